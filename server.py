@@ -2,22 +2,50 @@
 # Зависимости:
 #   pip install fastapi "uvicorn[standard]" python-multipart pandas openpyxl docxtpl requests
 # (docxtpl тянет python-docx, используется для генерации DOCX-инструкции)
+#
+# Тяжёлые зависимости (pandas, requests, docxtpl, python-docx, openpyxl, jinja2)
+# импортируются при первом обращении — воркер стартует и отвечает на /healthz сразу,
+# а /readyz становится готовым после прогрева (см. prepare_readiness).
+
+from __future__ import annotations
 
 import io
+import sys
+import importlib
 import re
+import hashlib
+import json
+import uuid
+import mimetypes
+import copy
+import functools
 import csv
 import zipfile
+import zlib
+import gzip
+import struct
+import string
 from pathlib import Path
-from typing import Optional, Dict, Tuple, List
+from collections import Counter, deque
+from urllib.parse import quote
+from typing import Optional, Dict, Tuple, List, NamedTuple
 
 import os
+import time
+import asyncio
 import tempfile
+import threading
 import subprocess
-
-import pandas as pd
-import requests
-from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Query
+import random
+import contextvars
+import tracemalloc
+import hmac
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Query, Request
 from fastapi.responses import (
+    Response,
     HTMLResponse,
     JSONResponse,
     StreamingResponse,
@@ -25,23 +53,494 @@ from fastapi.responses import (
     FileResponse,
 )
 from datetime import datetime
-from docxtpl import DocxTemplate
-import jinja2
-JINJA_ENV = jinja2.Environment()
-
-# для генерации DOCX-инструкции (ставится вместе с docxtpl)
-from docx import Document
-from docx.shared import Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import Alignment
-
-from templates_config import TEMPLATES
+
+import templates_config
 import unicodedata
+import logging
+
+log = logging.getLogger("uvicorn.error")
+
+# === Ленивые импорты тяжёлых зависимостей ===
+IMPORT_TIMINGS: Dict[str, float] = {}  # модуль → время первого импорта, мс
+_IMPORT_LOCK = threading.Lock()
+
+def import_dependency(name: str):
+    """Импортирует модуль при первом обращении и запоминает, сколько это заняло."""
+    if name in IMPORT_TIMINGS:
+        return sys.modules[name]
+    with _IMPORT_LOCK:
+        if name not in IMPORT_TIMINGS:
+            t0 = time.perf_counter()
+            importlib.import_module(name)
+            IMPORT_TIMINGS[name] = round((time.perf_counter() - t0) * 1000, 1)
+    return sys.modules[name]
+
+class _LazyModule:
+    """Заглушка модуля: настоящий импорт — при первом обращении к атрибуту."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(import_dependency(self._name), attr)
+
+pd = _LazyModule("pandas")
+requests = _LazyModule("requests")
+docxtpl = _LazyModule("docxtpl")
+
+# порядок важен только для отчёта: вложенные импорты засчитываются первому модулю
+HEAVY_DEPENDENCIES = ["pandas", "openpyxl", "requests", "jinja2", "docx", "docxtpl"]
+
+@asynccontextmanager
+async def lifespan(app):
+    # прогрев в фоне: /healthz отвечает сразу, /readyz — когда всё готово
+    threading.Thread(target=prepare_readiness, name="readiness", daemon=True).start()
+    if TEMPLATE_RELOAD_INTERVAL > 0:
+        threading.Thread(target=watch_templates, name="template-watcher", daemon=True).start()
+    yield
+
+app = FastAPI(title="Help University — DOCX → ZIP", version="3.6.0", lifespan=lifespan)
+
+# === Трассировка: спаны этапов запроса → OTLP JSON lines в локальный файл ===
+# Корневой спан — на POST-запрос (с вероятностью TRACE_SAMPLE), дочерние — этапы: загрузка
+# Google Sheets, чтение таблицы, records_from_wide_df, рендер каждого DOCX, PDF, запись ZIP.
+# Трасса пишется одной строкой ExportTraceServiceRequest (OTLP/JSON) — такой файл читает,
+# например, otlpjsonfile-ресивер OpenTelemetry Collector; при записи коллектор не нужен.
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0"))  # доля трассируемых запросов; 0 — выключено
+TRACE_FILE = Path(os.getenv("TRACE_FILE", str(Path(tempfile.gettempdir()) / "vkr_traces.jsonl")))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "20000"))  # на трассу; сверх — только счётчик
+_TRACE_LOCK = threading.Lock()
+
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER = 1, 2
+STATUS_UNSET, STATUS_ERROR = 0, 2
+
+class Trace:
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans: List["Span"] = []
+        self.dropped = 0
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "kind", "start", "end", "attrs", "error")
+
+    def __init__(self, trace: Trace, name: str, parent_id: str = "", attrs: Optional[dict] = None,
+                 kind: int = SPAN_KIND_INTERNAL):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attrs = dict(attrs or {})
+        self.error: Optional[str] = None
+        self.start = time.time_ns()
+        self.end = 0
+
+    def finish(self) -> None:
+        self.end = time.time_ns()
+        # list.append атомарен: спаны из потоков рендера пишутся без блокировки
+        if len(self.trace.spans) < TRACE_MAX_SPANS:
+            self.trace.spans.append(self)
+        else:
+            self.trace.dropped += 1
 
+_SPAN: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("vkr_span", default=None)
 
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Дочерний спан текущего: `with span("docx.render", template=...) as sp:` или декоратор
+    @span("pdf.convert"). Вне трассируемого запроса ничего не пишет (sp is None).
+    """
+    parent = _SPAN.get()
+    if parent is None:
+        yield None
+        return
+    sp = Span(parent.trace, name, parent.span_id, attrs)
+    token = _SPAN.set(sp)
+    try:
+        yield sp
+    except BaseException as e:
+        sp.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _SPAN.reset(token)
+        sp.finish()
+
+def start_span(name: str, **attrs) -> Optional[Span]:
+    """Дочерний спан текущего без with — для этапа, который закончится позже (sp.finish())."""
+    parent = _SPAN.get()
+    return Span(parent.trace, name, parent.span_id, attrs) if parent is not None else None
+
+def traced(fn, parent: Optional[Span] = None):
+    """
+    Для пулов потоков: fn выполнится с текущим спаном (или parent) как родителем
+    (контекст в поток не копируется).
+    """
+    parent = parent or _SPAN.get()
+    if parent is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = _SPAN.set(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _SPAN.reset(token)
+
+    return run
 
-app = FastAPI(title="Help University — DOCX → ZIP", version="3.6.0")
+def otlp_attributes(attrs: dict) -> List[dict]:
+    out = []
+    for key, value in attrs.items():
+        if isinstance(value, bool):
+            v = {"boolValue": value}
+        elif isinstance(value, int):
+            v = {"intValue": str(value)}
+        elif isinstance(value, float):
+            v = {"doubleValue": value}
+        else:
+            v = {"stringValue": str(value)}
+        out.append({"key": key, "value": v})
+    return out
+
+def export_trace(trace: Trace) -> None:
+    """Дописывает трассу строкой OTLP/JSON в TRACE_FILE; ошибка записи запрос не роняет."""
+    spans = []
+    for sp in trace.spans:
+        item = {
+            "traceId": trace.trace_id,
+            "spanId": sp.span_id,
+            "name": sp.name,
+            "kind": sp.kind,
+            "startTimeUnixNano": str(sp.start),
+            "endTimeUnixNano": str(sp.end),
+            "attributes": otlp_attributes(sp.attrs),
+            "status": {"code": STATUS_ERROR, "message": sp.error} if sp.error else {"code": STATUS_UNSET},
+        }
+        if sp.parent_id:
+            item["parentSpanId"] = sp.parent_id
+        spans.append(item)
+    resource = {"service.name": "vkr", "service.version": app.version, "process.pid": os.getpid()}
+    line = {"resourceSpans": [{
+        "resource": {"attributes": otlp_attributes(resource)},
+        "scopeSpans": [{"scope": {"name": "vkr.server"}, "spans": spans}],
+    }]}
+    try:
+        with _TRACE_LOCK, open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    except OSError as e:
+        log.warning("Не удалось записать трассу в %s: %s", TRACE_FILE, e)
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    if request.method != "POST" or TRACE_SAMPLE <= 0 or random.random() >= TRACE_SAMPLE:
+        return await call_next(request)
+
+    root = Span(Trace(), f"POST {request.url.path}", kind=SPAN_KIND_SERVER,
+                attrs={"http.request.method": "POST", "url.path": request.url.path})
+    token = _SPAN.set(root)
+    try:
+        response = await call_next(request)
+        root.attrs["http.response.status_code"] = response.status_code
+        if response.status_code >= 500:
+            root.error = f"HTTP {response.status_code}"
+        return response
+    except BaseException as e:
+        root.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _SPAN.reset(token)
+        root.finish()
+        if root.trace.dropped:
+            root.attrs["vkr.dropped_spans"] = root.trace.dropped
+        await asyncio.to_thread(export_trace, root.trace)
+
+# === Память: пик RSS на запрос, tracemalloc по этапам, снимки кучи ===
+# На каждый POST-запрос (MEMORY_ACCOUNTING) меряем RSS в начале/конце и пик (фоновый опрос /proc, пока есть
+# наблюдаемые запросы). Для доли MEMORY_TRACE_SAMPLE запросов ещё и tracemalloc: на каждый
+# этап (чтение таблицы, рендер, ZIP) — топ строк кода по приросту памяти. RSS общий на процесс:
+# при параллельных запросах их приросты перекрываются (см. concurrent в отчёте).
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # пусто — /admin/* выключены
+# по умолчанию — только при заданном ADMIN_TOKEN: без /admin/memory отчёты некому читать
+MEMORY_ACCOUNTING = os.getenv("MEMORY_ACCOUNTING", "1" if ADMIN_TOKEN else "0") == "1"
+MEMORY_TRACE_SAMPLE = float(os.getenv("MEMORY_TRACE_SAMPLE", "0"))  # доля запросов с tracemalloc
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "1"))  # глубина стека для group_by=traceback
+MEMORY_TOP = int(os.getenv("MEMORY_TOP", "10"))
+MEMORY_HISTORY = int(os.getenv("MEMORY_HISTORY", "100"))  # последних отчётов в /admin/memory
+MEMORY_POLL_INTERVAL = float(os.getenv("MEMORY_POLL_MS", "20")) / 1000
+MEMORY_SNAPSHOTS = int(os.getenv("MEMORY_SNAPSHOTS", "4"))  # снимков кучи держим в памяти
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def current_rss() -> int:
+    """RSS процесса в байтах: /proc/self/statm (Linux), иначе — пиковый ru_maxrss."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+        except ImportError:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def mb(n: int) -> float:
+    return round(n / (1024 * 1024), 1)
+
+class RssWatch:
+    __slots__ = ("start", "peak", "end")
+
+    def __init__(self):
+        self.start = self.peak = self.end = current_rss()
+
+_WATCHES: set = set()
+_WATCH_COND = threading.Condition()
+_WATCH_THREAD: Optional[threading.Thread] = None
+
+def _poll_rss() -> None:
+    while True:
+        with _WATCH_COND:
+            while not _WATCHES:
+                _WATCH_COND.wait()
+            watches = list(_WATCHES)
+        rss = current_rss()
+        for w in watches:
+            if rss > w.peak:
+                w.peak = rss
+        time.sleep(MEMORY_POLL_INTERVAL)
+
+@contextmanager
+def watch_rss():
+    """RSS в начале/конце блока и пик между ними (опрос раз в MEMORY_POLL_MS)."""
+    global _WATCH_THREAD
+    w = RssWatch()
+    with _WATCH_COND:
+        if _WATCH_THREAD is None:
+            _WATCH_THREAD = threading.Thread(target=_poll_rss, name="rss-poll", daemon=True)
+            _WATCH_THREAD.start()
+        _WATCHES.add(w)
+        _WATCH_COND.notify()
+    try:
+        yield w
+    finally:
+        with _WATCH_COND:
+            _WATCHES.discard(w)
+        w.end = current_rss()
+        w.peak = max(w.peak, w.end)
+
+# tracemalloc глобален на процесс: включаем, пока он нужен хоть одному запросу или снимкам /admin
+# (если его включили снаружи, например PYTHONTRACEMALLOC=1, — не выключаем)
+_TRACEMALLOC_LOCK = threading.Lock()
+_TRACEMALLOC_USERS = 0
+_TRACEMALLOC_OWNED = False
+
+def tracemalloc_acquire() -> None:
+    global _TRACEMALLOC_USERS, _TRACEMALLOC_OWNED
+    with _TRACEMALLOC_LOCK:
+        if _TRACEMALLOC_USERS == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_TRACE_FRAMES)
+            _TRACEMALLOC_OWNED = True
+        _TRACEMALLOC_USERS += 1
+
+def tracemalloc_release() -> None:
+    global _TRACEMALLOC_USERS, _TRACEMALLOC_OWNED
+    with _TRACEMALLOC_LOCK:
+        _TRACEMALLOC_USERS = max(0, _TRACEMALLOC_USERS - 1)
+        if _TRACEMALLOC_USERS == 0 and _TRACEMALLOC_OWNED:
+            tracemalloc.stop()
+            _TRACEMALLOC_OWNED = False
+
+def heap_snapshot() -> "tracemalloc.Snapshot":
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+_STDLIB_DIR = os.path.dirname(os.__file__).replace("\\", "/") + "/"
+
+def frame_location(frame, with_line: bool = True) -> str:
+    # пути библиотек — от site-packages/stdlib, чтобы было видно pandas/lxml/zipfile, а не корень venv
+    name = frame.filename.replace("\\", "/")
+    if "site-packages/" in name:
+        name = name.split("site-packages/", 1)[1]
+    elif name.startswith(_STDLIB_DIR):
+        name = name[len(_STDLIB_DIR):]
+    return f"{name}:{frame.lineno}" if with_line else name
+
+def top_allocations(stats, limit: int = MEMORY_TOP, with_line: bool = True) -> List[dict]:
+    """Топ StatisticDiff по приросту: где (файл:строка, для traceback — стек) и сколько."""
+    out = []
+    for st in stats:
+        if st.size_diff <= 0:
+            continue
+        out.append({
+            "where": " <- ".join(frame_location(f, with_line) for f in reversed(st.traceback)),
+            "size_kb": round(st.size_diff / 1024, 1),
+            "count": st.count_diff,
+        })
+        if len(out) >= limit:
+            break
+    return out
+
+class MemoryReport:
+    def __init__(self, path: str, traced: bool, concurrent: int):
+        self.path = path
+        self.traced = traced
+        self.concurrent = concurrent
+        self.stages: List[dict] = []
+
+_MEMORY: contextvars.ContextVar[Optional[MemoryReport]] = contextvars.ContextVar("vkr_memory", default=None)
+MEMORY_REPORTS: deque = deque(maxlen=MEMORY_HISTORY)
+_MEMORY_ACTIVE = 0
+
+@contextmanager
+def memory_stage(name: str):
+    """Этап запроса в отчёте о памяти (и декоратор): прирост/пик RSS, при tracemalloc — топ аллокаций."""
+    report = _MEMORY.get()
+    if report is None:
+        yield
+        return
+    before = heap_snapshot() if report.traced and tracemalloc.is_tracing() else None
+    w = None
+    try:
+        with watch_rss() as w:
+            yield
+    finally:
+        stage = {
+            "stage": name,
+            "rss_delta_mb": mb(w.end - w.start),
+            "rss_peak_delta_mb": mb(w.peak - w.start),
+        }
+        if before is not None:
+            stage["top"] = top_allocations(heap_snapshot().compare_to(before, "lineno"))
+        report.stages.append(stage)
+
+@app.middleware("http")
+async def account_memory(request: Request, call_next):
+    global _MEMORY_ACTIVE
+    if request.method != "POST" or not MEMORY_ACCOUNTING:
+        return await call_next(request)
+
+    traced = MEMORY_TRACE_SAMPLE > 0 and random.random() < MEMORY_TRACE_SAMPLE
+    _MEMORY_ACTIVE += 1  # только из event loop — без блокировки
+    report = MemoryReport(request.url.path, traced, _MEMORY_ACTIVE)
+    if traced:
+        await asyncio.to_thread(tracemalloc_acquire)
+    token = _MEMORY.set(report)
+    started = time.perf_counter()
+    status = 500
+    try:
+        with watch_rss() as w:
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        _MEMORY.reset(token)
+        _MEMORY_ACTIVE -= 1
+        if traced:
+            await asyncio.to_thread(tracemalloc_release)
+        entry = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "path": report.path,
+            "status": status,
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+            "concurrent": report.concurrent,
+            "tracemalloc": traced,
+            "rss_start_mb": mb(w.start),
+            "rss_delta_mb": mb(w.end - w.start),
+            "rss_peak_delta_mb": mb(w.peak - w.start),
+            "stages": report.stages,
+        }
+        MEMORY_REPORTS.append(entry)
+        log.info("Память %s: пик +%.1f МБ, итог %+.1f МБ", report.path, entry["rss_peak_delta_mb"], entry["rss_delta_mb"])
+
+# -------- /admin: отчёты о памяти и разница снимков кучи --------
+_HEAP_SNAPSHOTS: Dict[int, Tuple[str, "tracemalloc.Snapshot"]] = {}
+_HEAP_LOCK = threading.Lock()
+_HEAP_SEQ = 0
+_HEAP_HELD = False  # снимки держат tracemalloc включённым до /admin/heap/stop
+
+def require_admin(request: Request) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(404, "Админ-эндпоинты выключены (не задан ADMIN_TOKEN)")
+    if not hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(403, "Неверный X-Admin-Token")
+
+def tracemalloc_status() -> dict:
+    if not tracemalloc.is_tracing():
+        return {"tracing": False}
+    current, peak = tracemalloc.get_traced_memory()
+    return {"tracing": True, "current_mb": mb(current), "peak_mb": mb(peak), "frames": tracemalloc.get_traceback_limit()}
+
+@app.get("/admin/memory")
+def admin_memory(request: Request):
+    """RSS процесса, состояние tracemalloc и последние отчёты о памяти по запросам."""
+    require_admin(request)
+    return JSONResponse({
+        "rss_mb": mb(current_rss()),
+        "tracemalloc": tracemalloc_status(),
+        "snapshots": [{"id": i, "time": t} for i, (t, _) in sorted(_HEAP_SNAPSHOTS.items())],
+        "requests": list(MEMORY_REPORTS),
+    })
+
+@app.post("/admin/heap/snapshot")
+def admin_heap_snapshot(request: Request):
+    """
+    Снимок кучи (tracemalloc). Первый вызов включает tracemalloc: отслеживаются только
+    аллокации после него, поэтому разницу имеет смысл смотреть между двумя снимками.
+    """
+    global _HEAP_SEQ, _HEAP_HELD
+    require_admin(request)
+    with _HEAP_LOCK:
+        started = not _HEAP_HELD
+        if started:
+            tracemalloc_acquire()
+            _HEAP_HELD = True
+        snap = heap_snapshot()
+        _HEAP_SEQ += 1
+        _HEAP_SNAPSHOTS[_HEAP_SEQ] = (datetime.now().isoformat(timespec="seconds"), snap)
+        while len(_HEAP_SNAPSHOTS) > MEMORY_SNAPSHOTS:
+            _HEAP_SNAPSHOTS.pop(min(_HEAP_SNAPSHOTS))
+        return JSONResponse({"id": _HEAP_SEQ, "started_tracing": started, "tracemalloc": tracemalloc_status()})
+
+@app.get("/admin/heap/diff")
+def admin_heap_diff(
+    request: Request,
+    base: int = Query(..., description="id более раннего снимка"),
+    target: Optional[int] = Query(default=None, description="id более позднего снимка; без него — снимок сейчас"),
+    group_by: str = Query(default="lineno", pattern="^(lineno|filename|traceback)$"),
+    limit: int = Query(default=MEMORY_TOP, ge=1, le=200),
+):
+    """Что выросло между двумя снимками: топ мест аллокаций по приросту."""
+    require_admin(request)
+    with _HEAP_LOCK:
+        if base not in _HEAP_SNAPSHOTS or (target is not None and target not in _HEAP_SNAPSHOTS):
+            raise HTTPException(404, "Нет такого снимка (старые вытесняются, см. MEMORY_SNAPSHOTS)")
+        if not tracemalloc.is_tracing():
+            raise HTTPException(409, "tracemalloc выключен — сделайте новый снимок")
+        before = _HEAP_SNAPSHOTS[base][1]
+        after = _HEAP_SNAPSHOTS[target][1] if target is not None else heap_snapshot()
+    stats = after.compare_to(before, group_by)
+    return JSONResponse({
+        "base": base,
+        "target": target if target is not None else "now",
+        "group_by": group_by,
+        "size_diff_mb": mb(sum(st.size_diff for st in stats)),
+        "top": top_allocations(stats, limit, with_line=group_by != "filename"),
+    })
+
+@app.post("/admin/heap/stop")
+def admin_heap_stop(request: Request):
+    """Удаляет снимки и выключает tracemalloc (если он не нужен запросам с учётом памяти)."""
+    global _HEAP_HELD
+    require_admin(request)
+    with _HEAP_LOCK:
+        _HEAP_SNAPSHOTS.clear()
+        if _HEAP_HELD:
+            _HEAP_HELD = False
+            tracemalloc_release()
+    return JSONResponse({"tracemalloc": tracemalloc_status()})
 
 # === Стабильные ID для шаблонов ===
 def slug_id(v: str) -> str:
@@ -54,37 +553,172 @@ def slug_id(v: str) -> str:
         out.append(ch if (ch.isalnum() or ch in allowed) else "_")
     return re.sub(r"\s+", "_", "".join(out)).lower()
 
-# один раз навешиваем id на все шаблоны (учитываем ПУТЬ, чтобы комплекты не пересекались)
-for idx, tpl in enumerate(TEMPLATES):
-    if "id" not in tpl:
-        # "input/first/дневник.docx" -> "input/first/дневник"
-        rel = tpl["path"].replace("\\", "/")
-        rel_no_ext = re.sub(r"\.[^.\\/]+$", "", rel)
-        tpl["id"] = slug_id(rel_no_ext) or f"tpl_{idx:03d}"
+# === План шаблонов: конфиг + id + байты .docx, меняется только целиком ===
+# Запрос берёт current_plan() один раз и работает с ним до конца, поэтому горячая
+# перезагрузка (см. watch_templates) не задевает уже идущие генерации.
+CONFIG_PATH = Path(templates_config.__file__).resolve()
+
+class TemplatePlan:
+    def __init__(self, templates: List[dict], signature: Dict[str, Tuple[int, int]]):
+        self.templates = templates
+        self.signature = signature  # путь → (mtime_ns, size) конфига и всех .docx
+        self.by_id = {t["id"].lower(): t for t in templates}
+        self.order = {t["id"].lower(): n for n, t in enumerate(templates)}
+        # комплекты: kit → шаблоны его папки в порядке конфига (считается один раз на план)
+        self.kits = {kit: templates_for_prefix(self, prefix) for kit, prefix in KIT_FOLDERS.items()}
+        # нормализованные (_norm) названия колонок, которые ждут шаблоны, — для поиска строки заголовков
+        self.expected_headers = header_index(templates)
+        self.built_at = datetime.now().isoformat(timespec="seconds")
+
+        # побайтно одинаковые .docx: sha256 → id шаблонов (байты у них — один общий объект)
+        by_sha: Dict[str, List[str]] = {}
+        for t in templates:
+            if "_sha" in t:
+                by_sha.setdefault(t["_sha"], []).append(t["id"])
+        self.duplicates = {sha: ids for sha, ids in by_sha.items() if len(ids) > 1}
+
+def file_signature(path) -> Tuple[int, int]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (0, -1)
+    return (st.st_mtime_ns, st.st_size)
+
+def plan_signature(config: List[dict]) -> Dict[str, Tuple[int, int]]:
+    sig = {str(CONFIG_PATH): file_signature(CONFIG_PATH)}
+    for tpl in config:
+        sig[tpl["path"]] = file_signature(tpl["path"])
+    return sig
+
+def build_plan(config: List[dict], previous: Optional[TemplatePlan] = None) -> TemplatePlan:
+    """
+    Копия конфига с id (учитываем ПУТЬ, чтобы комплекты не пересекались) и байтами шаблонов.
+    Байты неизменившихся файлов берём из previous — перечитываются только изменённые.
+    """
+    signature = plan_signature(config)
+    old_sources: Dict[str, Tuple[Tuple[int, int], dict]] = {}
+    if previous is not None:
+        for t in previous.templates:
+            old_sources[t["path"]] = (previous.signature.get(t["path"]), t)
+
+    templates = []
+    blobs: Dict[str, bytes] = {}  # sha256 → байты: одинаковые файлы держим в памяти один раз
+    for idx, conf in enumerate(config):
+        tpl = dict(conf)
+        if "id" not in tpl:
+            # "input/first/дневник.docx" -> "input/first/дневник"
+            rel = tpl["path"].replace("\\", "/")
+            rel_no_ext = re.sub(r"\.[^.\\/]+$", "", rel)
+            tpl["id"] = slug_id(rel_no_ext) or f"tpl_{idx:03d}"
+
+        sig = signature[tpl["path"]]
+        old = old_sources.get(tpl["path"])
+        if old is not None and old[0] == sig and "_blob" in old[1]:
+            tpl["_blob"], tpl["_sha"] = old[1]["_blob"], old[1]["_sha"]
+        elif sig[1] >= 0:
+            try:
+                blob = Path(tpl["path"]).read_bytes()
+                tpl["_blob"], tpl["_sha"] = blob, hashlib.sha256(blob).hexdigest()
+            except OSError:
+                pass
+        if "_sha" in tpl:
+            tpl["_blob"] = blobs.setdefault(tpl["_sha"], tpl["_blob"])
+        templates.append(tpl)
+    return TemplatePlan(templates, signature)
+
+_PLAN: Optional[TemplatePlan] = None
+_PLAN_LOCK = threading.Lock()
+
+def current_plan() -> TemplatePlan:
+    global _PLAN
+    if _PLAN is None:
+        with _PLAN_LOCK:
+            if _PLAN is None:
+                _PLAN = build_plan(templates_config.TEMPLATES)
+    return _PLAN
+
+# -------- горячая перезагрузка templates_config.py и .docx --------
+TEMPLATE_RELOAD_INTERVAL = float(os.getenv("TEMPLATE_RELOAD_INTERVAL", "2"))  # сек; 0 — выключено
+RELOAD_STATUS: Dict[str, object] = {"reloads": 0}
+
+# подпись templates_config.py, который не удалось импортировать: не перечитываем его каждый тик
+_BAD_CONFIG_SIGNATURE: Optional[Tuple[int, int]] = None
+
+def reload_plan_if_changed() -> bool:
+    """Пересобирает план, если поменялся конфиг или какой-то .docx; подмена — одним присваиванием."""
+    global _PLAN, _BAD_CONFIG_SIGNATURE
+    old = current_plan()
+    config = templates_config.TEMPLATES
+    config_sig = file_signature(CONFIG_PATH)
+    if config_sig != old.signature.get(str(CONFIG_PATH)) and config_sig != _BAD_CONFIG_SIGNATURE:
+        try:
+            config = importlib.reload(templates_config).TEMPLATES
+            _BAD_CONFIG_SIGNATURE = None
+        except Exception as e:
+            # битый конфиг — остаёмся на старом плане, пока файл не исправят
+            RELOAD_STATUS["error"] = f"{type(e).__name__}: {e}"
+            _BAD_CONFIG_SIGNATURE = config_sig
+            return False
+    current = plan_signature(config)
+    if config_sig == _BAD_CONFIG_SIGNATURE:
+        # конфиг всё ещё битый: следим только за .docx, план — на последнем рабочем конфиге
+        current[str(CONFIG_PATH)] = old.signature.get(str(CONFIG_PATH))
+    if current == old.signature:
+        return False
+
+    new = build_plan(config, old)
+    changed = sorted(
+        t["id"] for t in new.templates
+        if new.signature.get(t["path"]) != old.signature.get(t["path"])
+        or t.get("_sha") != (old.by_id.get(t["id"].lower()) or {}).get("_sha")
+    )
+    with _PLAN_LOCK:
+        _PLAN = new
+    RELOAD_STATUS.update({
+        "reloads": RELOAD_STATUS["reloads"] + 1,
+        "last": new.built_at,
+        "changed": changed,
+        "error": RELOAD_STATUS.get("error") if config_sig == _BAD_CONFIG_SIGNATURE else None,
+    })
+    return True
+
+def watch_templates() -> None:
+    while True:
+        time.sleep(TEMPLATE_RELOAD_INTERVAL)
+        try:
+            reload_plan_if_changed()
+        except Exception as e:
+            RELOAD_STATUS["error"] = f"{type(e).__name__}: {e}"
 
 @app.get("/catalog")
-def catalog(prefix: Optional[str] = None):
+def catalog(request: Request, prefix: Optional[str] = None, kit: Optional[str] = None):
     """
-    Отдаём список документов. Если передан prefix,
-    фильтруем только шаблоны, у которых path начинается с этого префикса.
+    Отдаём список документов. kit — документы комплекта (из индекса плана);
+    prefix — шаблоны, у которых path начинается с этого префикса.
+    JSON собирается один раз на версию плана шаблонов (ETag, 304, gzip/brotli).
     """
-    tpls = TEMPLATES
-    if prefix:
-        pfx = prefix.replace("\\", "/")
-        tpls = [
-            t for t in TEMPLATES
-            if t["path"].replace("\\", "/").startswith(pfx)
-        ]
-
-    items = []
-    for t in tpls:
-        path_norm = t["path"].replace("\\", "/")
-        items.append({
-            "id": t["id"],
-            "title": Path(path_norm).stem + ".docx",
-            "path": path_norm,
-        })
-    return {"items": items}
+    plan = current_plan()
+    if kit:
+        tpls = kit_templates(plan, kit.strip())
+        key = f"catalog:kit:{kit.strip()}"
+    else:
+        tpls = None
+        key = f"catalog:{prefix or ''}"
+
+    def build():
+        items_src = tpls if tpls is not None else (templates_for_prefix(plan, prefix) if prefix else plan.templates)
+        items = []
+        for t in items_src:
+            path_norm = t["path"].replace("\\", "/")
+            items.append({
+                "id": t["id"],
+                "title": Path(path_norm).stem + ".docx",
+                "path": path_norm,
+            })
+        body = json.dumps({"items": items}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return StaticAsset(body, "application/json")
+
+    return static_asset(key, plan.signature, build).response(request)
 
 # === Пути базы ===
 BASE_DIR = Path(__file__).resolve().parent
@@ -107,6 +741,15 @@ KIT_TEMPLATES: Dict[str, Path] = {
     "kit4": BASE_DIR / "table_templates" / "docx11 шаблон.xlsx",
 }
 
+# Комплекты → папка в input/. Списки шаблонов комплектов считаются в плане (TemplatePlan.kits),
+# UI и /generate передают только id комплекта.
+KIT_FOLDERS: Dict[str, str] = {
+    "kit1": "input/first/",
+    "kit2": "input/менеджмент_УП_экономика",
+    "kit3": "input/Реклама, лингвистика, журналистика, ГМУ",
+    "kit4": "input/new_docx11/",
+}
+
 # KIT_MACROS: Dict[str, Path] = {
 #     # примеры — переименуй под свои реальные файлы:
 #     "kit1": BASE_DIR / "macros" / "макрос для рекламы.xlsm",
@@ -445,17 +1088,6 @@ select option:hover {
 <footer>© 2025 Help University • Интеллектуальная автоматизация документов</footer>
 
 <script>
-  // Комплекты → папка в input/
-  // ВАЖНО: здесь должны быть реальные папки, в которых лежат шаблоны из templates_config.py
-  const kitFolders = {
-    // пример для будущего:
-    // kitn: "input/new_docx11111/",
-    kit1: "input/first/",
-    kit2: "input/менеджмент_УП_экономика",
-    kit3: "input/Реклама, лингвистика, журналистика, ГМУ",
-    kit4: "input/new_docx11/",
-  };
-
   // НОВОЕ: соответствие "комплект → имя Excel-шаблона"
   // Здесь должны быть ТОЧНО такие же имена, как в KIT_TEMPLATES на бэкенде.
   const kitTemplateNames = {
@@ -485,17 +1117,16 @@ select option:hover {
       return;
     }
 
-    const prefix = kitFolders[kit];
-    if (!prefix) {
-      downloadBtn.disabled = true;
-      docsDiv.innerHTML = '<div class="empty">Для этого комплекта ещё не настроена папка</div>';
-      return;
-    }
-
     downloadBtn.disabled = false;
 
     try {
-      const resp = await fetch("/catalog?prefix=" + encodeURIComponent(prefix));
+      // комплекты (kit → папка с шаблонами) описаны на сервере: KIT_FOLDERS
+      const resp = await fetch("/catalog?kit=" + encodeURIComponent(kit));
+      if (resp.status === 400) {
+        downloadBtn.disabled = true;
+        docsDiv.innerHTML = '<div class="empty">Для этого комплекта ещё не настроена папка</div>';
+        return;
+      }
       if (!resp.ok) throw new Error("HTTP " + resp.status);
       const data = await resp.json();
       const items = data.items || [];
@@ -603,9 +1234,6 @@ select option:hover {
       alert("В этом комплекте нет документов");
       return;
     }
-    const ids = items
-      .map(el => el.dataset.id)
-      .filter(Boolean);
 
     // Источник данных: файл или Google Sheet
     const hasFile = fileInput.files && fileInput.files[0];
@@ -622,8 +1250,8 @@ select option:hover {
     } else {
       fd.append("gsheet_url", gsheet);                 // как и раньше
     }
-    fd.append("header_row", "1");                       // как в старом UI
-    fd.append("include", ids.join(","));                // КЛЮЧЕВОЕ: список id шаблонов
+    fd.append("header_row", "0");                       // 0 — сервер сам найдёт строку заголовков
+    fd.append("kit", kit);                              // КЛЮЧЕВОЕ: id комплекта, шаблоны знает сервер
 
     const prevText = downloadBtn.textContent;
     downloadBtn.disabled = true;
@@ -702,7 +1330,11 @@ def normalize_date(value) -> str:
     s = str(value).strip()
     if not s:
         return ""
+    return _normalize_date_str(s)
 
+@functools.lru_cache(maxsize=4096)
+def _normalize_date_str(s: str) -> str:
+    # одно и то же значение записи нормализуется для каждого шаблона — кэшируем
     # возможные входные форматы
     formats = [
         "%Y-%m-%d %H:%M:%S",  # 2025-10-02 00:00:00
@@ -748,9 +1380,90 @@ def uc(value: str) -> str:
     """
     return safe(value).upper()
 
-JINJA_ENV.filters["letter"] = letter
-JINJA_ENV.filters["lc"] = lc
-JINJA_ENV.filters["uc"] = uc
+_JINJA_ENV = None
+_JINJA_LOCK = threading.Lock()
+
+# Байткод скомпилированных Jinja-шаблонов — в общей папке: её видят все воркеры uvicorn
+# и она переживает рестарты. Ключ — sha256 исходника после patch_xml. "" — без кэша на диске.
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR", str(Path(tempfile.gettempdir()) / "vkr_jinja_cache"))
+JINJA_CACHE_MAX_MB = float(os.getenv("JINJA_CACHE_MAX_MB", "64"))
+_JINJA_SOURCE = threading.local()  # исходник, который сейчас компилирует этот поток
+
+def jinja_bytecode_cache(directory: str):
+    """FileSystemBytecodeCache с ограничением размера папки: при записи удаляем давно не читанные."""
+    jinja2 = import_dependency("jinja2")
+
+    class BoundedBytecodeCache(jinja2.FileSystemBytecodeCache):
+        def load_bytecode(self, bucket):
+            super().load_bytecode(bucket)
+            if bucket.code is not None:
+                # mtime = время последнего чтения: по нему и вытесняем
+                try:
+                    os.utime(self._get_cache_filename(bucket))
+                except OSError:
+                    pass
+
+        def dump_bytecode(self, bucket):
+            super().dump_bytecode(bucket)
+            evict_jinja_cache(self.directory)
+
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    return BoundedBytecodeCache(directory, pattern="vkr_%s.jinja")
+
+def evict_jinja_cache(directory: str) -> None:
+    files = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".jinja"):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue  # другой воркер уже удалил
+            files.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    limit = JINJA_CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(files):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def jinja_env():
+    """Общее Jinja-окружение для рендера шаблонов (создаётся при первом рендере)."""
+    global _JINJA_ENV
+    if _JINJA_ENV is None:
+        with _JINJA_LOCK:
+            if _JINJA_ENV is None:
+                jinja2 = import_dependency("jinja2")
+                bcc = None
+                if JINJA_CACHE_DIR:
+                    try:
+                        bcc = jinja_bytecode_cache(JINJA_CACHE_DIR)
+                    except OSError as e:
+                        log.warning("Кэш байткода Jinja выключен (%s): %s", JINJA_CACHE_DIR, e)
+                # байткод берётся только для шаблонов из загрузчика: исходник отдаём по его sha256
+                loader = jinja2.FunctionLoader(lambda name: getattr(_JINJA_SOURCE, "value", None))
+                env = jinja2.Environment(loader=loader, bytecode_cache=bcc)
+                env.filters["letter"] = letter
+                env.filters["lc"] = lc
+                env.filters["uc"] = uc
+                _JINJA_ENV = env
+    return _JINJA_ENV
+
+def compile_jinja(source: str):
+    """Template по исходнику через кэш байткода (в отличие от env.from_string, который его обходит)."""
+    name = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    _JINJA_SOURCE.value = source
+    try:
+        return jinja_env().get_template(name)
+    except import_dependency("jinja2").TemplateSyntaxError as e:
+        # как у from_string: без «File "<sha256>"» в тексте ошибки
+        e.name = e.filename = None
+        raise
+    finally:
+        _JINJA_SOURCE.value = None
 
 class SafeMap(dict):
     def __missing__(self, key): return ""
@@ -765,6 +1478,7 @@ def slugify_path(path: str) -> str:
 
 SOFFICE_BIN = os.getenv("SOFFICE_BIN", "soffice")  # на Windows можно указать полный путь до soffice.exe
 
+@span("pdf.convert")
 def docx_bytes_to_pdf_bytes(docx_bytes: bytes) -> bytes:
     """
     Конвертирует DOCX (bytes) -> PDF (bytes) через LibreOffice (soffice --headless).
@@ -806,40 +1520,181 @@ def docx_bytes_to_pdf_bytes(docx_bytes: bytes) -> bytes:
 def _norm(s: str) -> str:
     return re.sub(r"\s+", "", str(s)).replace("\ufeff","").replace("\xa0","").replace("ё","е").lower()
 
-def expected_headers() -> set:
+def header_index(templates: List[dict]) -> frozenset:
     exp = {"фио","группа"}
-    for tpl in TEMPLATES:
+    for tpl in templates:
         exp |= {_norm(v) for v in tpl["fields"].values()}
         exp |= {_norm(m) for m in re.findall(r"\{([^}]+)\}", tpl["out"])}
-    return exp
+    return frozenset(exp)
+
+def expected_headers() -> frozenset:
+    return current_plan().expected_headers
 
 def score_columns(cols) -> int:
     exp = expected_headers()
     return sum(1 for c in cols if _norm(c) in exp)
 
-def read_wide_try(file_bytes: bytes, is_xlsx: bool, header_row: int) -> Tuple[pd.DataFrame, Dict]:
+# -------- автоопределение строки заголовков (header_row=0) --------
+# Первые HEADER_SCAN_ROWS строк уже прочитанной таблицы сравниваются с индексом ожидаемых колонок;
+# вместо «загрузить → не та строка → поменять header_row → загрузить снова» — один разбор.
+HEADER_SCAN_ROWS = int(os.getenv("HEADER_SCAN_ROWS", "20"))
+HEADER_SCAN_BYTES = 256 * 1024  # CSV: из скольких первых байт берём строки для поиска
+
+def detect_header_row(rows: List[list]) -> Dict[str, object]:
+    """
+    Строка заголовков: та, где больше всего разных названий из индекса (ничья — верхняя).
+    confidence = лучший / (лучший + второй): 1.0 — похожа единственная строка, 0.5 — две
+    одинаково похожи, 0 — ни одна (тогда берём первую строку, как раньше). row — с единицы.
+    """
+    exp = expected_headers()
+    scores = [len({_norm(v) for v in row if safe(v)} & exp) for row in rows[:HEADER_SCAN_ROWS]]
+    if not scores or max(scores) == 0:
+        return {"row": 1, "score": 0, "confidence": 0.0, "candidates": []}
+    ranked = sorted(range(len(scores)), key=lambda i: (-scores[i], i))
+    best = ranked[0]
+    runner = scores[ranked[1]] if len(ranked) > 1 else 0
+    return {
+        "row": best + 1,
+        "score": scores[best],
+        "confidence": round(scores[best] / (scores[best] + runner), 2),
+        "candidates": [{"row": i + 1, "score": scores[i]} for i in ranked[:3] if scores[i]],
+    }
+
+def frame_from_grid(grid: pd.DataFrame, header: int) -> pd.DataFrame:
+    """
+    Таблица под строкой header (с нуля) из сетки, прочитанной с header=None, — как её дал бы
+    read_excel(header=header): пустые заголовки → «Unnamed: i», повторы → «X.1», типы колонок
+    выводятся заново по строкам данных (infer_objects), чтобы даты и числа остались типизированными.
+    """
+    names: List[object] = []
+    seen: Dict[object, int] = {}
+    for i, v in enumerate(grid.iloc[header].tolist()):
+        name = v if isinstance(v, str) else (safe(v) or f"Unnamed: {i}")
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    df = grid.iloc[header + 1:].reset_index(drop=True)
+    df.columns = names
+    return df.infer_objects()
+
+def read_excel_sheet(read, header_row: int) -> Tuple[pd.DataFrame, Optional[dict]]:
+    """
+    read(header=..., nrows=...) — pd.read_excel / ExcelFile.parse для выбранного листа.
+    header_row ≥ 1 — как указано; 0 — авто: лист читается один раз без заголовка,
+    строка заголовков ищется в этой же сетке. Второе значение — итог поиска (или None).
+    """
+    if header_row > 0:
+        return read(header=header_row - 1, nrows=MAX_TABLE_ROWS + 1), None
+    grid = read(header=None, nrows=HEADER_SCAN_ROWS + MAX_TABLE_ROWS + 1)
+    if grid.empty:
+        return grid, None
+    detected = detect_header_row(grid.iloc[:HEADER_SCAN_ROWS].values.tolist())
+    return frame_from_grid(grid, detected["row"] - 1), detected
+
+def csv_head_rows(source, sep: str) -> List[list]:
+    """Первые строки CSV для поиска заголовков (пустые пропускаем — pandas их тоже не считает)."""
+    source.seek(0)
+    text = source.read(HEADER_SCAN_BYTES).decode("utf-8-sig", errors="ignore")
+    rows = []
+    for row in csv.reader(io.StringIO(text), delimiter=sep):
+        if row:
+            rows.append(row)
+            if len(rows) >= HEADER_SCAN_ROWS:
+                break
+    source.seek(0)
+    return rows
+
+def normalize_typed_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Один векторный проход по типизированным колонкам (xlsx-загрузки, xlsx-экспорт Google Sheets):
+    - даты → 'ДД.ММ.ГГГГ' (как сделал бы normalize_date для каждой ячейки);
+    - «целые» float-колонки (курс, ИНН, год) → строки без '.0'.
+    Дальше safe/normalize_date видят уже готовые строки и не парсят их заново.
+    """
+    for col in df.columns:
+        s = df[col]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            df[col] = s.dt.strftime("%d.%m.%Y").fillna("")
+        elif pd.api.types.is_float_dtype(s):
+            notna = s.dropna()
+            if not notna.empty and (notna % 1 == 0).all() and notna.abs().max() < 2**53:
+                df[col] = s.astype("Int64").astype("string").fillna("").astype(object)
+    return df
+
+# -------- ограничения на загружаемые таблицы --------
+# Starlette держит загрузку во временном файле (SpooledTemporaryFile: в памяти до 1 МБ, дальше
+# на диске); pandas читает прямо из этого дескриптора — без копии всего файла в bytes.
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", "20"))
+MAX_TABLE_ROWS = int(os.getenv("MAX_TABLE_ROWS", "5000"))  # строк данных (студентов) в листе
+
+def check_upload_size(size: int) -> None:
+    if size > MAX_UPLOAD_MB * 1024 * 1024:
+        raise HTTPException(413, f"Файл таблицы больше {MAX_UPLOAD_MB:g} МБ")
+
+def check_row_count(df: pd.DataFrame) -> None:
+    # читаем не больше MAX_TABLE_ROWS + 1 строк: лишняя строка = таблица слишком длинная
+    if len(df) > MAX_TABLE_ROWS:
+        raise HTTPException(413, f"В таблице больше {MAX_TABLE_ROWS} строк данных")
+
+@app.middleware("http")
+async def reject_large_uploads(request: Request, call_next):
+    # заведомо слишком большое тело отклоняем по Content-Length, не принимая его
+    length = request.headers.get("content-length")
+    if request.method == "POST" and length and length.isdigit():
+        if int(length) > (MAX_UPLOAD_MB + 1) * 1024 * 1024:  # +1 МБ на остальные поля формы
+            return JSONResponse({"detail": f"Файл таблицы больше {MAX_UPLOAD_MB:g} МБ"}, status_code=413)
+    return await call_next(request)
+
+def upload_handle(file: UploadFile):
+    """Дескриптор загрузки с начала файла (после проверки размера) — вместо file.file.read()."""
+    fh = file.file
+    fh.seek(0, os.SEEK_END)
+    check_upload_size(fh.tell())
+    fh.seek(0)
+    return fh
+
+def read_wide_try(source, is_xlsx: bool, header_row: int, sheet_name=0) -> Tuple[pd.DataFrame, Dict]:
+    """header_row — номер строки заголовков с единицы; 0 — найти автоматически (meta["header_detected"])."""
+    source.seek(0)
     if is_xlsx:
-        df = pd.read_excel(io.BytesIO(file_bytes), sheet_name=0, header=max(header_row-1,0))
-        return df, {"source":"xlsx", "mode":"wide", "header_row": header_row-1}
+        with span("read_excel", sheet=str(sheet_name)):
+            df, detected = read_excel_sheet(functools.partial(pd.read_excel, source, sheet_name=sheet_name), header_row)
+            check_row_count(df)
+            df = normalize_typed_columns(df)
+        meta = {"source":"xlsx", "mode":"wide"}
     else:
-        sample = file_bytes[:2048].decode("utf-8", errors="ignore")
+        sample = source.read(2048).decode("utf-8", errors="ignore")
+        source.seek(0)
         try: sep = csv.Sniffer().sniff(sample).delimiter
         except Exception: sep = ","
-        df = pd.read_csv(io.BytesIO(file_bytes), sep=sep, header=max(header_row-1,0))
-        return df, {"source":"csv", "mode":"wide", "header_row": header_row-1}
-
-def read_kv_from_raw(file_bytes: bytes, is_xlsx: bool, key_row: int = 1, val_row: int = 2) -> Tuple[Dict[str,str], Dict]:
+        with span("read_csv"):
+            detected = None
+            if header_row <= 0:
+                detected = detect_header_row(csv_head_rows(source, sep))
+            header = detected["row"] if detected else header_row
+            df = pd.read_csv(source, sep=sep, header=header-1, nrows=MAX_TABLE_ROWS + 1)
+            check_row_count(df)
+        meta = {"source":"csv", "mode":"wide"}
+    meta["header_row"] = (detected["row"] if detected else header_row) - 1
+    if detected:
+        meta["header_detected"] = detected
+    return df, meta
+
+def read_kv_from_raw(source, is_xlsx: bool, key_row: int = 1, val_row: int = 2) -> Tuple[Dict[str,str], Dict]:
+    source.seek(0)
     if is_xlsx:
-        df = pd.read_excel(io.BytesIO(file_bytes), sheet_name=0, header=None)
+        df = pd.read_excel(source, sheet_name=0, header=None, nrows=max(key_row, val_row))
     else:
-        df = pd.read_csv(io.BytesIO(file_bytes), header=None)
+        df = pd.read_csv(source, header=None, nrows=max(key_row, val_row))
     keys = [safe(x).replace("\ufeff","").replace("\xa0"," ") for x in df.iloc[key_row-1].tolist()]
     vals = [safe(x).replace("\ufeff","").replace("\xa0"," ") for x in df.iloc[val_row-1].tolist()]
     kv = {k: v for k, v in zip(keys, vals) if k}
     return kv, {"source":"xlsx" if is_xlsx else "csv", "mode":"kv", "key_row":key_row-1, "val_row":val_row-1}
 
 def extract_record_from_upload(file: UploadFile, header_row: int) -> Tuple[Dict[str,str], Dict, Optional[list]]:
-    data = file.file.read()
     name = (file.filename or "").lower()
 
     # считаем Excel-файлом и .xlsx, и .xlsm
@@ -848,6 +1703,7 @@ def extract_record_from_upload(file: UploadFile, header_row: int) -> Tuple[Dict[
     # если это не Excel и не CSV — ругаемся
     if not (is_excel or name.endswith(".csv")):
         raise HTTPException(400, "Поддерживаются только .xlsx, .xlsm или .csv")
+    data = upload_handle(file)
 
     # пробуем прочитать "широкую" таблицу (несколько строк студентов)
     df_wide, meta = read_wide_try(data, is_excel, header_row)
@@ -865,19 +1721,174 @@ def extract_record_from_upload(file: UploadFile, header_row: int) -> Tuple[Dict[
     return kv, meta_kv, None
 
 
-def extract_record_from_gsheet(url: str, header_row: int) -> Tuple[Dict[str,str], Dict, Optional[list]]:
+# ============= Google Sheets: общий HTTP-клиент с кэшем =============
+# Один пул соединений на процесс, короткий TTL-кэш по (spreadsheetId, gid, format),
+# ревалидация через ETag / Last-Modified и склейка одновременных одинаковых запросов:
+# /inspect и следующий за ним /generate качают таблицу один раз.
+GSHEET_EXPORT_BASE = os.getenv("GSHEET_EXPORT_BASE", "https://docs.google.com").rstrip("/")
+GSHEET_CACHE_TTL = float(os.getenv("GSHEET_CACHE_TTL", "60"))       # секунд без ревалидации
+GSHEET_CACHE_MAX = int(os.getenv("GSHEET_CACHE_MAX", "32"))          # записей в кэше
+GSHEET_TIMEOUT = float(os.getenv("GSHEET_TIMEOUT", "30"))
+
+_HTTP_SESSION: Optional[requests.Session] = None
+_HTTP_SESSION_LOCK = threading.Lock()
+
+def http_session() -> requests.Session:
+    """Общая requests.Session с пулом keep-alive соединений (потокобезопасно для GET)."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        with _HTTP_SESSION_LOCK:
+            if _HTTP_SESSION is None:
+                sess = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                sess.mount("https://", adapter)
+                sess.mount("http://", adapter)
+                _HTTP_SESSION = sess
+    return _HTTP_SESSION
+
+class _GSheetEntry:
+    __slots__ = ("content", "etag", "last_modified", "fetched_at")
+
+    def __init__(self, content: bytes, etag: Optional[str], last_modified: Optional[str]):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+
+class _Flight:
+    """Один «полёт» за данными: остальные потоки ждут его результата."""
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+# «gid» всей книги (xlsx-выгрузка без gid) — в ключе кэша, чтобы не совпасть с настоящим листом
+GSHEET_BOOK = -1
+
+_GSHEET_CACHE: Dict[Tuple[str, int, str], _GSheetEntry] = {}
+_GSHEET_INFLIGHT: Dict[Tuple[str, int, str], _Flight] = {}
+_GSHEET_LOCK = threading.Lock()
+
+def parse_gsheet_url(url: str) -> Tuple[str, Optional[int]]:
+    """Достаём (spreadsheetId, gid) из ссылки на Google Sheet; gid=None — в ссылке его нет."""
     m = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", url or "")
-    if not m: raise HTTPException(400, "Не удалось извлечь spreadsheetId из URL")
-    spreadsheet_id = m.group(1)
+    if not m:
+        raise HTTPException(400, "Не удалось извлечь spreadsheetId из URL")
     gid_match = re.search(r"[#&?]gid=([0-9]+)", url)
-    gid = int(gid_match.group(1)) if gid_match else 0
-    export = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export?format=csv&gid={gid}"
-    resp = requests.get(export, timeout=30)
-    if resp.status_code != 200:
-        raise HTTPException(400, f"Google Sheets недоступен (HTTP {resp.status_code})")
-    upl = UploadFile(filename="gs.csv", file=io.BytesIO(resp.content))
+    gid = int(gid_match.group(1)) if gid_match else None
+    return m.group(1), gid
+
+def _gsheet_download(key: Tuple[str, int, str], stale: Optional[_GSheetEntry]) -> _GSheetEntry:
+    spreadsheet_id, gid, fmt = key
+    with span("gsheet.fetch", **{"gsheet.gid": gid, "gsheet.format": fmt, "gsheet.revalidate": stale is not None}):
+        return _gsheet_get(spreadsheet_id, gid, fmt, stale)
+
+def _gsheet_get(spreadsheet_id: str, gid: int, fmt: str, stale: Optional[_GSheetEntry]) -> _GSheetEntry:
+    export = f"{GSHEET_EXPORT_BASE}/spreadsheets/d/{spreadsheet_id}/export?format={fmt}"
+    if gid != GSHEET_BOOK:
+        export += f"&gid={gid}"
+    headers = {}
+    if stale is not None:
+        if stale.etag:
+            headers["If-None-Match"] = stale.etag
+        if stale.last_modified:
+            headers["If-Modified-Since"] = stale.last_modified
+    try:
+        # читаем потоком, чтобы оборвать выгрузку больше MAX_UPLOAD_MB, не скачивая её целиком
+        with http_session().get(export, headers=headers, timeout=GSHEET_TIMEOUT, stream=True) as resp:
+            if resp.status_code == 304 and stale is not None:
+                # не изменилась — продлеваем старую запись
+                return _GSheetEntry(stale.content, stale.etag, stale.last_modified)
+            if resp.status_code != 200:
+                raise HTTPException(400, f"Google Sheets недоступен (HTTP {resp.status_code})")
+            check_upload_size(int(resp.headers.get("Content-Length") or 0))
+            chunks, size = [], 0
+            for chunk in resp.iter_content(256 * 1024):
+                size += len(chunk)
+                check_upload_size(size)
+                chunks.append(chunk)
+            return _GSheetEntry(b"".join(chunks), resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+    except requests.RequestException as e:
+        raise HTTPException(400, f"Google Sheets недоступен ({type(e).__name__})")
+
+def fetch_gsheet_export(spreadsheet_id: str, gid: int, fmt: str = "csv") -> bytes:
+    """
+    Скачивает экспорт листа (csv по умолчанию) через общий клиент.
+    Свежая запись отдаётся из кэша, устаревшая — ревалидируется условным запросом,
+    одновременные запросы одного и того же листа ждут один общий download.
+    """
+    key = (spreadsheet_id, gid, fmt)
+    with _GSHEET_LOCK:
+        entry = _GSHEET_CACHE.get(key)
+        if entry is not None and time.monotonic() - entry.fetched_at < GSHEET_CACHE_TTL:
+            return entry.content
+        flight = _GSHEET_INFLIGHT.get(key)
+        leader = flight is None
+        if leader:
+            flight = _GSHEET_INFLIGHT[key] = _Flight()
+
+    if not leader:
+        flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        fresh = _gsheet_download(key, entry)
+        with _GSHEET_LOCK:
+            _GSHEET_CACHE.pop(key, None)
+            _GSHEET_CACHE[key] = fresh
+            while len(_GSHEET_CACHE) > GSHEET_CACHE_MAX:
+                _GSHEET_CACHE.pop(next(iter(_GSHEET_CACHE)))
+        flight.result = fresh.content
+        return fresh.content
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _GSHEET_LOCK:
+            _GSHEET_INFLIGHT.pop(key, None)
+        flight.event.set()
+
+# csv — как раньше; xlsx — типизированный экспорт (даты и числа не превращаются в текст)
+GSHEET_EXPORT_FORMAT = os.getenv("GSHEET_EXPORT_FORMAT", "csv").strip().lower()
+
+def gsheet_export_format(fmt: Optional[str]) -> str:
+    fmt = (fmt or GSHEET_EXPORT_FORMAT or "csv").strip().lower()
+    if fmt not in ("csv", "xlsx"):
+        raise HTTPException(400, f"Неизвестный формат выгрузки Google Sheets: {fmt}")
+    return fmt
+
+def gsheet_book(url: str) -> UploadFile:
+    """Вся книга одним xlsx (листы в ней — по именам, gid в выгрузке нет)."""
+    spreadsheet_id, _ = parse_gsheet_url(url)
+    content = fetch_gsheet_export(spreadsheet_id, GSHEET_BOOK, "xlsx")
+    return UploadFile(filename="gs.xlsx", file=io.BytesIO(content))
+
+def gsheet_upload(url: str, fmt: Optional[str] = None, gid: Optional[int] = None) -> Tuple[UploadFile, Optional[int], str]:
+    """
+    Скачивает лист и заворачивает его в UploadFile, чтобы дальше шёл тот же загрузчик, что и для файлов.
+    xlsx-экспорт отдаёт ВСЮ книгу, а какой вкладке в ней соответствует gid, без Sheets API не узнать
+    (gid=0 — лист, созданный первым, а не первый по порядку). Поэтому лист, заданный gid, всегда
+    качается csv; xlsx — только для ссылки без gid (читается первая вкладка книги)
+    и для листов, выбранных по имени (load_record_sets).
+    """
+    spreadsheet_id, url_gid = parse_gsheet_url(url)
+    gid = url_gid if gid is None else gid
+    fmt = gsheet_export_format(fmt)
+    if gid is not None:
+        fmt = "csv"
+    if fmt == "xlsx":
+        return gsheet_book(url), None, fmt
+    content = fetch_gsheet_export(spreadsheet_id, gid or 0, fmt)
+    return UploadFile(filename=f"gs.{fmt}", file=io.BytesIO(content)), gid, fmt
+
+def extract_record_from_gsheet(url: str, header_row: int, fmt: Optional[str] = None) -> Tuple[Dict[str,str], Dict, Optional[list]]:
+    upl, gid, fmt = gsheet_upload(url, fmt)
     rec, meta, cols = extract_record_from_upload(upl, header_row)
-    meta.update({"source":"gsheet", "gid": gid})
+    meta.update({"source":"gsheet", "gid": gid, "export": fmt})
     return rec, meta, cols
 
 def pick_first_nonempty_row(df: pd.DataFrame) -> pd.Series:
@@ -887,6 +1898,7 @@ def pick_first_nonempty_row(df: pd.DataFrame) -> pd.Series:
             return row
     raise HTTPException(400, "Не найдена ни одна непустая строка с данными")
 
+@span("records_from_wide_df")
 def records_from_wide_df(df: pd.DataFrame) -> Tuple[List[Dict[str, str]], list]:
     """
     Превращаем «широкий» df (несколько строк студентов) в список словарей.
@@ -935,7 +1947,6 @@ def extract_records_from_upload_multi(
     """
     Версия extract_record_from_upload, но возвращает СПИСОК записей (по студентам).
     """
-    data = file.file.read()
     name = (file.filename or "").lower()
 
     # Excel-файлы: и .xlsx, и .xlsm
@@ -943,6 +1954,7 @@ def extract_records_from_upload_multi(
 
     if not (is_excel or name.endswith(".csv")):
         raise HTTPException(400, "Поддерживаются только .xlsx, .xlsm или .csv")
+    data = upload_handle(file)
 
     df_wide, meta = read_wide_try(data, is_excel, header_row)
     if not df_wide.empty:
@@ -956,31 +1968,62 @@ def extract_records_from_upload_multi(
     meta_kv.setdefault("score", 0)
     return [kv], meta_kv, None
 
+def _sheet_key(s: str):
+    # "0", "1" → номер листа; всё остальное — имя листа
+    return int(s) if s.isdigit() else s
+
+def extract_records_from_upload_sheets(
+    file: UploadFile,
+    header_row: int,
+    sheets: List[str],
+) -> List[Tuple[str, List[Dict[str, str]]]]:
+    """
+    Несколько листов одной книги: книга открывается один раз (pd.ExcelFile),
+    листы задаются именем или номером с нуля. Возвращает [(имя листа, записи), ...].
+    """
+    name = (file.filename or "").lower()
+    is_excel = name.endswith(".xlsx") or name.endswith(".xlsm")
+    if not is_excel:
+        raise HTTPException(400, "Несколько листов можно указать только для .xlsx / .xlsm")
+
+    out = []
+    with pd.ExcelFile(upload_handle(file)) as book:
+        for s in sheets:
+            key = _sheet_key(s)
+            if isinstance(key, int):
+                if key >= len(book.sheet_names):
+                    raise HTTPException(400, f"В книге нет листа №{key}")
+                key = book.sheet_names[key]
+            elif key not in book.sheet_names:
+                raise HTTPException(400, f"В книге нет листа «{key}»")
+            df, _ = read_excel_sheet(functools.partial(book.parse, key), header_row)
+            check_row_count(df)
+            df = normalize_typed_columns(df)
+            try:
+                records, _ = records_from_wide_df(df)
+            except HTTPException as e:
+                raise HTTPException(e.status_code, f"Лист «{key}»: {e.detail}")
+            out.append((key, records))
+    return out
+
 def extract_records_from_gsheet_multi(
     url: str,
     header_row: int,
+    fmt: Optional[str] = None,
+    gid: Optional[int] = None,
 ) -> Tuple[List[Dict[str, str]], Dict, Optional[list]]:
     """
     То же самое, что extract_record_from_gsheet, но возвращает список записей.
     """
-    m = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", url or "")
-    if not m:
-        raise HTTPException(400, "Не удалось извлечь spreadsheetId из URL")
-    spreadsheet_id = m.group(1)
-    gid_match = re.search(r"[#&?]gid=([0-9]+)", url)
-    gid = int(gid_match.group(1)) if gid_match else 0
-    export = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export?format=csv&gid={gid}"
-    resp = requests.get(export, timeout=30)
-    if resp.status_code != 200:
-        raise HTTPException(400, f"Google Sheets недоступен (HTTP {resp.status_code})")
-    upl = UploadFile(filename="gs.csv", file=io.BytesIO(resp.content))
+    upl, gid, fmt = gsheet_upload(url, fmt, gid)
     records, meta, cols = extract_records_from_upload_multi(upl, header_row)
-    meta.update({"source": "gsheet", "gid": gid})
+    meta.update({"source": "gsheet", "gid": gid, "export": fmt})
     return records, meta, cols
 
 # -------- шаблон Excel --------
 @app.get("/template")
 def download_template(
+    request: Request,
     kit: Optional[str] = Query(
         default=None,
         description="id комплекта (kit1, kit2, kit3, kit4)",
@@ -1003,11 +2046,11 @@ def download_template(
             detail=f"Файл шаблона для комплекта {kit} не найден по пути {path}",
         )
 
-    return FileResponse(
+    return file_asset(
+        f"template:{kit}",
         path,
-        filename=path.name,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ).response(request)
 
 # # -------- макрос Excel (xlsm) --------
 # @app.get("/macro")
@@ -1041,7 +2084,7 @@ def download_template(
 
 # -------- макрос для всех комплектов --------
 @app.get("/macro")
-def download_macro():
+def download_macro(request: Request):
     path = GLOBAL_MACRO
     if not path.is_file():
         raise HTTPException(
@@ -1049,16 +2092,16 @@ def download_macro():
             detail=f"Файл макроса не найден по пути {path}",
         )
 
-    return FileResponse(
-        path,
-        filename=path.name,
-        media_type="application/vnd.ms-excel.sheet.macroEnabled.12",
-    )
+    return file_asset("macro", path, "application/vnd.ms-excel.sheet.macroEnabled.12").response(request)
 
 
 # -------- инструкция DOCX --------
 def _build_instruction_docx_bytes() -> bytes:
     """Генерация дефолтной инструкции (если нет готового файла)."""
+    from docx import Document
+    from docx.shared import Pt
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+
     doc = Document()
     # стиль
     style = doc.styles["Normal"]
@@ -1125,48 +2168,140 @@ def _build_instruction_docx_bytes() -> bytes:
     return buf.getvalue()
 
 @app.get("/instruction")
-def download_instruction():
+def download_instruction(request: Request):
     """
     Отдаём инструкцию (DOCX). Если в корне лежит готовый файл (instruction.docx / инструкция.docx / …),
-    вернём его. Иначе — сгенерируем типовой DOCX на лету.
+    вернём его. Иначе — типовой DOCX, сгенерированный один раз на процесс.
     """
+    media_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
     for p in INSTRUCTION_CANDIDATES:
         if p.exists():
-            return FileResponse(
-                str(p),
-                media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                filename=INSTRUCTION_DOWNLOAD_NAME,
-                headers={"Cache-Control": "no-store, no-cache, must-revalidate"},
-            )
+            return file_asset("instruction", p, media_type, INSTRUCTION_DOWNLOAD_NAME).response(request)
     # fallback: сгенерируем docx
-    content = _build_instruction_docx_bytes()
-    return StreamingResponse(
-        io.BytesIO(content),
-        media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        headers={
-            "Content-Disposition": f'attachment; filename="{INSTRUCTION_DOWNLOAD_NAME}"',
-            "Cache-Control": "no-store, no-cache, must-revalidate",
-        },
+    return static_asset(
+        "instruction",
+        "generated",
+        lambda: StaticAsset(_build_instruction_docx_bytes(), media_type, INSTRUCTION_DOWNLOAD_NAME),
+    ).response(request)
+
+# ============= Статика: предсжатые ответы с ETag =============
+# Страница, каталог и файлы для скачивания собираются и сжимаются один раз на версию
+# (подпись файла / плана шаблонов); дальше ответ — готовые байты или 304 по If-None-Match.
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "60"))  # сек; после — браузер переспрашивает по ETag
+STATIC_CACHE_MAX = 256  # записей (каталог кэшируется по каждому prefix)
+_STATIC: Dict[str, Tuple[object, "StaticAsset"]] = {}
+_STATIC_LOCK = threading.Lock()
+
+def brotli_module():
+    # brotli необязателен: без него отдаём gzip
+    try:
+        return import_dependency("brotli")
+    except ImportError:
+        return None
+
+class StaticAsset:
+    """Готовый ответ: тело, его gzip/brotli-варианты и строгий ETag на каждый вариант."""
+
+    def __init__(self, body: bytes, media_type: str, filename: Optional[str] = None):
+        self.media_type = media_type
+        self.filename = filename
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants: Dict[str, Tuple[bytes, str]] = {"identity": (body, f'"{digest}"')}
+        # docx/xlsx/xlsm — уже ZIP, сжимать их ещё раз бессмысленно
+        if media_type.startswith(("text/", "application/json")) and len(body) > 1024:
+            self.variants["gzip"] = (gzip.compress(body, 9, mtime=0), f'"{digest}-gzip"')
+            br = brotli_module()
+            if br is not None:
+                self.variants["br"] = (br.compress(body, quality=11), f'"{digest}-br"')
+
+    def response(self, request: Request) -> Response:
+        encoding = "identity"
+        if len(self.variants) > 1:
+            accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+            encoding = next((e for e in ("br", "gzip") if e in accepted and e in self.variants), "identity")
+        body, etag = self.variants[encoding]
+
+        headers = {"ETag": etag, "Cache-Control": f"public, max-age={STATIC_MAX_AGE}, must-revalidate"}
+        if len(self.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if self.filename:
+            headers.update(attachment_headers(self.filename))
+        if etag_matches(request.headers.get("if-none-match", ""), etag):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type=self.media_type, headers=headers)
+
+def accepted_encodings(header: str) -> set:
+    """Кодировки из Accept-Encoding, кроме явно запрещённых (q=0)."""
+    accepted = set()
+    for item in header.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name.strip())
+    return accepted
+
+def etag_matches(header: str, etag: str) -> bool:
+    """
+    If-None-Match: список ETag через запятую или «*». Сравнение слабое (RFC 9110):
+    W/ не учитывается, так что W/"x" и "x" совпадают.
+    """
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    wanted = opaque(etag)
+    return any(tag == "*" or tag == wanted for tag in map(opaque, header.split(",")) if tag)
+
+def static_asset(key: str, version: object, build) -> StaticAsset:
+    """Ответ из кэша, если версия не поменялась; иначе build() → StaticAsset."""
+    cached = _STATIC.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    asset = build()
+    with _STATIC_LOCK:
+        _STATIC.pop(key, None)
+        if len(_STATIC) >= STATIC_CACHE_MAX:
+            _STATIC.pop(next(iter(_STATIC)))
+        _STATIC[key] = (version, asset)
+    return asset
+
+def file_asset(key: str, path: Path, media_type: str, filename: Optional[str] = None) -> StaticAsset:
+    return static_asset(
+        key,
+        (str(path), file_signature(path)),
+        lambda: StaticAsset(path.read_bytes(), media_type, filename or path.name),
     )
 
 # ============= HTTP API =============
 @app.get("/", response_class=HTMLResponse)
-def index():
-    return HTMLResponse(INDEX_HTML)
+def index(request: Request):
+    return static_asset(
+        "index", None, lambda: StaticAsset(INDEX_HTML.encode("utf-8"), "text/html; charset=utf-8")
+    ).response(request)
 
 @app.post("/inspect")
 def inspect(
     table_file: Optional[UploadFile] = File(default=None),
     gsheet_url: Optional[str] = Form(default=None),
-    header_row: int = Form(default=1),
+    header_row: int = Form(default=0),  # 0 — строка заголовков определяется автоматически
+    gsheet_format: Optional[str] = Form(default=None),
 ):
     # приоритет: если есть ссылка — используем её, иначе файл
-    if gsheet_url and gsheet_url.strip():
-        record, meta, cols = extract_record_from_gsheet(gsheet_url.strip(), header_row)
-    elif table_file and (table_file.filename or "").strip():
-        record, meta, cols = extract_record_from_upload(table_file, header_row)
-    else:
-        raise HTTPException(400, "Укажите Google Sheet ИЛИ выберите файл")
+    with memory_stage("ingest"):
+        if gsheet_url and gsheet_url.strip():
+            record, meta, cols = extract_record_from_gsheet(gsheet_url.strip(), header_row, gsheet_format)
+        elif table_file and (table_file.filename or "").strip():
+            record, meta, cols = extract_record_from_upload(table_file, header_row)
+        else:
+            raise HTTPException(400, "Укажите Google Sheet ИЛИ выберите файл")
 
     needed = ["ФИО", "Группа"]
     missing = [k for k in needed if k not in record]
@@ -1178,116 +2313,1712 @@ def inspect(
         preview_pairs = list(record.items())[:12]
         return JSONResponse({"columns": [], "preview_pairs": preview_pairs, "missing": missing, "meta": meta})
 
+# ============= Генерация документов =============
+GENERATE_WORKERS = int(os.getenv("GENERATE_WORKERS", "4"))
+
+def split_csv(value: Optional[str]) -> List[str]:
+    return [x.strip() for x in (value or "").split(",") if x.strip()]
+
+def templates_for_prefix(plan: TemplatePlan, prefix: str) -> List[dict]:
+    pfx = prefix.replace("\\", "/")
+    return [t for t in plan.templates if t["path"].replace("\\", "/").startswith(pfx)]
+
+def templates_for_ids(plan: TemplatePlan, ids) -> List[dict]:
+    # по индексу плана, в порядке конфига (как и раньше)
+    wanted = {s.lower() for s in ids if s.lower() in plan.by_id}
+    return [plan.by_id[i] for i in sorted(wanted, key=plan.order.__getitem__)]
+
+def kit_templates(plan: TemplatePlan, kit: str) -> List[dict]:
+    tpls = plan.kits.get(kit)
+    if tpls is None:
+        raise HTTPException(400, f"Неизвестный комплект: {kit}")
+    return tpls
+
+def template_groups(plan: TemplatePlan, kits: Optional[str], include: Optional[str]) -> List[Tuple[str, List[dict]]]:
+    """
+    Группы шаблонов для одного запроса: [(метка, шаблоны), ...].
+    kits="kit1,kit2" (или kit=) — по комплекту на группу; include — как раньше список id,
+    несколько групп разделяются «;». Без параметров — все шаблоны одной группой.
+    """
+    groups: List[Tuple[str, List[dict]]] = []
+    for kit in split_csv(kits):
+        groups.append((kit, kit_templates(plan, kit)))
+
+    include_groups = [g for g in (include or "").split(";") if g.strip()]
+    for n, group in enumerate(include_groups, start=1):
+        label = "include" if len(include_groups) == 1 else f"include_{n}"
+        groups.append((label, templates_for_ids(plan, split_csv(group))))
+
+    return groups or [("", plan.templates)]
+
+@memory_stage("ingest")
+@span("load_record_sets")
+def load_record_sets(
+    table_file: Optional[UploadFile],
+    gsheet_url: Optional[str],
+    header_row: int,
+    gsheet_format: Optional[str],
+    sheets: List[str],
+) -> List[Tuple[str, List[Dict[str, str]]]]:
+    """Читает таблицу один раз и возвращает [(лист, записи), ...] (без sheets — один лист)."""
+    if gsheet_url and gsheet_url.strip():
+        url = gsheet_url.strip()
+        if not sheets:
+            records, _, _ = extract_records_from_gsheet_multi(url, header_row, gsheet_format)
+            return [("", records)]
+        # для Google Sheets листы задаются их gid, а при выгрузке xlsx — ещё и именем вкладки
+        names = [s for s in sheets if not s.isdigit()]
+        if names and gsheet_export_format(gsheet_format) != "xlsx":
+            raise HTTPException(
+                400, f"Для Google Sheets листы задаются числовым gid (имена — только с форматом xlsx), получено: {names[0]}"
+            )
+        by_name = dict(extract_records_from_upload_sheets(gsheet_book(url), header_row, names)) if names else {}
+        out = []
+        for s in sheets:
+            if s in by_name:
+                records = by_name[s]
+            else:
+                records, _, _ = extract_records_from_gsheet_multi(url, header_row, gsheet_format, int(s))
+            out.append((s, records))
+        return out
+
+    if table_file and (table_file.filename or "").strip():
+        if sheets:
+            return extract_records_from_upload_sheets(table_file, header_row, sheets)
+        records, _, _ = extract_records_from_upload_multi(table_file, header_row)
+        return [("", records)]
+
+    raise HTTPException(400, "Укажите Google Sheet ИЛИ выберите файл")
+
+def build_context(tpl: dict, record: Dict[str, str]) -> Dict[str, str]:
+    # контекст: {tpl_key: значение из record по названию колонки}
+    ctx = {}
+    for tpl_key, excel_col in tpl["fields"].items():
+        raw_val = record.get(excel_col, "")
+
+        # сначала пробуем интерпретировать значение как дату
+        raw_val = normalize_date(raw_val)
+        # потом уже просто "подчищаем" строку
+        raw_val = safe(raw_val)
+
+        ctx[tpl_key] = raw_val
+    return ctx
+
+def student_folder(idx: int, record: Dict[str, str]) -> str:
+    # имя папки вида "001_Иванов Иван Иванович"
+    fio = safe(record.get("ФИО")) or f"record_{idx:03d}"
+    return slugify(f"{idx:03d}_{fio}")
+
+def document_relpath(tpl: dict, record: Dict[str, str]) -> str:
+    """Путь документа внутри папки студента: [dir/]имя.docx|pdf."""
+    # имя файла из шаблонной маски out
+    out_name = slugify(
+        tpl["out"].format_map(SafeMap(record)) or "doc_001.docx"
+    )
+
+    # формат выхода: docx или pdf
+    if template_output(tpl) == "pdf":
+        if out_name.lower().endswith(".docx"):
+            out_name = out_name[:-5] + ".pdf"
+        elif not out_name.lower().endswith(".pdf"):
+            out_name += ".pdf"
+    elif not out_name.lower().endswith(".docx"):
+        out_name += ".docx"
+
+    # dir → подпапка внутри папки студента
+    subdir_raw = (tpl.get("dir") or "").strip()
+    if subdir_raw:
+        subdir_filled = slugify_path(subdir_raw.format_map(SafeMap(record)))
+        if subdir_filled:
+            return "/".join([subdir_filled, out_name])
+    return out_name
+
+def template_output(tpl: dict) -> str:
+    return (tpl.get("output") or "docx").strip().lower()
+
+# фиксированная дата записей ZIP: одинаковый вход → побайтно одинаковый DOCX/архив
+ZIP_FIXED_DATE = (1980, 1, 1, 0, 0, 0)
+
+def fixed_zipinfo(name: str) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=ZIP_FIXED_DATE)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return info
+
+class _FixedDateZipWriter:
+    """Замена PhysPkgWriter из python-docx: те же части, но без текущего времени в заголовках ZIP."""
+
+    def __init__(self, fileobj):
+        self._zipf = zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def write(self, pack_uri, blob):
+        self._zipf.writestr(fixed_zipinfo(pack_uri.membername), blob)
+
+    def close(self):
+        self._zipf.close()
+
+def save_docx(doc: DocxTemplate) -> bytes:
+    """DocxTemplate.save в память, но детерминированно (см. ZIP_FIXED_DATE)."""
+    if doc.pics_to_replace or doc.crc_to_new_media or doc.crc_to_new_embedded or doc.zipname_to_replace:
+        # замены картинок/вложений делает сам docxtpl при сохранении
+        out_mem = io.BytesIO()
+        doc.save(out_mem)
+        return out_mem.getvalue()
+
+    from docx.opc.pkgwriter import PackageWriter
+
+    package = doc.docx.part.package
+    parts = list(package.parts)
+    for part in parts:
+        part.before_marshal()
+    out_mem = io.BytesIO()
+    writer = _FixedDateZipWriter(out_mem)
+    PackageWriter._write_content_types_stream(writer, parts)
+    PackageWriter._write_pkg_rels(writer, package.rels)
+    PackageWriter._write_parts(writer, parts)
+    writer.close()
+    doc.is_saved = True
+    return out_mem.getvalue()
+
+def template_bytes(tpl: dict) -> bytes:
+    """Байты .docx шаблона из плана (снимок на момент сборки плана; при DOCX_SLIM=1 — облегчённые)."""
+    blob = tpl.get("_blob")
+    if blob is None:
+        # файла не было при сборке плана — пусть ошибка будет как при открытии
+        return Path(tpl["path"]).read_bytes()
+    if DOCX_SLIM:
+        return slim_template(tpl, blob)
+    return blob
+
+def open_template(tpl: dict):
+    return docxtpl.DocxTemplate(io.BytesIO(template_bytes(tpl)))
+
+def render_docx_bytes(tpl: dict, ctx: Dict[str, str]) -> bytes:
+    with span("docx.render", template=tpl["id"]) as sp:
+        compiled = compiled_template(tpl)
+        if sp is not None:
+            sp.attrs["renderer"] = "fast" if compiled is not None else "docxtpl"
+        if compiled is not None:
+            return compiled.render(ctx)
+        return render_docx_reference(tpl, ctx)
+
+def elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def render_document(tpl: dict, record: Dict[str, str], timing: Optional[Dict[str, float]] = None) -> bytes:
+    """
+    Готовый документ (docx или pdf — по полю output шаблона).
+    timing — сюда пишутся render_ms / pdf_ms (заполняются и при ошибке).
+    """
+    timing = {} if timing is None else timing
+    started = time.perf_counter()
+    try:
+        docx_bytes = render_docx_bytes(tpl, build_context(tpl, record))
+    finally:
+        timing["render_ms"] = elapsed_ms(started)
+    if template_output(tpl) == "pdf":
+        started = time.perf_counter()
+        try:
+            return docx_bytes_to_pdf_bytes(docx_bytes)
+        finally:
+            timing["pdf_ms"] = elapsed_ms(started)
+    return docx_bytes
+
+def error_text(tpl: dict, e: BaseException) -> bytes:
+    return f"Ошибка ({tpl['path']}): {type(e).__name__}: {e}".encode("utf-8")
+
+def render_group(
+    records: List[Dict[str, str]],
+    templates: List[dict],
+    prefix: str = "",
+    memo: Optional[Dict[Tuple[int, str], Tuple[str, bytes, dict]]] = None,
+    start: int = 1,
+    report: Optional[List[dict]] = None,
+) -> List[Tuple[str, bytes]]:
+    """
+    Все документы группы: [(путь в архиве, bytes), ...] в порядке студент → шаблон.
+    start — номер первого студента (для части списка, см. vkr.py).
+    memo — общий на запрос кэш (id записи, render_key шаблона) → результат: шаблон,
+    попавший в несколько групп (или побайтно одинаковый шаблон с теми же настройками),
+    для одного студента рендерится один раз.
+    report — сюда на каждую запись архива добавляется строка для манифеста результата
+    (шаблон, студент, статус, время рендера и PDF), в том же порядке, что и записи.
+    """
+    entries: List[Tuple[str, bytes]] = []
+    for idx, folder, record, tpl in document_tasks(records, templates, prefix, start):
+        key = memo_key(record, tpl)
+        reused = memo is not None and key in memo
+        if reused:
+            kind, data, timing = memo[key]
+        else:
+            timing = {}
+            try:
+                kind, data = "ok", render_document(tpl, record, timing)
+            except Exception as e:
+                kind, data = "error", error_text(tpl, e)
+            if memo is not None:
+                memo[key] = (kind, data, timing)
+
+        entries.append((document_arcname(folder, tpl, record, kind), data))
+        if report is not None:
+            report.append(report_row(tpl, idx, kind, data, timing, reused))
+    return entries
+
+def document_tasks(records: List[Dict[str, str]], templates: List[dict], prefix: str = "", start: int = 1):
+    """(номер студента, папка, запись, шаблон) в порядке студент → шаблон — порядок записей архива."""
+    for idx, record in enumerate(records, start=start):
+        folder = student_folder(idx, record)
+        if prefix:
+            folder = f"{prefix}/{folder}"
+        for tpl in templates:
+            yield idx, folder, record, tpl
+
+def memo_key(record: Dict[str, str], tpl: dict) -> Tuple[int, str]:
+    return (id(record), render_key(tpl) + template_output(tpl))
+
+def document_arcname(folder: str, tpl: dict, record: Dict[str, str], kind: str) -> str:
+    if kind == "ok":
+        return f"{folder}/{document_relpath(tpl, record)}"
+    return f"{folder}/{slugify(tpl.get('out', 'file'))}.ERROR.txt"
+
+def report_row(tpl: dict, idx: int, kind: str, data: bytes, timing: dict, reused: bool) -> dict:
+    # повторно использованный документ времени в этом месте не стоил
+    return {
+        "template": tpl["id"],
+        "student": idx,
+        "status": kind,
+        "error": data.decode("utf-8") if kind == "error" else None,
+        "render_ms": 0.0 if reused else timing.get("render_ms", 0.0),
+        "pdf_ms": 0.0 if reused else timing.get("pdf_ms", 0.0),
+        "reused": reused,
+    }
+
+# -------- конвейер режима folders: рендер → PDF → запись, этапы перекрываются --------
+# Рендер идёт в своём пуле потоков, конвертация в PDF — в своём (soffice — отдельный процесс,
+# пока он работает, рендерятся следующие документы), запись в ZIP — в потоке запроса в исходном
+# порядке. Впереди записи — не больше PIPELINE_DEPTH документов: если запись (или PDF) отстаёт,
+# новые рендеры не запускаются, и в памяти не копится весь результат.
+PIPELINE_RENDER_WORKERS = int(os.getenv("PIPELINE_RENDER_WORKERS", str(GENERATE_WORKERS)))
+PIPELINE_PDF_WORKERS = int(os.getenv("PIPELINE_PDF_WORKERS", "2"))
+PIPELINE_DEPTH = int(os.getenv("PIPELINE_DEPTH", "32"))
+
+def pipeline_documents(
+    jobs: List[Tuple[List[Dict[str, str]], List[dict], str]],
+    write,
+) -> None:
+    """
+    Все документы заданий «лист × группа» конвейером; write(путь, bytes, строка манифеста)
+    вызывается в порядке render_group. Как memo в render_group, один студент не рендерится
+    дважды по одному шаблону: ни по шаблону, попавшему в несколько групп, ни по побайтно
+    одинаковым шаблонам с теми же полями (render_key). Готовый документ держится в memo только
+    до последнего совпадающего задания, так что память по-прежнему ограничена PIPELINE_DEPTH
+    и повторами. Трасса — как у render_group: спан render_group на задание, zip.write на запись.
+    """
+    def convert(tpl, docx_bytes, timing):
+        started = time.perf_counter()
+        try:
+            return "ok", docx_bytes_to_pdf_bytes(docx_bytes), timing
+        except Exception as e:
+            return "error", error_text(tpl, e), timing
+        finally:
+            timing["pdf_ms"] = elapsed_ms(started)
+
+    def render(tpl, record):
+        timing: Dict[str, float] = {}
+        started = time.perf_counter()
+        try:
+            docx_bytes = render_docx_bytes(tpl, build_context(tpl, record))
+        except Exception as e:
+            return "error", error_text(tpl, e), timing
+        finally:
+            timing["render_ms"] = elapsed_ms(started)
+        if template_output(tpl) == "pdf":
+            # поток рендера не ждёт soffice: результатом будет future этапа PDF
+            return pdf_pool.submit(traced(convert), tpl, docx_bytes, timing)
+        return "ok", docx_bytes, timing
+
+    def store(arcname, data, row):
+        with span("zip.write", path=arcname, bytes=len(data)):
+            write(arcname, data, row)
+
+    tasks = [
+        (job, task, memo_key(task[2], task[3]))
+        for job, (records, templates, prefix) in enumerate(jobs)
+        for task in document_tasks(records, templates, prefix)
+    ]
+    uses = Counter(key for _, _, key in tasks)
+    memo: Dict[Tuple[int, str], Future] = {}
+    spans: List[Optional[Span]] = [None] * len(jobs)
+    inflight: deque = deque()
+
+    def drain() -> None:
+        job, (idx, folder, record, tpl), fut, reused, last = inflight.popleft()
+        result = fut.result()
+        if isinstance(result, Future):
+            result = result.result()
+        kind, data, timing = result
+        row = report_row(tpl, idx, kind, data, timing, reused)
+        traced(store, spans[job])(document_arcname(folder, tpl, record, kind), data, row)
+        if last and spans[job] is not None:
+            spans[job].finish()
+
+    with ThreadPoolExecutor(max_workers=max(1, PIPELINE_RENDER_WORKERS), thread_name_prefix="render") as render_pool, \
+            ThreadPoolExecutor(max_workers=max(1, PIPELINE_PDF_WORKERS), thread_name_prefix="pdf") as pdf_pool:
+        for n, (job, task, key) in enumerate(tasks):
+            if spans[job] is None:
+                records, templates, prefix = jobs[job]
+                spans[job] = start_span("render_group", prefix=prefix, students=len(records), templates=len(templates))
+            fut = memo.get(key)
+            reused = fut is not None
+            if fut is None:
+                fut = render_pool.submit(traced(render, spans[job]), task[3], task[2])
+            # документ нужен ещё какому-то заданию — держим, иначе отпускаем
+            uses[key] -= 1
+            if uses[key]:
+                memo[key] = fut
+            else:
+                memo.pop(key, None)
+            last = n + 1 == len(tasks) or tasks[n + 1][0] != job
+            inflight.append((job, task, fut, reused, last))
+            if len(inflight) >= max(1, PIPELINE_DEPTH):
+                drain()
+        while inflight:
+            drain()
+
+# -------- режим «слияния»: один документ на шаблон для всех студентов --------
+def compile_xml_part(doc: DocxTemplate, src_xml: str, part):
+    """
+    То же, что DocxTemplate.render_xml_part, но Jinja-шаблон компилируется один раз:
+    возвращает функцию ctx → готовый XML части.
+    """
+    template = compile_jinja(re.sub(r"<w:p([ >])", r"\n<w:p\1", src_xml))
+
+    def render(ctx: Dict[str, str]) -> str:
+        doc.current_rendering_part = part
+        dst_xml = re.sub(r"\n<w:p([ >])", r"<w:p\1", template.render(ctx))
+        dst_xml = (
+            dst_xml.replace("{_{", "{{")
+            .replace("}_}", "}}")
+            .replace("{_%", "{%")
+            .replace("%_}", "%}")
+        )
+        return doc.resolve_listing(dst_xml)
+
+    return render
+
+def render_merged_docx(tpl: dict, records: List[Dict[str, str]]) -> bytes:
+    """
+    Один DOCX на шаблон: тело шаблона рендерится для каждой записи и дописывается
+    новым разделом (разрыв страницы между студентами). Шаблон разбирается и чистится
+    (patch_xml) и компилируется один раз; колонтитулы и свойства берутся по первой записи.
+    """
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    doc = open_template(tpl)
+    doc.render_init()
+    render_body = compile_xml_part(doc, doc.patch_xml(doc.get_xml()), doc.docx._part)
+
+    body = None
+    for record in records:
+        ctx = build_context(tpl, record)
+        tree = doc.fix_tables(render_body(ctx))
+        doc.fix_docpr_ids(tree)
+
+        if body is None:
+            doc.map_tree(tree)
+            body = tree
+            for uri in (doc.HEADER_URI, doc.FOOTER_URI):
+                for rel_key, xml in doc.build_headers_footers_xml(ctx, uri, jinja_env()):
+                    doc.map_headers_footers_xml(rel_key, xml)
+            doc.render_properties(ctx, jinja_env())
+            doc.render_footnotes(ctx, jinja_env())
+            continue
+
+        # закрываем предыдущий раздел: копия sectPr в последнем абзаце = разрыв раздела с новой страницы
+        sect_pr = body.find(qn("w:sectPr"))
+        closing = copy.deepcopy(sect_pr)
+        for t in closing.findall(qn("w:type")):
+            closing.remove(t)
+        p = OxmlElement("w:p")
+        p_pr = OxmlElement("w:pPr")
+        p_pr.append(closing)
+        p.append(p_pr)
+        sect_pr.addprevious(p)
+
+        for child in list(tree):
+            if child.tag != qn("w:sectPr"):
+                sect_pr.addprevious(child)
+
+    doc.is_rendered = True
+    return save_docx(doc)
+
+def merged_name(tpl: dict) -> str:
+    """Имя сводного файла: [dir/]<имя шаблона> без расширения."""
+    stem = slugify(Path(tpl["path"].replace("\\", "/")).stem)
+    subdir = slugify_path(tpl.get("dir") or "")
+    return f"{subdir}/{stem}" if subdir else stem
+
+def render_group_merged(
+    records: List[Dict[str, str]],
+    templates: List[dict],
+    prefix: str = "",
+    merge_pdf: bool = False,
+    report: Optional[List[dict]] = None,
+) -> List[Tuple[str, bytes]]:
+    """
+    Режим слияния: на каждый шаблон — один DOCX со всеми студентами и/или один PDF
+    (одна конвертация LibreOffice на шаблон вместо одной на каждого студента).
+    report — как у render_group; время рендера относится к первой записи шаблона, PDF — к PDF.
+    """
+    def one(tpl, timing):
+        started = time.perf_counter()
+        with span("docx.render", template=tpl["id"], renderer="merge", records=len(records)):
+            docx_bytes = render_merged_docx(tpl, records)
+        timing["render_ms"] = elapsed_ms(started)
+        out = []
+        if template_output(tpl) != "pdf":
+            out.append(("docx", docx_bytes))
+        if template_output(tpl) == "pdf" or merge_pdf:
+            started = time.perf_counter()
+            try:
+                out.append(("pdf", docx_bytes_to_pdf_bytes(docx_bytes)))
+            finally:
+                timing["pdf_ms"] = elapsed_ms(started)
+        return out
+
+    entries: List[Tuple[str, bytes]] = []
+    used: Dict[str, int] = {}
+    root = f"{prefix}/" if prefix else ""
+    workers = max(1, min(GENERATE_WORKERS, len(templates)))
+    timings = [{} for _ in templates]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = [ex.submit(traced(one), tpl, timing) for tpl, timing in zip(templates, timings)]
+        for tpl, fut, timing in zip(templates, futures, timings):
+            # два шаблона с одинаковым именем (например, дневник в разных папках) не должны затирать друг друга
+            name = merged_name(tpl)
+            used[name] = used.get(name, 0) + 1
+            if used[name] > 1:
+                name = f"{name}_{used[name]}"
+            try:
+                out = [(f"{root}{name}.{ext}", data, "ok", None, ext) for ext, data in fut.result()]
+            except Exception as e:
+                err = error_text(tpl, e)
+                out = [(f"{root}{name}.ERROR.txt", err, "error", err.decode("utf-8"), "")]
+            for n, (arcname, data, kind, error, ext) in enumerate(out):
+                entries.append((arcname, data))
+                if report is not None:
+                    report.append({
+                        "template": tpl["id"],
+                        "student": None,
+                        "status": kind,
+                        "error": error,
+                        "render_ms": timing.get("render_ms", 0.0) if n == 0 else 0.0,
+                        "pdf_ms": timing.get("pdf_ms", 0.0) if ext != "docx" else 0.0,
+                        "reused": False,
+                    })
+    return entries
+
+# -------- быстрый рендер: разбор и компиляция шаблона один раз --------
+# docxtpl на каждый документ заново открывает пакет, сериализует тело, чистит XML
+# (patch_xml) и компилирует Jinja. Здесь всё это делается один раз на файл шаблона (по sha256):
+# на рендер остаётся только вычислить скомпилированные части и собрать ZIP из готовых байтов.
+RENDERER = os.getenv("RENDERER", "fast").strip().lower()  # fast | docxtpl
+FAST_RENDER_FALLBACK: Dict[str, str] = {}  # sha256 → почему шаблон рендерится через docxtpl
+_COMPILED: Dict[str, "CompiledDocx"] = {}
+_COMPILED_LOCK = threading.Lock()
+
+# те же строковые свойства, что подставляет DocxTemplate.render_properties
+CORE_PROPERTIES = ("author", "comments", "identifier", "language", "subject", "title")
+
+class CompiledDocx:
+    """
+    Шаблон, подготовленный к многократному рендеру. Повторяет DocxTemplate.render + save_docx:
+    тело (patch_xml → Jinja → fix_tables → fix_docpr_ids), колонтитулы, свойства документа и
+    сноски; остальные части пакета пишутся заранее сериализованными байтами.
+    """
+
+    def __init__(self, blob: bytes):
+        from docx.opc.constants import RELATIONSHIP_TYPE as RT
+        from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+        from docx.opc.pkgwriter import _ContentTypesItem
+        from docx.oxml.ns import qn
+
+        doc = docxtpl.DocxTemplate(io.BytesIO(blob))
+        doc.render_init()
+        self.doc = doc
+        package = doc.docx.part.package
+        if not any(rel.reltype == RT.CORE_PROPERTIES for rel in package.rels.values()):
+            # python-docx создал бы core.xml с текущим временем — такой шаблон оставляем docxtpl
+            raise ValueError("в шаблоне нет docProps/core.xml")
+
+        # тело: компилируем один раз, на рендер подменяем пустой w:body в копии корня
+        root = doc.docx._element
+        self.render_body = compile_xml_part(doc, doc.patch_xml(doc.get_xml()), doc.docx._part)
+        self.shell = copy.deepcopy(root)
+        old_body = self.shell.find(qn("w:body"))
+        self.shell.replace(old_body, self.shell.makeelement(old_body.tag, nsmap=old_body.nsmap))
+
+        rendered_parts: Dict[int, tuple] = {}
+        for uri in (doc.HEADER_URI, doc.FOOTER_URI):
+            for _, part in doc.get_headers_footers(uri):
+                xml = doc.get_part_xml(part)
+                encoding = doc.get_headers_footers_encoding(xml)
+                rendered_parts[id(part)] = ("header", compile_xml_part(doc, doc.patch_xml(xml), part), encoding)
+
+        core_part = package._core_properties_part
+        self.core_element = core_part.element
+        initial = {prop: getattr(doc.docx.core_properties, prop) for prop in CORE_PROPERTIES}
+        self.core_templates = {prop: jinja_env().from_string(value) for prop, value in initial.items()}
+        # без Jinja-разметки свойства не зависят от записи — core.xml один на все документы
+        self.core_blob = None
+        if not any("{" in value for value in initial.values()):
+            self.core_blob = self.render_core({})
+        rendered_parts[id(core_part)] = ("core",)
+
+        self.footnotes = []
+        for part in package.parts:
+            if part.content_type == FOOTNOTES_CONTENT_TYPE:
+                src = part.blob.decode("utf-8") if isinstance(part.blob, bytes) else part.blob
+                rendered_parts[id(part)] = ("footnotes", compile_xml_part(doc, doc.patch_xml(src), part), part)
+
+        # порядок и содержимое членов ZIP — как у PackageWriter (обход связей в глубину);
+        # неизменные части сжимаются здесь один раз и дальше копируются в архив как есть
+        parts = list(package.parts)
+        self.members: List[tuple] = [
+            (CONTENT_TYPES_URI.membername, deflate_member(_ContentTypesItem.from_parts(parts).blob)),
+            (PACKAGE_URI.rels_uri.membername, deflate_member(package.rels.xml)),
+        ]
+        for part in parts:
+            if part is doc.docx.part:
+                data = ("body",)
+            elif id(part) in rendered_parts:
+                data = rendered_parts[id(part)]
+            else:
+                data = deflate_member(part.blob)
+            if data == ("core",) and self.core_blob is not None:
+                data = deflate_member(self.core_blob)
+            self.members.append((part.partname.membername, data))
+            if len(part.rels):
+                self.members.append((part.partname.rels_uri.membername, deflate_member(part.rels.xml)))
+
+    def render_core(self, ctx: Dict[str, str]) -> bytes:
+        from docx.opc.coreprops import CoreProperties
+        from docx.opc.oxml import serialize_part_xml
+
+        props = CoreProperties(copy.deepcopy(self.core_element))
+        for prop, template in self.core_templates.items():
+            setattr(props, prop, template.render(ctx))
+        return serialize_part_xml(props._element)
+
+    def render(self, ctx: Dict[str, str]) -> bytes:
+        from docx.opc.oxml import serialize_part_xml
+        from docx.oxml.parser import parse_xml
+
+        doc = self.doc
+        tree = doc.fix_tables(self.render_body(ctx))
+        # fix_docpr_ids: сквозная нумерация картинок с 1001, как после render_init
+        for n, elt in enumerate(tree.xpath("//wp:docPr", namespaces=DOCX_NSMAP), start=1001):
+            elt.attrib["id"] = str(n)
+        root = copy.deepcopy(self.shell)
+        root.replace(root.find(tree.tag), tree)
+        sections = len(tree.xpath("./w:p/w:pPr/w:sectPr | ./w:sectPr", namespaces=DOCX_NSMAP))
+
+        writer = RawZipWriter()
+        for name, data in self.members:
+            kind = data[0]
+            if isinstance(data, RawMember):
+                writer.write_raw(name, data)
+                continue
+            if kind == "body":
+                blob = serialize_part_xml(root)
+            elif kind == "header":
+                blob = serialize_part_xml(parse_xml(data[1](ctx).encode(data[2])))
+            elif kind == "core":
+                blob = self.render_core(ctx)
+            else:
+                # docxtpl рендерит сноски заново для каждого раздела документа
+                xml = data[1](ctx)
+                for _ in range(sections - 1):
+                    xml = doc.render_xml_part(doc.patch_xml(xml), data[2], ctx, jinja_env())
+                blob = xml.encode("utf-8")
+            writer.write(name, blob)
+        return b"".join(writer.close())
+
+class RawMember(NamedTuple):
+    """Член ZIP, уже сжатый deflate."""
+    crc: int
+    size: int
+    raw: bytes
+
+def deflate_member(data: bytes) -> RawMember:
+    # те же параметры, что у zipfile для ZIP_DEFLATED, — сжатые байты совпадают
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return RawMember(zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush())
+
+class RawZipWriter:
+    """
+    Запись ZIP только дописыванием, побайтно как zipfile с fixed_zipinfo, но заранее сжатые
+    члены (RawMember) копируются без распаковки и повторного сжатия. Без fileobj результат —
+    список кусков (заголовки и данные), склеиваемых один раз; с fileobj куски сразу пишутся
+    в поток (склейка частичных архивов vkr.py, там же нужен ZIP64 для архивов > 2 ГБ).
+    """
+
+    def __init__(self, fileobj=None):
+        self.fileobj = fileobj
+        self.chunks: List[bytes] = []
+        self.offset = 0
+        self.entries: List[zipfile.ZipInfo] = []
+
+    def _emit(self, *chunks: bytes) -> None:
+        for chunk in chunks:
+            if self.fileobj is not None:
+                self.fileobj.write(chunk)
+            else:
+                self.chunks.append(chunk)
+            self.offset += len(chunk)
+
+    def write(self, name: str, data: bytes) -> None:
+        self.write_raw(name, deflate_member(data))
+
+    def write_raw(self, name: str, member: RawMember) -> None:
+        crc, size, raw = member
+        zinfo = fixed_zipinfo(name)
+        zinfo.CRC, zinfo.file_size, zinfo.compress_size = crc, size, len(raw)
+        zinfo.header_offset = self.offset
+        self.entries.append(zinfo)
+        self._emit(zinfo.FileHeader(False), raw)
+
+    def close(self) -> List[bytes]:
+        dt = ZIP_FIXED_DATE
+        dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+        dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+        start = self.offset
+        for zinfo in self.entries:
+            filename, flag_bits = zinfo._encodeFilenameFlags()
+            extra, header_offset, version = b"", zinfo.header_offset, zinfo.create_version
+            if header_offset > zipfile.ZIP64_LIMIT:
+                # как zipfile: смещение — в поле ZIP64 extra
+                extra = struct.pack("<HHQ", 1, 8, header_offset)
+                header_offset, version = 0xFFFFFFFF, max(version, zipfile.ZIP64_VERSION)
+            self._emit(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir,
+                version, zinfo.create_system, max(version, zinfo.extract_version), zinfo.reserved,
+                flag_bits, zinfo.compress_type, dostime, dosdate,
+                zinfo.CRC, zinfo.compress_size, zinfo.file_size,
+                len(filename), len(extra), 0, 0, zinfo.internal_attr, zinfo.external_attr,
+                header_offset,
+            ), filename, extra)
+
+        count, size, end = len(self.entries), self.offset - start, self.offset
+        if count > zipfile.ZIP_FILECOUNT_LIMIT or start > zipfile.ZIP64_LIMIT or size > zipfile.ZIP64_LIMIT:
+            self._emit(
+                struct.pack(zipfile.structEndArchive64, zipfile.stringEndArchive64,
+                            44, 45, 45, 0, 0, count, count, size, start),
+                struct.pack(zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator, 0, end, 1),
+            )
+            count, size, start = min(count, 0xFFFF), min(size, 0xFFFFFFFF), min(start, 0xFFFFFFFF)
+        self._emit(struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive,
+            0, 0, count, count, size, start, 0,
+        ))
+        return self.chunks
+
+def zip_raw_members(path: Path, names: Optional[List[str]] = None):
+    """(имя, RawMember) записей архива (все или names по порядку): сжатые байты читаются как есть."""
+    with zipfile.ZipFile(path) as zf, path.open("rb") as fp:
+        for info in (zf.infolist() if names is None else [zf.getinfo(n) for n in names]):
+            if info.compress_type != zipfile.ZIP_DEFLATED:
+                yield info.filename, deflate_member(zf.read(info))
+                continue
+            fp.seek(info.header_offset)
+            header = fp.read(zipfile.sizeFileHeader)
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            fp.seek(info.header_offset + zipfile.sizeFileHeader + name_len + extra_len)
+            yield info.filename, RawMember(info.CRC, info.file_size, fp.read(info.compress_size))
+
+FOOTNOTES_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml"
+DOCX_NSMAP = {
+    "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
+    "wp": "http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing",
+}
+
+def render_docx_reference(tpl: dict, ctx: Dict[str, str]) -> bytes:
+    """Эталонный рендер через DocxTemplate.render (им же проверяется быстрый путь)."""
+    doc = open_template(tpl)
+    doc.render(ctx, jinja_env=jinja_env())
+
+    # рендерим DOCX в память
+    return save_docx(doc)
+
+def compiled_template(tpl: dict) -> Optional[CompiledDocx]:
+    """
+    Скомпилированный шаблон или None (быстрый путь выключен / шаблон ему не подходит).
+    При первой компиляции результат сверяется побайтно с docxtpl на тестовой записи
+    (в каждом поле — его имя); при расхождении шаблон навсегда остаётся на docxtpl.
+    """
+    sha = tpl.get("_sha")
+    if RENDERER != "fast" or not sha or sha in FAST_RENDER_FALLBACK:
+        return None
+    compiled = _COMPILED.get(sha)
+    if compiled is not None:
+        return compiled
+
+    try:
+        compiled = CompiledDocx(template_bytes(tpl))
+        ctx = build_context(tpl, {col: f"«{key}»" for key, col in tpl["fields"].items()})
+        if compiled.render(ctx) != render_docx_reference(tpl, ctx):
+            raise ValueError("результат отличается от docxtpl")
+    except Exception as e:
+        FAST_RENDER_FALLBACK[sha] = f"{type(e).__name__}: {e}"
+        log.warning("Быстрый рендер выключен для %s: %s", tpl["path"], FAST_RENDER_FALLBACK[sha])
+        return None
+
+    with _COMPILED_LOCK:
+        # шаблоны, ушедшие из плана после перезагрузки, больше не держим в памяти
+        live = {t.get("_sha") for t in current_plan().templates}
+        for old in [k for k in _COMPILED if k not in live]:
+            del _COMPILED[old]
+        compiled = _COMPILED.setdefault(sha, compiled)
+    return compiled
+
+# -------- облегчение DOCX: лишнее вычищается из шаблона один раз (DOCX_SLIM=1) --------
+# Word тащит в каждый файл rsid-атрибуты правок, маркеры проверки орфографии, сотни
+# неиспользуемых стилей, определения списков и шрифтов. Всё это попадает в каждый
+# сгенерированный документ. Чистится копия шаблона (по sha256), и её уже рендерят и быстрый
+# путь, и docxtpl, и слияние, так что сверка быстрого рендера с эталоном не меняется.
+DOCX_SLIM = os.getenv("DOCX_SLIM", "0") == "1"
+DOCX_SLIM_STATS: Dict[str, dict] = {}  # sha256 → что вычищено и сколько байт сэкономлено
+_SLIM_BLOBS: Dict[str, bytes] = {}
+_SLIM_LOCK = threading.Lock()
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+R_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+A_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+PKG_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+CT_NS = "{http://schemas.openxmlformats.org/package/2006/content-types}"
+
+# части, где стоят ссылки на стили, списки и шрифты (тело, колонтитулы, сноски, примечания)
+SLIM_CONTENT_TYPES = ("main+xml", ".header+xml", ".footer+xml", ".footnotes+xml", ".endnotes+xml", ".comments+xml")
+STYLE_REFS = {"pStyle", "rStyle", "tblStyle", "numStyleLink", "styleLink", "clickAndTypeStyle", "defaultTableStyle"}
+STYLE_CHAIN = STYLE_REFS | {"basedOn", "next", "link"}
+FONT_ATTRS = tuple(W_NS + a for a in ("ascii", "hAnsi", "cs", "eastAsia"))
+FONT_EMBEDS = {W_NS + t for t in ("embedRegular", "embedBold", "embedItalic", "embedBoldItalic")}
+
+def _localname(el) -> str:
+    tag = el.tag
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+def _drop(el) -> None:
+    """Удаляет элемент, не теряя текст после него."""
+    parent = el.getparent()
+    if el.tail:
+        prev = el.getprevious()
+        if prev is not None:
+            prev.tail = (prev.tail or "") + el.tail
+        else:
+            parent.text = (parent.text or "") + el.tail
+    parent.remove(el)
+
+def _vals(roots, names) -> set:
+    return {
+        el.get(W_NS + "val")
+        for root in roots
+        for el in root.iter()
+        if _localname(el) in names and el.get(W_NS + "val") is not None
+    }
+
+def _dynamic(values) -> bool:
+    """Значение подставляется Jinja — что будет использовано, заранее не известно."""
+    return any("{" in v or "%" in v for v in values)
+
+def _rels_name(part: str) -> str:
+    folder, _, base = part.rpartition("/")
+    return f"{folder}/_rels/{base}.rels" if folder else f"_rels/{base}.rels"
+
+def _resolve(part: str, target: str) -> str:
+    if target.startswith("/"):
+        return target.lstrip("/")
+    folder = part.rpartition("/")[0].split("/") if "/" in part else []
+    for piece in target.split("/"):
+        if piece == "..":
+            folder = folder[:-1]
+        elif piece not in ("", "."):
+            folder.append(piece)
+    return "/".join(folder)
+
+def slim_docx(blob: bytes) -> Tuple[bytes, dict]:
+    """
+    Облегчённая копия .docx: без rsid-атрибутов, proofErr/proofState, неиспользуемых стилей,
+    определений списков и шрифтов (вместе со встроенными файлами шрифтов).
+    Если ссылки на стили/списки/шрифты формирует сам шаблон (Jinja), соответствующая
+    чистка пропускается. Возвращает (байты, статистика).
+    """
+    from lxml import etree
+
+    with zipfile.ZipFile(io.BytesIO(blob)) as zin:
+        order = [i.filename for i in zin.infolist()]
+        raw = {name: zin.read(name) for name in order}
+
+    overrides = etree.fromstring(raw["[Content_Types].xml"])
+    types = {o.get("PartName", "").lstrip("/"): o.get("ContentType", "") for o in overrides.iter(CT_NS + "Override")}
+    # глоссарий (стандартные блоки) живёт со своими стилями и списками — его не трогаем
+    parts = {n: t for n, t in types.items() if n in raw and not n.startswith("word/glossary/")}
+
+    trees: dict = {}
+    changed = set()  # части, которые надо сериализовать заново
+
+    def tree(name):
+        if name not in trees:
+            trees[name] = etree.fromstring(raw[name])
+        return trees[name]
+
+    def drop(name, el):
+        _drop(el)
+        changed.add(name)
+
+    def group(suffixes):
+        return [(n, tree(n)) for n, t in parts.items() if t.endswith(suffixes)]
+
+    stats = {"rsid_attrs": 0, "proof_marks": 0, "styles_removed": 0, "numbering_removed": 0, "fonts_removed": 0}
+    content = group(SLIM_CONTENT_TYPES)
+    styles = group(".styles+xml")
+    numbering = group(".numbering+xml")
+    settings = group(".settings+xml")
+
+    def roots(*groups):
+        return [root for g in groups for _, root in g]
+
+    # 1) rsid-атрибуты (история правок) и маркеры проверки правописания
+    for name, root in content + styles + numbering + settings:
+        for el in root.iter():
+            rsids = [k for k in el.attrib if k.startswith(W_NS + "rsid")]
+            for k in rsids:
+                del el.attrib[k]
+            if rsids:
+                stats["rsid_attrs"] += len(rsids)
+                changed.add(name)
+    for name, root in content:
+        for el in list(root.iter(W_NS + "proofErr")):
+            drop(name, el)
+            stats["proof_marks"] += 1
+    for name, root in settings:
+        for el in list(root.iter(W_NS + "proofState", W_NS + "rsids")):
+            drop(name, el)
+            stats["proof_marks"] += 1
+
+    # 2) стили: используемые в тексте/списках/настройках + цепочки basedOn/next/link + стили по умолчанию
+    used = _vals(roots(content, numbering, settings), STYLE_REFS)
+    if not _dynamic(used):
+        for name, root in styles:
+            by_id = {s.get(W_NS + "styleId"): s for s in root.iter(W_NS + "style")}
+            keep = {sid for sid, s in by_id.items() if s.get(W_NS + "default") in ("1", "true", "on")}
+            todo = list(used | keep)
+            while todo:
+                sid = todo.pop()
+                keep.add(sid)
+                if sid in by_id:
+                    todo.extend(v for v in _vals([by_id[sid]], STYLE_CHAIN) if v not in keep)
+            for sid, s in by_id.items():
+                if sid not in keep:
+                    drop(name, s)
+                    stats["styles_removed"] += 1
+
+    # 3) списки: w:num, на которые есть numId, и их abstractNum (связанные со стилями — всегда)
+    num_ids = _vals(roots(content, styles), {"numId"})
+    if not _dynamic(num_ids):
+        for name, root in numbering:
+            abstract_ids = set()
+            for num in root.findall(W_NS + "num"):
+                if num.get(W_NS + "numId") in num_ids:
+                    abstract_ids |= _vals([num], {"abstractNumId"})
+                else:
+                    drop(name, num)
+                    stats["numbering_removed"] += 1
+            for an in root.findall(W_NS + "abstractNum"):
+                linked = an.find(W_NS + "styleLink") is not None or an.find(W_NS + "numStyleLink") is not None
+                if an.get(W_NS + "abstractNumId") not in abstract_ids and not linked:
+                    drop(name, an)
+                    stats["numbering_removed"] += 1
+
+    # 4) шрифты: оставляем упомянутые в rFonts/w:sym и шрифты темы; встроенные файлы — вместе с записью
+    fonts = {el.get(a) for root in roots(content, styles, numbering) for el in root.iter() for a in FONT_ATTRS if el.get(a)}
+    fonts |= {el.get(W_NS + "font") for root in roots(content) for el in root.iter(W_NS + "sym")}
+    fonts |= {el.get("typeface") for root in roots(group(".theme+xml")) for el in root.iter(A_NS + "latin", A_NS + "ea", A_NS + "cs", A_NS + "font")}
+    fonts.discard(None)
+    dropped_parts = set()
+    for name, root in group(".fontTable+xml") if not _dynamic(fonts) else []:
+        rels_name = _rels_name(name)
+        rels = {r.get("Id"): r for r in tree(rels_name).iter(PKG_NS + "Relationship")} if rels_name in raw else {}
+        for font in root.findall(W_NS + "font"):
+            if font.get(W_NS + "name") in fonts:
+                continue
+            for embed in font:
+                rel = rels.pop(embed.get(R_NS + "id"), None) if embed.tag in FONT_EMBEDS else None
+                if rel is not None:
+                    dropped_parts.add(_resolve(name, rel.get("Target", "")))
+                    drop(rels_name, rel)
+            drop(name, font)
+            stats["fonts_removed"] += 1
+        # файл шрифта, на который ссылается оставшаяся запись, остаётся в пакете
+        dropped_parts -= {_resolve(name, r.get("Target", "")) for r in rels.values()}
+    for o in list(overrides.iter(CT_NS + "Override")):
+        if o.get("PartName", "").lstrip("/") in dropped_parts:
+            _drop(o)
+            trees["[Content_Types].xml"] = overrides
+            changed.add("[Content_Types].xml")
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zout:
+        for name in order:
+            if name in dropped_parts:
+                continue
+            data = raw[name]
+            if name in changed:
+                data = etree.tostring(trees[name], xml_declaration=True, encoding="UTF-8", standalone=True)
+            zout.writestr(fixed_zipinfo(name), data)
+    result = out.getvalue()
+    stats.update(before=len(blob), after=len(result), saved=len(blob) - len(result))
+    return result, stats
+
+def slim_template(tpl: dict, blob: bytes) -> bytes:
+    """Облегчённые байты шаблона (считаются один раз на sha256); при сбое — исходные."""
+    sha = tpl.get("_sha")
+    slim = _SLIM_BLOBS.get(sha)
+    if slim is not None:
+        return slim
+    started = time.perf_counter()
+    try:
+        slim, stats = slim_docx(blob)
+    except Exception as e:
+        slim, stats = blob, {"error": f"{type(e).__name__}: {e}", "before": len(blob), "after": len(blob), "saved": 0}
+        log.warning("DOCX_SLIM: шаблон %s оставлен как есть: %s", tpl["path"], stats["error"])
+    stats.update(path=str(tpl["path"]), ms=elapsed_ms(started))
+    log.info(
+        "DOCX_SLIM: %s %d → %d байт (rsid %d, стилей %d, списков %d, шрифтов %d)",
+        tpl["path"], stats["before"], stats["after"], stats.get("rsid_attrs", 0),
+        stats.get("styles_removed", 0), stats.get("numbering_removed", 0), stats.get("fonts_removed", 0),
+    )
+    with _SLIM_LOCK:
+        live = {t.get("_sha") for t in current_plan().templates}
+        for old in [k for k in _SLIM_BLOBS if k not in live]:
+            del _SLIM_BLOBS[old]
+            DOCX_SLIM_STATS.pop(old, None)
+        DOCX_SLIM_STATS[sha] = stats
+        return _SLIM_BLOBS.setdefault(sha, slim)
+
+def slim_summary() -> dict:
+    """Итог по облегчённым шаблонам — для /readyz."""
+    stats = list(DOCX_SLIM_STATS.values())
+    return {
+        "enabled": DOCX_SLIM,
+        "templates": len(stats),
+        "bytes_before": sum(s["before"] for s in stats),
+        "bytes_after": sum(s["after"] for s in stats),
+        "saved": sum(s["saved"] for s in stats),
+        "errors": [s["path"] for s in stats if "error" in s],
+    }
+
+# ============= Хранилище результатов =============
+# Каждый архив /generate сохраняется на диск вместе с индексом (студент → файлы),
+# чтобы можно было докачать одну папку, один документ или часть большого архива.
+RESULTS_DIR = Path(os.getenv("RESULTS_DIR") or Path(tempfile.gettempdir()) / "vkr_results")
+RESULT_TTL = float(os.getenv("RESULT_TTL_HOURS", "24")) * 3600
+RESULT_PART_MAX_MB = float(os.getenv("RESULT_PART_MAX_MB", "100"))
+_RESULT_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+def attachment_headers(filename: str) -> Dict[str, str]:
+    # не-ASCII имена (кириллица) — через filename* по RFC 5987
+    ascii_name = filename.encode("ascii", "ignore").decode() or "download"
+    return {
+        "Content-Disposition": f'attachment; filename="{ascii_name}"; filename*=UTF-8\'\'{quote(filename)}'
+    }
+
+def purge_old_results() -> None:
+    if not RESULTS_DIR.is_dir():
+        return
+    cutoff = time.time() - RESULT_TTL
+    for p in RESULTS_DIR.iterdir():
+        try:
+            if p.stat().st_mtime < cutoff:
+                p.unlink()
+        except OSError:
+            pass
+
+def result_paths(rid: str) -> Tuple[Path, Path]:
+    return RESULTS_DIR / f"{rid}.zip", RESULTS_DIR / f"{rid}.json"
+
+def manifest_path(rid: str) -> Path:
+    # рядом с архивом, а не внутри: в манифесте время рендера, архив же побайтно детерминирован
+    return RESULTS_DIR / f"{rid}.manifest.json"
+
+def result_unit(arcname: str, depth: int) -> str:
+    """Папка студента (или группы) для записи архива: первые depth компонентов пути."""
+    parts = arcname.split("/")
+    return "/".join(parts[:depth]) if 0 < depth < len(parts) else ""
+
+def write_result_index(rid: str, depth: int) -> dict:
+    """Строит индекс по готовому архиву: units (папки студентов) и разбивку на части ≤ RESULT_PART_MAX_MB."""
+    zip_path, index_path = result_paths(rid)
+    units: Dict[str, dict] = {}
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            unit = units.setdefault(result_unit(info.filename, depth), {"files": [], "size": 0})
+            unit["files"].append({"path": info.filename, "size": info.file_size})
+            unit["size"] += info.compress_size
+
+    cap = max(1, int(RESULT_PART_MAX_MB * 1024 * 1024))
+    parts: List[dict] = []
+    for name, unit in units.items():
+        if not parts or parts[-1]["size"] + unit["size"] > cap:
+            parts.append({"units": [], "size": 0})
+        parts[-1]["units"].append(name)
+        parts[-1]["size"] += unit["size"]
+
+    digest = hashlib.sha256()
+    with open(zip_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    index = {
+        "id": rid,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "size": zip_path.stat().st_size,
+        "etag": digest.hexdigest(),
+        "manifest": f"/results/{rid}/manifest" if manifest_path(rid).is_file() else None,
+        "students": [{"folder": name, **unit} for name, unit in units.items()],
+        "parts": [{"n": n, **part} for n, part in enumerate(parts, start=1)],
+    }
+    index_path.write_text(json.dumps(index, ensure_ascii=False), encoding="utf-8")
+    return index
+
+def load_result_index(rid: str) -> Tuple[dict, Path]:
+    if not _RESULT_ID_RE.match(rid or ""):
+        raise HTTPException(404, "Результат не найден")
+    zip_path, index_path = result_paths(rid)
+    if not (zip_path.is_file() and index_path.is_file()):
+        raise HTTPException(404, "Результат не найден или устарел")
+    return json.loads(index_path.read_text(encoding="utf-8")), zip_path
+
+def stream_zip_subset(zip_path: Path, names: List[str], filename: str) -> StreamingResponse:
+    """Новый ZIP только из выбранных записей сохранённого архива (сжатые данные копируются как есть)."""
+    out = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    writer = RawZipWriter(out)
+    for name, member in zip_raw_members(zip_path, names):
+        writer.write_raw(name, member)
+    writer.close()
+    out.seek(0)
+
+    def chunks():
+        with out:
+            while True:
+                chunk = out.read(1024 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+
+    return StreamingResponse(chunks(), media_type="application/zip", headers=attachment_headers(filename))
+
+@app.get("/results/{rid}")
+def result_index(rid: str):
+    """Индекс сохранённого результата: студенты, их файлы и части архива."""
+    index, _ = load_result_index(rid)
+    return JSONResponse(index)
+
+def result_response(request: Request, rid: str, extra: Optional[Dict[str, str]] = None):
+    """Весь архив результата со стабильным ETag (по содержимому документов) и ответом 304."""
+    index, zip_path = load_result_index(rid)
+    etag = f'"{index["etag"]}"'
+    headers = {"ETag": etag, "X-Result-Id": rid, **(extra or {})}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(zip_path, media_type="application/zip", filename="generated_docs.zip", headers=headers)
+
+@app.get("/results/{rid}/archive")
+def result_archive(request: Request, rid: str):
+    return result_response(request, rid)
+
+@app.get("/results/{rid}/manifest")
+def result_manifest_file(rid: str):
+    """Манифест результата: документы, статусы, время рендера (в архив не входит)."""
+    load_result_index(rid)
+    path = manifest_path(rid)
+    if not path.is_file():
+        raise HTTPException(404, "У этого результата нет манифеста")
+    return FileResponse(path, media_type="application/json")
+
+@app.get("/results/{rid}/parts/{n}")
+def result_part(rid: str, n: int):
+    """n-я часть архива (целые папки студентов, размер ≤ RESULT_PART_MAX_MB)."""
+    index, zip_path = load_result_index(rid)
+    if not 1 <= n <= len(index["parts"]):
+        raise HTTPException(404, f"Нет части №{n}")
+    folders = set(index["parts"][n - 1]["units"])
+    names = [f["path"] for st in index["students"] if st["folder"] in folders for f in st["files"]]
+    return stream_zip_subset(zip_path, names, f"generated_docs.part{n:02d}.zip")
+
+@app.get("/results/{rid}/student")
+def result_student(rid: str, folder: str = Query(..., description="папка студента из индекса")):
+    index, zip_path = load_result_index(rid)
+    for st in index["students"]:
+        if st["folder"] == folder:
+            names = [f["path"] for f in st["files"]]
+            return stream_zip_subset(zip_path, names, (folder.rsplit("/", 1)[-1] or "generated_docs") + ".zip")
+    raise HTTPException(404, f"Нет папки {folder}")
+
+@app.get("/results/{rid}/document")
+def result_document(rid: str, path: str = Query(..., description="путь документа внутри архива")):
+    _, zip_path = load_result_index(rid)
+    with zipfile.ZipFile(zip_path) as zf:
+        try:
+            data = zf.read(path)
+        except KeyError:
+            raise HTTPException(404, f"Нет документа {path}")
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return StreamingResponse(io.BytesIO(data), media_type=media_type, headers=attachment_headers(path.rsplit("/", 1)[-1]))
+
+# -------- идемпотентность: кэш результатов и склейка одинаковых запросов --------
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_MINUTES", "10")) * 60
+
+_GENERATE_INFLIGHT: Dict[str, _Flight] = {}
+_GENERATE_LOCK = threading.Lock()
+
+def template_version(tpl: dict) -> str:
+    """Хэш содержимого .docx (посчитан при сборке плана) и настроек шаблона."""
+    version = tpl.get("_version")
+    if version is None:
+        conf = json.dumps({k: tpl.get(k) for k in ("fields", "out", "dir", "output")}, ensure_ascii=False, sort_keys=True)
+        version = tpl["_version"] = hashlib.sha256((tpl.get("_sha", "missing") + conf).encode("utf-8")).hexdigest()
+    return version
+
+def render_key(tpl: dict) -> str:
+    """
+    Пространство имён кэша рендера: байты .docx + отображение полей. Побайтно одинаковые
+    шаблоны с одинаковыми fields дают одинаковые документы, даже если out/dir у них разные.
+    """
+    key = tpl.get("_render_key")
+    if key is None:
+        fields = json.dumps(tpl.get("fields"), ensure_ascii=False, sort_keys=True)
+        key = tpl["_render_key"] = hashlib.sha256((tpl.get("_sha", "missing") + fields).encode("utf-8")).hexdigest()
+    return key
+
+def source_digest(
+    table_file: Optional[UploadFile],
+    gsheet_url: Optional[str],
+    gsheet_format: Optional[str],
+    sheets: List[str],
+) -> str:
+    """Хэш входной таблицы. Google Sheets качается через кэш, так что load_record_sets не скачает её второй раз."""
+    h = hashlib.sha256()
+    if gsheet_url and gsheet_url.strip():
+        for s in (sheets or [None]):
+            if s is not None and not s.isdigit():
+                upl, gid, fmt = gsheet_book(gsheet_url.strip()), s, "xlsx"
+            else:
+                upl, gid, fmt = gsheet_upload(gsheet_url.strip(), gsheet_format, int(s) if s is not None else None)
+            h.update(f"gsheet:{gid}:{fmt}:".encode())
+            h.update(upl.file.getvalue())
+    elif table_file and (table_file.filename or "").strip():
+        h.update(f"file:{Path(table_file.filename).suffix.lower()}:".encode())
+        fh = upload_handle(table_file)
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(chunk)
+        fh.seek(0)
+    return h.hexdigest()
+
+def cached_result(key: str) -> Optional[str]:
+    key_path = RESULTS_DIR / f"{key}.key"
+    try:
+        if time.time() - key_path.stat().st_mtime > RESULT_CACHE_TTL:
+            return None
+        rid = key_path.read_text(encoding="ascii").strip()
+    except OSError:
+        return None
+    zip_path, index_path = result_paths(rid)
+    return rid if zip_path.is_file() and index_path.is_file() else None
+
+def remember_result(key: str, rid: str) -> None:
+    tmp = RESULTS_DIR / f"{key}.key.tmp"
+    tmp.write_text(rid, encoding="ascii")
+    tmp.replace(RESULTS_DIR / f"{key}.key")
+
+def single_flight_result(key: str, compute) -> Tuple[str, bool]:
+    """
+    (rid, из кэша?). Свежий результат отдаём из кэша; одинаковые запросы,
+    пришедшие одновременно, ждут одно общее вычисление.
+    """
+    rid = cached_result(key)
+    if rid:
+        return rid, True
+
+    with _GENERATE_LOCK:
+        flight = _GENERATE_INFLIGHT.get(key)
+        leader = flight is None
+        if leader:
+            flight = _GENERATE_INFLIGHT[key] = _Flight()
+
+    if not leader:
+        flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, True
+
+    try:
+        rid = cached_result(key)
+        hit = rid is not None
+        if not hit:
+            rid = compute()
+            remember_result(key, rid)
+        flight.result = rid
+        return rid, hit
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _GENERATE_LOCK:
+            _GENERATE_INFLIGHT.pop(key, None)
+        flight.event.set()
+
 @app.post("/generate")
 def generate_zip(
+    request: Request,
     table_file: Optional[UploadFile] = File(default=None),
     gsheet_url: Optional[str] = Form(default=None),
-    header_row: int = Form(default=1),
+    header_row: int = Form(default=0),  # 0 — строка заголовков определяется автоматически
     include: Optional[str] = Form(default=None),
+    gsheet_format: Optional[str] = Form(default=None),
+    kits: Optional[str] = Form(default=None),
+    sheets: Optional[str] = Form(default=None),
+    layout: str = Form(default="folders"),
+    merge_pdf: bool = Form(default=False),
+    kit: Optional[str] = Form(default=None),
 ):
-    # 1) читаем ТАБЛИЦУ: теперь получаем СПИСОК записей (по студентам)
-    if gsheet_url and gsheet_url.strip():
-        records, meta, _ = extract_records_from_gsheet_multi(gsheet_url.strip(), header_row)
-    elif table_file and (table_file.filename or "").strip():
-        records, meta, _ = extract_records_from_upload_multi(table_file, header_row)
-    else:
-        raise HTTPException(400, "Укажите Google Sheet ИЛИ выберите файл")
+    # группы шаблонов: комплекты (kit / kits) и/или include (группы через «;»)
+    kits = ",".join(k for k in (kit, kits) if k and k.strip())
+    groups = template_groups(current_plan(), kits, include)
+
+    # folders — папка на студента (как раньше); merge — один документ на шаблон для всех
+    layout = (layout or "folders").strip().lower()
+    if layout not in ("folders", "merge"):
+        raise HTTPException(400, f"Неизвестный режим выдачи: {layout}")
+
+    # ключ идемпотентности: содержимое таблицы + параметры + версии выбранных шаблонов
+    sheet_list = split_csv(sheets)
+    key_src = {
+        "source": source_digest(table_file, gsheet_url, gsheet_format, sheet_list),
+        "header_row": header_row,
+        "sheets": sheet_list,
+        "layout": layout,
+        "merge_pdf": merge_pdf,
+        "docx_slim": DOCX_SLIM,  # облегчённые шаблоны дают другие байты .docx
+        "groups": [[label, [template_version(t) for t in tpls]] for label, tpls in groups],
+    }
+    key = hashlib.sha256(json.dumps(key_src, sort_keys=True).encode("utf-8")).hexdigest()
 
-    if not records:
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    rid, hit = single_flight_result(
+        key,
+        lambda: build_result(table_file, gsheet_url, header_row, gsheet_format, sheet_list, groups, layout, merge_pdf),
+    )
+    return result_response(request, rid, {"X-Result-Cache": "hit" if hit else "miss"})
+
+def generation_jobs(
+    record_sets: List[Tuple[str, List[Dict[str, str]]]],
+    groups: List[Tuple[str, List[dict]]],
+) -> List[Tuple[List[Dict[str, str]], List[dict], str]]:
+    """Задания «лист × группа»: (записи, шаблоны, верхняя папка); при нескольких листах/группах — своя папка."""
+    jobs = []
+    for sheet_label, records in record_sets:
+        for group_label, templates in groups:
+            parts = []
+            if len(record_sets) > 1:
+                parts.append(slugify(sheet_label))
+            if len(groups) > 1:
+                parts.append(slugify(group_label))
+            jobs.append((records, templates, "/".join(parts)))
+    return jobs
+
+# -------- манифест результата: что отрендерено, сколько весит и сколько заняло --------
+def result_manifest(documents: List[dict], students: int, params: dict, wall_ms: float) -> dict:
+    """
+    Манифест результата (/results/{rid}/manifest): строка на каждую запись (путь, размер, sha256, статус, render_ms, pdf_ms),
+    итоги по запросу и по шаблонам (чтобы видеть медленные шаблоны, не распаковывая архив).
+    content_sha256 зависит только от путей и содержимого документов, не от времени рендера.
+    """
+    totals = {
+        "documents": len(documents),
+        "ok": 0,
+        "errors": 0,
+        "reused": 0,
+        "students": students,
+        "bytes": 0,
+        "render_ms": 0.0,
+        "pdf_ms": 0.0,
+        "wall_ms": wall_ms,
+    }
+    templates: Dict[str, dict] = {}
+    for doc in documents:
+        totals["ok" if doc["status"] == "ok" else "errors"] += 1
+        totals["reused"] += doc["reused"]
+        totals["bytes"] += doc["size"]
+        totals["render_ms"] += doc["render_ms"]
+        totals["pdf_ms"] += doc["pdf_ms"]
+        t = templates.setdefault(
+            doc["template"], {"documents": 0, "errors": 0, "render_ms": 0.0, "pdf_ms": 0.0, "max_ms": 0.0}
+        )
+        t["documents"] += 1
+        t["errors"] += doc["status"] != "ok"
+        t["render_ms"] += doc["render_ms"]
+        t["pdf_ms"] += doc["pdf_ms"]
+        t["max_ms"] = max(t["max_ms"], doc["render_ms"] + doc["pdf_ms"])
+
+    for item in (totals, *templates.values()):
+        for k in ("render_ms", "pdf_ms"):
+            item[k] = round(item[k], 1)
+
+    if DOCX_SLIM:
+        # экономия DOCX_SLIM — по размеру облегчённого шаблона, на каждый .docx из архива
+        saved = {t["id"]: DOCX_SLIM_STATS.get(t.get("_sha"), {}).get("saved", 0) for t in current_plan().templates}
+        totals["slim_saved_bytes"] = 0
+        for doc in documents:
+            if doc["status"] == "ok" and doc["path"].endswith(".docx"):
+                t = templates[doc["template"]]
+                t["slim_saved_bytes"] = t.get("slim_saved_bytes", 0) + saved.get(doc["template"], 0)
+                totals["slim_saved_bytes"] += saved.get(doc["template"], 0)
+
+    content = hashlib.sha256(
+        json.dumps([[d["path"], d["sha256"]] for d in documents], ensure_ascii=False).encode("utf-8")
+    )
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        **params,
+        "content_sha256": content.hexdigest(),
+        "totals": totals,
+        "templates": templates,
+        "documents": documents,
+    }
+
+def build_result(
+    table_file: Optional[UploadFile],
+    gsheet_url: Optional[str],
+    header_row: int,
+    gsheet_format: Optional[str],
+    sheet_list: List[str],
+    groups: List[Tuple[str, List[dict]]],
+    layout: str,
+    merge_pdf: bool,
+) -> str:
+    """Полный прогон генерации; возвращает id сохранённого результата."""
+    started = time.perf_counter()
+    # 1) читаем ТАБЛИЦУ один раз: список записей (по студентам) для каждого листа
+    record_sets = load_record_sets(table_file, gsheet_url, header_row, gsheet_format, sheet_list)
+    if not any(records for _, records in record_sets):
         raise HTTPException(400, "Не найдено ни одной строки с данными")
 
-    # 2) фильтрация шаблонов через include (как и раньше)
-    selected_ids = None
-    if include:
-        selected_ids = {
-            s.strip().lower()
-            for s in include.split(",")
-            if s.strip()
-        }
+    # 3) задания «лист × группа»
+    jobs = generation_jobs(record_sets, groups)
+
+    # 4) ZIP пишем сразу на диск (одна ПАПКА на каждого студента), затем индексируем его
+    purge_old_results()
+    rid = uuid.uuid4().hex
+    zip_path, _ = result_paths(rid)
+    tmp_path = zip_path.with_suffix(".part")
+    documents: List[dict] = []
+
+    with memory_stage("generate"), zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        def write(arcname: str, data: bytes, row: dict) -> None:
+            zf.writestr(fixed_zipinfo(arcname), data)
+            documents.append({
+                "path": arcname,
+                "size": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+                **row,
+            })
+
+        if layout == "merge":
+            # слияние: группы параллельно (внутри — свой пул по шаблонам), запись — в стабильном порядке
+            reports: List[List[dict]] = [[] for _ in jobs]
+
+            def run(job, report):
+                with span("render_group", prefix=job[2], students=len(job[0]), templates=len(job[1])):
+                    return render_group_merged(*job, merge_pdf=merge_pdf, report=report)
+
+            with ThreadPoolExecutor(max_workers=max(1, min(GENERATE_WORKERS, len(jobs)))) as ex:
+                results = list(ex.map(traced(run), jobs, reports))
+            with span("zip.write"):
+                for entries, report in zip(results, reports):
+                    for (arcname, data), row in zip(entries, report):
+                        write(arcname, data, row)
+        else:
+            # folders: рендер, PDF и запись перекрываются (см. pipeline_documents)
+            with span("pipeline", render_workers=PIPELINE_RENDER_WORKERS,
+                      pdf_workers=PIPELINE_PDF_WORKERS, depth=PIPELINE_DEPTH):
+                pipeline_documents(jobs, write)
+
+        manifest = result_manifest(
+            documents,
+            students=sum(len(records) for _, records in record_sets),
+            params={
+                "layout": layout,
+                "merge_pdf": merge_pdf,
+                "sheets": [label for label, _ in record_sets],
+                "groups": [label for label, _ in groups],
+                "docx_slim": DOCX_SLIM,
+            },
+            wall_ms=elapsed_ms(started),
+        )
+    tmp_path.replace(zip_path)
+    tmp_manifest = manifest_path(rid).with_suffix(".tmp")
+    tmp_manifest.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+    tmp_manifest.replace(manifest_path(rid))
+
+    # глубина «единицы» индекса: верхние папки листов/групп + папка студента
+    depth = len(jobs[0][2].split("/")) if jobs[0][2] else 0
+    if layout == "folders":
+        depth += 1
+    write_result_index(rid, depth)
+    return rid
+
+# ============= Предварительная проверка таблицы =============
+# колонки-даты узнаём по названию; значения проверяем теми же форматами, что и normalize_date
+VALIDATE_DATE_COLUMNS = re.compile(os.getenv("VALIDATE_DATE_COLUMNS", r"дата|начало|конец"), re.IGNORECASE)
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d.%m.%Y")
+
+def mask_fields(mask: Optional[str]) -> List[str]:
+    """Поля маски имени вида «{ФИО}_{Группа}» (для out/dir)."""
+    return [name for _, name, _, _ in string.Formatter().parse(mask or "") if name]
+
+def validation_columns(templates: List[dict]) -> Dict[str, List[str]]:
+    """Какие колонки нужны выбранным шаблонам: {колонка: [id шаблонов]} в порядке конфига."""
+    need: Dict[str, List[str]] = {}
+    for tpl in templates:
+        for col in tpl["fields"].values():
+            ids = need.setdefault(col, [])
+            if tpl["id"] not in ids:
+                ids.append(tpl["id"])
+    return need
+
+def validate_records(records: List[Dict[str, str]], templates: List[dict]) -> dict:
+    """
+    Проверка всех строк одним проходом по колонкам (pandas, без рендера):
+    пустые обязательные поля, неразбираемые даты и пустые поля масок имён файлов.
+    Номер строки — тот же, что у папки студента (001_…).
+    """
+    need = validation_columns(templates)
+    naming = {"ФИО"}  # папка студента
+    for tpl in templates:
+        naming.update(mask_fields(tpl["out"]))
+        naming.update(mask_fields(tpl.get("dir")))
+
+    df = pd.DataFrame.from_records(records).fillna("")
+    missing = {col: ids for col, ids in need.items() if col not in df.columns}
+    present = [col for col in need if col in df.columns]
+
+    # пустые значения: сразу матрица «строка × колонка»
+    empty = df[present].eq("") if present else pd.DataFrame(index=df.index)
+
+    # даты: непустое значение, которое не разбирается ни одним форматом
+    bad_date = pd.DataFrame(False, index=df.index, columns=[c for c in present if VALIDATE_DATE_COLUMNS.search(c)])
+    for col in bad_date.columns:
+        values = df[col]
+        parsed = pd.Series(False, index=df.index)
+        for fmt in DATE_FORMATS:
+            parsed |= pd.to_datetime(values, format=fmt, errors="coerce").notna()
+        bad_date[col] = values.ne("") & ~parsed
+
+    # маски имён: пустое поле или вовсе нет колонки — имя файла получится «титул__.docx»
+    name_cols = [c for c in naming if c in df.columns]
+    name_empty = df[name_cols].eq("") if name_cols else pd.DataFrame(index=df.index)
+
+    # строки с проблемами собираем из разреженных координат матриц, а не ячейка за ячейкой
+    rows: Dict[int, Dict[str, object]] = {}
+    fio = df["ФИО"].tolist() if "ФИО" in df.columns else [""] * len(df)
+    values = {c: df[c].tolist() for c in bad_date.columns}
+
+    def issue(i: int) -> Dict[str, object]:
+        if i not in rows:
+            rows[i] = {"row": i + 1, "fio": fio[i]}
+        return rows[i]
+
+    for key, matrix in (("empty", empty), ("bad_date", bad_date), ("filename", name_empty)):
+        cols = list(matrix.columns)
+        for i, j in zip(*matrix.to_numpy(dtype=bool).nonzero()):
+            i, col = int(i), cols[j]
+            if key == "bad_date":
+                issue(i).setdefault(key, {})[col] = values[col][i]
+            else:
+                issue(i).setdefault(key, []).append(col)
+    rows = [rows[i] for i in sorted(rows)]
+
+    # сводка по колонкам: сколько строк затронуто и каким шаблонам колонка нужна
+    columns = {}
+    for col in present:
+        n_empty = int(empty[col].sum())
+        n_bad = int(bad_date[col].sum()) if col in bad_date.columns else 0
+        if n_empty or n_bad:
+            columns[col] = {"empty": n_empty, "bad_date": n_bad, "templates": need[col]}
+
+    return {
+        "rows": len(df),
+        "rows_with_issues": len(rows),
+        "missing_columns": missing,
+        "missing_filename_columns": sorted(c for c in naming if c not in df.columns),
+        "columns": columns,
+        "issues": rows,
+    }
 
-    templates = TEMPLATES
-    if selected_ids:
-        templates = [
-            t for t in TEMPLATES
-            if t.get("id") and t["id"].lower() in selected_ids
-        ]
+@app.post("/validate")
+def validate(
+    table_file: Optional[UploadFile] = File(default=None),
+    gsheet_url: Optional[str] = Form(default=None),
+    header_row: int = Form(default=0),  # 0 — строка заголовков определяется автоматически
+    include: Optional[str] = Form(default=None),
+    gsheet_format: Optional[str] = Form(default=None),
+    kits: Optional[str] = Form(default=None),
+    sheets: Optional[str] = Form(default=None),
+    kit: Optional[str] = Form(default=None),
+):
+    """Те же поля, что у /generate; ничего не рендерим — только проверяем таблицу."""
+    started = time.perf_counter()
+    kits = ",".join(k for k in (kit, kits) if k and k.strip())
+    groups = template_groups(current_plan(), kits, include)
+
+    # шаблоны всех групп без повторов
+    templates: Dict[str, dict] = {}
+    for _, tpls in groups:
+        for tpl in tpls:
+            templates.setdefault(tpl["id"], tpl)
+
+    record_sets = load_record_sets(table_file, gsheet_url, header_row, gsheet_format, split_csv(sheets))
+    checked = time.perf_counter()
+    report = [
+        dict(sheet=label, **validate_records(records, list(templates.values())))
+        for label, records in record_sets
+    ]
+    done = time.perf_counter()
+
+    ok = all(not r["issues"] and not r["missing_columns"] and not r["missing_filename_columns"] for r in report)
+    return JSONResponse({
+        "ok": ok,
+        "templates": list(templates),
+        "sheets": report,
+        "ms": {"read": round((checked - started) * 1000, 1), "check": round((done - checked) * 1000, 1)},
+    })
+
+# ============= Живость и готовность =============
+READY_REQUIRE_PDF = os.getenv("READY_REQUIRE_PDF", "1") == "1"
+READINESS: Dict[str, object] = {"ready": False, "stage": "starting"}
+
+def check_pdf_backend() -> Dict[str, object]:
+    """Проверяем, что LibreOffice запускается (soffice --version)."""
+    t0 = time.perf_counter()
+    try:
+        proc = subprocess.run(
+            [SOFFICE_BIN, "--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            timeout=120,
+        )
+        ok = proc.returncode == 0
+        info = (proc.stdout or "").strip()
+    except (OSError, subprocess.TimeoutExpired) as e:
+        ok, info = False, f"{type(e).__name__}: {e}"
+    return {"ok": ok, "info": info, "ms": round((time.perf_counter() - t0) * 1000, 1)}
 
-    # 3) собираем ZIP: одна ПАПКА на каждого студента
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for idx, record in enumerate(records, start=1):
-            # имя папки вида "001_Иванов Иван Иванович"
-            fio = safe(record.get("ФИО")) or f"record_{idx:03d}"
-            folder = slugify(f"{idx:03d}_{fio}")
+WARMUP = os.getenv("WARMUP", "1") == "1"
 
-            for tpl in templates:
-                try:
-                    # контекст: {tpl_key: значение из record по названию колонки}
-                    ctx = {}
-                    for tpl_key, excel_col in tpl["fields"].items():
-                        raw_val = record.get(excel_col, "")
-
-                        # сначала пробуем интерпретировать значение как дату
-                        raw_val = normalize_date(raw_val)
-                        # потом уже просто "подчищаем" строку
-                        raw_val = safe(raw_val)
-
-                        ctx[tpl_key] = raw_val
-
-                    doc = DocxTemplate(tpl["path"])
-                    doc.render(ctx, jinja_env=JINJA_ENV)
-
-                    # рендерим DOCX в память
-                    out_mem = io.BytesIO()
-                    doc.save(out_mem)
-                    docx_bytes = out_mem.getvalue()
-
-                    # имя файла из шаблонной маски out
-                    out_name = slugify(
-                        tpl["out"].format_map(SafeMap(record)) or "doc_001.docx"
-                    )
-
-                    # формат выхода: docx или pdf
-                    output = (tpl.get("output") or "docx").strip().lower()
-                    if output == "pdf":
-                        if out_name.lower().endswith(".docx"):
-                            out_name = out_name[:-5] + ".pdf"
-                        elif not out_name.lower().endswith(".pdf"):
-                            out_name += ".pdf"
-
-                    # путь внутри архива (dir → подпапка внутри папки студента)
-                    subdir_raw = (tpl.get("dir") or "").strip()
-                    if subdir_raw:
-                        subdir_filled = slugify_path(
-                            subdir_raw.format_map(SafeMap(record))
-                        )
-                        arcname = "/".join([folder, subdir_filled, out_name])
-                    else:
-                        arcname = "/".join([folder, out_name])
-
-                    # пишем либо pdf, либо docx
-                    if output == "pdf":
-                        pdf_bytes = docx_bytes_to_pdf_bytes(docx_bytes)
-                        zf.writestr(arcname, pdf_bytes)
-                    else:
-                        if not out_name.lower().endswith(".docx"):
-                            arcname = arcname + ".docx"
-                        zf.writestr(arcname, docx_bytes)
-
-                except Exception as e:
-                    err = slugify(tpl.get("out", "file")) + ".ERROR.txt"
-                    zf.writestr(
-                        f"{folder}/{err}",
-                        f"Ошибка ({tpl['path']}): {type(e).__name__}: {e}",
-                    )
-
-    buf.seek(0)
-    return StreamingResponse(
-        buf,
-        media_type="application/zip",
-        headers={"Content-Disposition": 'attachment; filename="generated_docs.zip"'},
-    )
+def warm_up() -> Dict[str, object]:
+    """
+    Прогрев перед первым запросом: читаем каждый шаблон в память, делаем пробный рендер
+    с пустым контекстом (Jinja, lxml, python-docx) и, если есть шаблоны с output: pdf,
+    одну «холостую» конвертацию через soffice. Возвращает тайминги и ошибки.
+    """
+    t_all = time.perf_counter()
+    timings: Dict[str, float] = {}
+    errors: Dict[str, str] = {}
+    sample_docx: Optional[bytes] = None
+    done: Dict[str, str] = {}  # sha256 → id уже прогретого шаблона с теми же байтами
+    for tpl in current_plan().templates:
+        sha = tpl.get("_sha")
+        if sha in done:
+            if done[sha] in errors:
+                errors[tpl["id"]] = errors[done[sha]]
+            continue
+        t0 = time.perf_counter()
+        try:
+            docx_bytes = render_docx_bytes(tpl, {})
+            if sample_docx is None and template_output(tpl) == "pdf":
+                sample_docx = docx_bytes
+        except Exception as e:
+            errors[tpl["id"]] = f"{type(e).__name__}: {e}"
+        timings[tpl["id"]] = round((time.perf_counter() - t0) * 1000, 1)
+        if sha:
+            done[sha] = tpl["id"]
+
+    result: Dict[str, object] = {"templates_ms": timings, "errors": errors}
+    if sample_docx is not None:
+        t0 = time.perf_counter()
+        try:
+            docx_bytes_to_pdf_bytes(sample_docx)
+            result["pdf"] = {"ok": True}
+        except Exception as e:
+            result["pdf"] = {"ok": False, "info": f"{type(e).__name__}: {e}"}
+        result["pdf"]["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    result["total_ms"] = round((time.perf_counter() - t_all) * 1000, 1)
+    return result
+
+def prepare_readiness() -> None:
+    """Фоновый прогрев: тяжёлые импорты, шаблоны, PDF-бэкенд. Итог — в READINESS (/readyz)."""
+    try:
+        READINESS["stage"] = "imports"
+        for name in HEAVY_DEPENDENCIES:
+            import_dependency(name)
+
+        READINESS["stage"] = "templates"
+        plan = current_plan()
+        missing = [t["path"] for t in plan.templates if "_blob" not in t]
+        READINESS["templates"] = {
+            "count": len(plan.templates),
+            "missing": missing,
+            "duplicates": list(plan.duplicates.values()),
+        }
+        for ids in plan.duplicates.values():
+            log.warning("Одинаковые файлы шаблонов (общий кэш): %s", ", ".join(ids))
+
+        needs_pdf = any(template_output(t) == "pdf" for t in plan.templates)
+        broken: Dict[str, str] = {}
+        if WARMUP:
+            # пробный рендер каждого шаблона + холостая конвертация (она же проверка PDF-бэкенда)
+            READINESS["stage"] = "warmup"
+            warm = warm_up()
+            READINESS["warmup"] = warm
+            broken = warm["errors"]
+            pdf = warm.get("pdf")
+        elif needs_pdf:
+            READINESS["stage"] = "pdf_backend"
+            pdf = check_pdf_backend()
+        else:
+            pdf = None
+
+        pdf_ok = True
+        if needs_pdf:
+            READINESS["pdf_backend"] = pdf
+            pdf_ok = bool(pdf and pdf["ok"]) or not READY_REQUIRE_PDF
+
+        READINESS["ready"] = not missing and not broken and pdf_ok
+        READINESS["stage"] = "done"
+    except Exception as e:
+        READINESS["stage"] = "failed"
+        READINESS["error"] = f"{type(e).__name__}: {e}"
 
 @app.get("/healthz")
 def healthz():
+    # живость: процесс отвечает, ничего тяжёлого не трогаем
     return PlainTextResponse("ok")
+
+@app.get("/readyz")
+def readyz():
+    """Готовность: шаблоны загружены, PDF-бэкенд проверен. Время импорта зависимостей — в imports_ms."""
+    body = {**READINESS, "imports_ms": dict(IMPORT_TIMINGS), "template_reload": RELOAD_STATUS, "docx_slim": slim_summary()}
+    return JSONResponse(body, status_code=200 if READINESS["ready"] else 503)
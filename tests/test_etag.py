@@ -0,0 +1,34 @@
+"""If-None-Match: список ETag, «*» и слабые ETag."""
+import pytest
+from starlette.requests import Request
+
+import server
+
+
+@pytest.mark.parametrize("header, etag, expected", [
+    ('"abc"', '"abc"', True),
+    ('"x", "abc"', '"abc"', True),
+    ('"x","abc" , "y"', '"abc"', True),
+    ("*", '"abc"', True),
+    ('W/"abc"', '"abc"', True),
+    ('"abc"', 'W/"abc"', True),
+    ('"abcd"', '"abc"', False),
+    ('"ab"', '"abc"', False),
+    ('"abc-gzip"', '"abc"', False),
+    ("", '"abc"', False),
+])
+def test_etag_matches(header, etag, expected):
+    assert server.etag_matches(header, etag) is expected
+
+
+def request(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match is not None else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+def test_static_asset_answers_304_for_any_listed_etag():
+    asset = server.StaticAsset(b"{}", "application/json")
+    etag = asset.response(request()).headers["etag"]
+    assert asset.response(request(f'"other", {etag}')).status_code == 304
+    assert asset.response(request("*")).status_code == 304
+    assert asset.response(request('"other"')).status_code == 200
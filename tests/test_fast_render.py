@@ -0,0 +1,74 @@
+"""
+Золотой тест быстрого рендера: каждый шаблон из templates_config рендерится CompiledDocx и
+DocxTemplate (render_docx_reference) на наборе записей, части пакета сравниваются побайтно.
+Ошибка рендера тоже результат: оба пути должны падать одинаково.
+"""
+import io
+import zipfile
+
+import pytest
+
+import server
+
+# значения, на которых пути могли бы разойтись: пустые, XML-спецсимволы, переносы строк,
+# табы и пробелы по краям, даты (normalize_date), Jinja-разметка внутри значения
+VALUES = {
+    "empty": lambda col: "",
+    "plain": lambda col: f"«{col}»",
+    "xml_special": lambda col: f'{col} & <b>"кавычки"</b> \'апостроф\' > <',
+    "multiline": lambda col: f"{col}\nвторая строка\n\nчетвёртая строка",
+    "whitespace": lambda col: f"  {col}\tс табом  ",
+    "date": lambda col: "2025-09-01 00:00:00",
+    "jinja_like": lambda col: "{{ x }} {% if y %}z{% endif %}",
+}
+
+
+def unique_templates():
+    seen, out = set(), []
+    for tpl in server.current_plan().templates:
+        if tpl.get("_blob") is None or tpl["_sha"] in seen:
+            continue
+        seen.add(tpl["_sha"])
+        out.append(tpl)
+    return out
+
+
+TEMPLATES = unique_templates()
+
+
+def outcome(render):
+    """('ok', {часть: байты}) или ('error', тип исключения)."""
+    try:
+        blob = render()
+    except Exception as e:
+        return "error", type(e).__name__
+    with zipfile.ZipFile(io.BytesIO(blob)) as zf:
+        return "ok", {name: zf.read(name) for name in zf.namelist()}
+
+
+@pytest.fixture(params=[False, True], ids=["original", "slim"])
+def slim(request, monkeypatch):
+    monkeypatch.setattr(server, "DOCX_SLIM", request.param)
+    return request.param
+
+
+def test_every_template_is_covered():
+    assert len(TEMPLATES) == len({t["_sha"] for t in server.current_plan().templates if t.get("_blob")})
+    assert TEMPLATES
+
+
+@pytest.mark.parametrize("tpl", TEMPLATES, ids=[t["id"] for t in TEMPLATES])
+def test_fast_render_matches_docxtpl(tpl, slim):
+    compiled = server.CompiledDocx(server.template_bytes(tpl))
+    for case, value in VALUES.items():
+        record = {col: value(col) for col in tpl["fields"].values()}
+        ctx = server.build_context(tpl, record)
+        fast = outcome(lambda: compiled.render(ctx))
+        reference = outcome(lambda: server.render_docx_reference(tpl, ctx))
+        assert fast[0] == reference[0], f"{case}: {fast[0]} != {reference[0]}"
+        if fast[0] == "error":
+            assert fast[1] == reference[1], case
+            continue
+        assert list(fast[1]) == list(reference[1]), f"{case}: состав частей"
+        for name, data in reference[1].items():
+            assert fast[1][name] == data, f"{case}: {name}"
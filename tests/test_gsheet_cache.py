@@ -0,0 +1,146 @@
+"""Кэш и склейка запросов к Google Sheets: проверка на локальном HTTP-сервере-заглушке."""
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import server
+
+CSV = "ФИО,Группа\nИванов Иван,ЭК-21\n".encode("utf-8")
+ETAG = '"v1"'
+
+
+def make_book() -> bytes:
+    """Книга, где вкладки переставлены: первая по порядку — «Весна», а не лист с gid=0."""
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    wb.active.title = "Весна"
+    wb.active.append(["ФИО", "Группа"])
+    wb.active.append(["Петров Пётр", "ЭК-22"])
+    autumn = wb.create_sheet("Осень")
+    autumn.append(["ФИО", "Группа"])
+    autumn.append(["Сидоров Сидор", "ЭК-23"])
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+BOOK = make_book()
+
+
+class _Upstream(BaseHTTPRequestHandler):
+    hits = []
+
+    def do_GET(self):
+        type(self).hits.append((self.path, self.headers.get("If-None-Match")))
+        time.sleep(0.3)  # чтобы одновременные запросы успели встать в очередь за первым
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = BOOK if "format=xlsx" in self.path else CSV
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", ETAG)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    _Upstream.hits = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Upstream)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    monkeypatch.setattr(server, "GSHEET_EXPORT_BASE", f"http://127.0.0.1:{httpd.server_port}")
+    monkeypatch.setattr(server, "_GSHEET_CACHE", {})
+    monkeypatch.setattr(server, "_GSHEET_INFLIGHT", {})
+    yield _Upstream.hits
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fetch_concurrently(n, *args):
+    results, errors = [None] * n, []
+    barrier = threading.Barrier(n)
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = server.fetch_gsheet_export(*args)
+        except Exception as e:  # pragma: no cover - попадёт в assert ниже
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    return results
+
+
+def test_concurrent_fetches_of_one_key_hit_upstream_once(upstream):
+    results = fetch_concurrently(8, "sheet1", 5, "csv")
+    assert results == [CSV] * 8
+    assert len(upstream) == 1
+    assert upstream[0][0] == "/spreadsheets/d/sheet1/export?format=csv&gid=5"
+
+    # свежая запись — из кэша, без запроса
+    assert server.fetch_gsheet_export("sheet1", 5, "csv") == CSV
+    assert len(upstream) == 1
+
+
+def test_different_keys_are_fetched_separately(upstream):
+    server.fetch_gsheet_export("sheet1", 5, "csv")
+    server.fetch_gsheet_export("sheet1", 6, "csv")
+    assert sorted(path for path, _ in upstream) == [
+        "/spreadsheets/d/sheet1/export?format=csv&gid=5",
+        "/spreadsheets/d/sheet1/export?format=csv&gid=6",
+    ]
+
+
+def test_stale_entry_is_revalidated_with_etag(upstream, monkeypatch):
+    server.fetch_gsheet_export("sheet1", 5, "csv")
+    monkeypatch.setattr(server, "GSHEET_CACHE_TTL", 0)
+    results = fetch_concurrently(4, "sheet1", 5, "csv")
+    assert results == [CSV] * 4
+    # одна ревалидация на всех, сервер ответил 304 — отдали сохранённое содержимое
+    assert upstream == [(upstream[0][0], None), (upstream[0][0], ETAG)]
+
+
+URL = "https://docs.google.com/spreadsheets/d/sheet1/edit"
+
+
+def test_xlsx_with_gid_exports_that_tab_as_csv(upstream):
+    # gid=0 — не обязательно первая вкладка книги: лист по gid берём только из csv-выгрузки
+    upl, gid, fmt = server.gsheet_upload(URL + "#gid=0", "xlsx")
+    assert (gid, fmt) == (0, "csv")
+    assert upl.file.getvalue() == CSV
+    assert [path for path, _ in upstream] == ["/spreadsheets/d/sheet1/export?format=csv&gid=0"]
+
+
+def test_xlsx_without_gid_downloads_whole_book(upstream):
+    upl, gid, fmt = server.gsheet_upload(URL, "xlsx")
+    assert (gid, fmt) == (None, "xlsx")
+    assert upl.file.getvalue() == BOOK
+    assert [path for path, _ in upstream] == ["/spreadsheets/d/sheet1/export?format=xlsx"]
+
+
+def test_sheets_by_name_are_read_from_book(upstream):
+    sets = server.load_record_sets(None, URL, 1, "xlsx", ["Осень", "5"])
+    assert [label for label, _ in sets] == ["Осень", "5"]
+    assert sets[0][1][0]["ФИО"] == "Сидоров Сидор"
+    assert sets[1][1][0]["ФИО"] == "Иванов Иван"
+
+
+def test_sheet_names_need_xlsx(upstream):
+    with pytest.raises(server.HTTPException) as e:
+        server.load_record_sets(None, URL, 1, "csv", ["Осень"])
+    assert e.value.status_code == 400
+    assert upstream == []
@@ -0,0 +1,84 @@
+"""Автоопределение строки заголовков (header_row=0): xlsx с шапкой над таблицей, CSV, явный header_row."""
+import io
+
+import openpyxl
+import pandas as pd
+
+import server
+
+TITLE = ["Список группы ЭК-21"]
+HEADER = ["ФИО", "Группа", "Руководитель"]
+ROWS = [["Иванов Иван Иванович", "ЭК-21", "Петров П. П."], ["Сидорова Анна Павловна", "ЭК-21", ""]]
+
+
+def xlsx(rows):
+    wb = openpyxl.Workbook()
+    for row in rows:
+        wb.active.append(row)
+    out = io.BytesIO()
+    wb.save(out)
+    out.seek(0)
+    return out
+
+
+def test_header_index_collects_fields_and_filename_masks():
+    templates = [{"fields": {"fio": "ФИО  Студента"}, "out": "{Группа}_{Тема ВКР}.docx"}]
+    assert server.header_index(templates) == {"фио", "группа", "фиостудента", "темавкр"}
+
+
+def test_title_and_blank_row_above_header():
+    grid = [TITLE, [None, None, None], HEADER, *ROWS]
+    detected = server.detect_header_row(grid)
+    assert detected["row"] == 3
+    assert detected["confidence"] == 1.0
+    assert detected["candidates"] == [{"row": 3, "score": 2}]
+
+
+def test_no_known_headers_falls_back_to_first_row():
+    detected = server.detect_header_row([["Колонка A", "Колонка B"], ["1", "2"]])
+    assert detected == {"row": 1, "score": 0, "confidence": 0.0, "candidates": []}
+    assert server.detect_header_row([])["row"] == 1
+
+
+def test_tie_prefers_upper_row_with_half_confidence():
+    detected = server.detect_header_row([["ФИО", "x"], ["ФИО", "y"]])
+    assert (detected["row"], detected["confidence"]) == (1, 0.5)
+
+
+def test_xlsx_auto_detection_matches_explicit_header_row():
+    source = xlsx([TITLE, [], HEADER, *ROWS])
+    auto, meta = server.read_wide_try(source, True, 0)
+    assert meta["header_row"] == 2
+    assert meta["header_detected"]["row"] == 3
+
+    explicit, meta = server.read_wide_try(source, True, 3)
+    assert "header_detected" not in meta
+    pd.testing.assert_frame_equal(auto, explicit)
+    assert list(auto.columns) == HEADER
+    assert auto.iloc[0, 0] == "Иванов Иван Иванович"
+
+
+def test_explicit_header_row_overrides_detection():
+    df, meta = server.read_wide_try(xlsx([TITLE, [], HEADER, *ROWS]), True, 1)
+    assert "header_detected" not in meta
+    assert meta["header_row"] == 0
+    assert list(df.columns)[0] == TITLE[0]
+
+
+def test_frame_from_grid_names_like_read_excel():
+    source = xlsx([TITLE, ["ФИО", None, "ФИО", "Группа"], ["Иванов", "x", "дубль", "ЭК-21"]])
+    grid = pd.read_excel(source, header=None)
+    source.seek(0)
+    reference = pd.read_excel(source, header=1)
+    pd.testing.assert_frame_equal(server.frame_from_grid(grid, 1), reference)
+    assert list(reference.columns) == ["ФИО", "Unnamed: 1", "ФИО.1", "Группа"]
+
+
+def test_csv_title_row_and_blank_line():
+    text = "\n".join([TITLE[0], "", ",".join(HEADER), *(",".join(r) for r in ROWS)]) + "\n"
+    df, meta = server.read_wide_try(io.BytesIO(text.encode("utf-8")), False, 0)
+    # пустую строку CSV не считают ни pandas, ни поиск заголовков: шапка — вторая строка
+    assert meta["header_detected"]["row"] == 2
+    assert meta["header_detected"]["confidence"] == 1.0
+    assert list(df.columns) == HEADER
+    assert len(df) == len(ROWS)
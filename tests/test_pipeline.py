@@ -0,0 +1,131 @@
+"""
+Конвейер режима folders (pipeline_documents): порядок записи как у render_group, общий рендер
+шаблона для нескольких групп, ошибки → .ERROR.txt, не больше PIPELINE_DEPTH документов впереди записи.
+Рендер и PDF подменены заглушками — soffice не нужен.
+"""
+import random
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+import server
+
+
+def template(tid, output="docx", sha=None):
+    return {"id": tid, "path": f"{tid}.docx", "out": f"{tid}_{{ФИО}}.docx", "fields": {"fio": "ФИО"},
+            "output": output, "_sha": sha or f"sha-{tid}"}
+
+
+STUDENTS = [{"ФИО": f"Студент {n}"} for n in range(1, 6)]
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Заглушки рендера и PDF со случайной задержкой: готовность документов идёт не по порядку."""
+    calls = Counter()
+    lock = threading.Lock()
+
+    def render_docx_bytes(tpl, ctx):
+        with lock:
+            calls[(ctx["fio"], tpl["_sha"])] += 1
+        time.sleep(random.uniform(0, 0.005))
+        if tpl["id"] == "bad":
+            raise ValueError("сломанный шаблон")
+        return f"docx:{tpl['_sha']}:{ctx['fio']}".encode()
+
+    def docx_bytes_to_pdf_bytes(docx_bytes):
+        time.sleep(random.uniform(0, 0.005))
+        if b"badpdf" in docx_bytes:
+            raise RuntimeError("soffice упал")
+        return b"pdf:" + docx_bytes
+
+    monkeypatch.setattr(server, "render_docx_bytes", render_docx_bytes)
+    monkeypatch.setattr(server, "docx_bytes_to_pdf_bytes", docx_bytes_to_pdf_bytes)
+    monkeypatch.setattr(server, "PIPELINE_RENDER_WORKERS", 4)
+    monkeypatch.setattr(server, "PIPELINE_PDF_WORKERS", 2)
+    return calls
+
+
+def run_pipeline(jobs):
+    out = []
+    server.pipeline_documents(jobs, lambda arcname, data, row: out.append((arcname, data, row)))
+    return out
+
+
+def run_render_group(jobs):
+    memo, entries, report = {}, [], []
+    for records, templates, prefix in jobs:
+        entries += server.render_group(records, templates, prefix, memo=memo, report=report)
+    return [(arcname, data, row) for (arcname, data), row in zip(entries, report)]
+
+
+def without_timing(rows):
+    return [(arcname, data, {k: v for k, v in row.items() if not k.endswith("_ms")}) for arcname, data, row in rows]
+
+
+def test_write_order_matches_render_group(renders):
+    jobs = [
+        (STUDENTS, [template("a"), template("b", "pdf"), template("c")], "g1"),
+        (STUDENTS[:2], [template("d", "pdf")], "g2"),
+    ]
+    piped = run_pipeline(jobs)
+    assert len(piped) == 5 * 3 + 2
+    assert without_timing(piped) == without_timing(run_render_group(jobs))
+    assert piped[1][0] == "g1/001_Студент 1/b_Студент 1.pdf"
+    assert piped[1][1] == "pdf:docx:sha-b:Студент 1".encode()
+
+
+def test_shared_template_is_rendered_once_per_student(renders):
+    a = template("a")
+    twin = template("twin", sha="sha-a")  # побайтно тот же .docx с теми же полями
+    jobs = [(STUDENTS, [a, template("b")], "g1"), (STUDENTS, [a, twin], "g2")]
+    piped = run_pipeline(jobs)
+
+    assert len(piped) == 5 * 4
+    assert all(renders[(st["ФИО"], "sha-a")] == 1 for st in STUDENTS)
+    reused = [row for _, _, row in piped if row["reused"]]
+    assert len(reused) == 5 * 2
+    assert all(row["render_ms"] == 0.0 and row["template"] in ("a", "twin") for row in reused)
+    by_name = {arcname: data for arcname, data, _ in piped}
+    assert by_name["g2/003_Студент 3/twin_Студент 3.docx"] == by_name["g1/003_Студент 3/a_Студент 3.docx"]
+
+
+def test_render_and_pdf_errors_become_error_entries(renders):
+    jobs = [(STUDENTS[:2], [template("a"), template("bad"), template("badpdf", "pdf")], "")]
+    piped = run_pipeline(jobs)
+    names = [arcname for arcname, _, _ in piped]
+    assert names[:3] == [
+        "001_Студент 1/a_Студент 1.docx",
+        "001_Студент 1/bad_{ФИО}.docx.ERROR.txt",
+        "001_Студент 1/badpdf_{ФИО}.docx.ERROR.txt",
+    ]
+    assert piped[1][1].decode() == "Ошибка (bad.docx): ValueError: сломанный шаблон"
+    assert piped[2][1].decode() == "Ошибка (badpdf.docx): RuntimeError: soffice упал"
+    assert [row["status"] for _, _, row in piped] == ["ok", "error", "error"] * 2
+    assert piped[2][2]["error"] == piped[2][1].decode()
+
+
+def test_no_more_than_depth_documents_ahead_of_writer(renders, monkeypatch):
+    monkeypatch.setattr(server, "PIPELINE_DEPTH", 3)
+    counts = {"started": 0, "written": 0, "peak": 0}
+    lock = threading.Lock()
+    render = server.render_docx_bytes
+
+    def counting(tpl, ctx):
+        with lock:
+            counts["started"] += 1
+            counts["peak"] = max(counts["peak"], counts["started"] - counts["written"])
+        return render(tpl, ctx)
+
+    def write(arcname, data, row):
+        time.sleep(0.01)  # запись медленнее рендера — рендер упирается в PIPELINE_DEPTH
+        with lock:
+            counts["written"] += 1
+
+    monkeypatch.setattr(server, "render_docx_bytes", counting)
+    students = [dict(st) for st in STUDENTS * 4]  # разные записи: memo их не склеивает
+    server.pipeline_documents([(students, [template("a"), template("b", "pdf")], "")], write)
+    assert counts["written"] == counts["started"] == 40
+    assert counts["peak"] == 3
@@ -0,0 +1,108 @@
+"""Идемпотентность /generate: кэш результатов по содержимому, склейка одновременных запросов, TTL."""
+import io
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from starlette.datastructures import UploadFile
+from starlette.requests import Request
+
+import server
+
+TABLE = (
+    "ФИО,Группа,НачалоПрактики\n"
+    "Иванов Иван Иванович,ЭК-21,01.09.2025\n"
+    "Петров Пётр Петрович,ЭК-21,02.09.2025\n"
+).encode("utf-8")
+INCLUDE = "input_first_тз_для_практик_дневник,input_first_тз_для_вкр_титул_вкр"
+
+
+@pytest.fixture(autouse=True)
+def results_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "RESULTS_DIR", tmp_path)
+    monkeypatch.setattr(server, "RESULT_CACHE_TTL", 600.0)
+    return tmp_path
+
+
+def generate():
+    request = Request({"type": "http", "method": "POST", "path": "/generate", "headers": []})
+    upload = UploadFile(file=io.BytesIO(TABLE), filename="students.csv")
+    response = server.generate_zip(
+        request, table_file=upload, gsheet_url=None, header_row=0, include=INCLUDE, gsheet_format=None,
+        kits=None, sheets=None, layout="folders", merge_pdf=False, kit=None,
+    )
+    return response.headers, Path(response.path).read_bytes()
+
+
+@pytest.fixture
+def build_calls(monkeypatch):
+    calls = []
+    build_result = server.build_result
+
+    def counting(*args):
+        calls.append(args)
+        time.sleep(0.2)  # окно, в которое успевают прийти одинаковые запросы
+        return build_result(*args)
+
+    monkeypatch.setattr(server, "build_result", counting)
+    return calls
+
+
+def test_same_input_is_served_from_cache(build_calls):
+    first_headers, first = generate()
+    second_headers, second = generate()
+    assert first_headers["x-result-cache"] == "miss"
+    assert second_headers["x-result-cache"] == "hit"
+    assert second == first
+    assert second_headers["etag"] == first_headers["etag"]
+    assert second_headers["x-result-id"] == first_headers["x-result-id"]
+    assert len(build_calls) == 1
+
+
+def test_concurrent_identical_requests_build_once(build_calls):
+    out, errors = [], []
+
+    def worker():
+        try:
+            out.append(generate())
+        except Exception as e:  # исключение в потоке иначе потерялось бы молча
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert len(build_calls) == 1
+    assert sorted(h["x-result-cache"] for h, _ in out) == ["hit", "hit", "hit", "miss"]
+    assert len({h["etag"] for h, _ in out}) == 1
+    assert len({data for _, data in out}) == 1
+
+
+def test_expired_entry_is_rebuilt(build_calls, results_dir):
+    first_headers, first = generate()
+    (key_file,) = results_dir.glob("*.key")
+    stale = time.time() - server.RESULT_CACHE_TTL - 1
+    os.utime(key_file, (stale, stale))
+
+    second_headers, second = generate()
+    assert second_headers["x-result-cache"] == "miss"
+    assert len(build_calls) == 2
+    # новый прогон — тот же контент: id результата другой, ETag и байты прежние
+    assert second_headers["x-result-id"] != first_headers["x-result-id"]
+    assert second_headers["etag"] == first_headers["etag"]
+    assert second == first
+    assert generate()[0]["x-result-cache"] == "hit"
+
+
+def test_docx_slim_is_part_of_the_key(build_calls, monkeypatch):
+    monkeypatch.setattr(server, "DOCX_SLIM", False)
+    assert generate()[0]["x-result-cache"] == "miss"
+    monkeypatch.setattr(server, "DOCX_SLIM", True)
+    assert generate()[0]["x-result-cache"] == "miss"
+    assert generate()[0]["x-result-cache"] == "hit"
+    assert len(build_calls) == 2
@@ -0,0 +1,80 @@
+"""Предварительная проверка таблицы (validate_records): колонки, даты, маски имён, номера строк."""
+import pandas as pd
+
+import server
+
+TEMPLATES = [
+    {"id": "титул", "fields": {"fio": "ФИО", "start": "ДатаНачала"}, "out": "титул_{ФИО}_{Группа}.docx"},
+    {"id": "отзыв", "fields": {"fio": "ФИО", "theme": "Тема"}, "out": "отзыв.docx", "dir": "{Кафедра}"},
+]
+
+
+def record(**values):
+    base = {"ФИО": "Иванов Иван", "Группа": "ЭК-21", "Кафедра": "Экономики", "ДатаНачала": "01.09.2025", "Тема": "Тема"}
+    return {**base, **values}
+
+
+def test_clean_table_has_no_issues():
+    report = server.validate_records([record(), record(ФИО="Петров Пётр", ДатаНачала="2025-09-01")], TEMPLATES)
+    assert report["rows"] == 2
+    assert report["rows_with_issues"] == 0
+    assert report["missing_columns"] == {}
+    assert report["missing_filename_columns"] == []
+    assert report["columns"] == {}
+
+
+def test_missing_columns_are_listed_per_template():
+    records = [{k: v for k, v in record().items() if k not in ("Тема", "Группа")}]
+    report = server.validate_records(records, TEMPLATES)
+    assert report["missing_columns"] == {"Тема": ["отзыв"]}
+    assert report["missing_filename_columns"] == ["Группа"]
+
+
+def test_unparseable_date_is_reported_with_its_value():
+    report = server.validate_records([record(), record(ДатаНачала="31.02.2025"), record(ДатаНачала="")], TEMPLATES)
+    assert [r["row"] for r in report["issues"]] == [2, 3]
+    assert report["issues"][0]["bad_date"] == {"ДатаНачала": "31.02.2025"}
+    # пустая дата — «пустое поле», а не «неразбираемая дата»
+    assert report["issues"][1] == {"row": 3, "fio": "Иванов Иван", "empty": ["ДатаНачала"]}
+    assert report["columns"]["ДатаНачала"] == {"empty": 1, "bad_date": 1, "templates": ["титул"]}
+
+
+def test_date_columns_are_matched_by_name():
+    templates = [{"id": "t", "fields": {"x": "Конец практики", "y": "Оценка"}, "out": "t.docx"}]
+    report = server.validate_records([{"ФИО": "А", "Конец практики": "завтра", "Оценка": "отлично"}], templates)
+    assert report["issues"][0]["bad_date"] == {"Конец практики": "завтра"}
+
+
+def test_empty_filename_mask_fields():
+    report = server.validate_records([record(Кафедра="", Группа="")], TEMPLATES)
+    (issue,) = report["issues"]
+    assert sorted(issue["filename"]) == ["Группа", "Кафедра"]
+    assert "empty" not in issue  # Группа и Кафедра нужны только именам файлов
+    assert report["columns"] == {}
+
+
+def test_row_numbers_match_student_folders():
+    # пустая строка таблицы в записи не попадает — номера идут по записям, как папки 001_…
+    df = pd.DataFrame([
+        record(ФИО="Иванов Иван"),
+        {k: "" for k in record()},
+        record(ФИО="Петров Пётр"),
+        record(ФИО="Сидоров Сидор", ДатаНачала="вчера"),
+    ])
+    records, _ = server.records_from_wide_df(df)
+    (issue,) = server.validate_records(records, TEMPLATES)["issues"]
+    folder = server.student_folder(issue["row"], records[issue["row"] - 1])
+    assert folder.startswith("003_") and issue["fio"] == "Сидоров Сидор"
+
+
+def test_cells_inherited_from_first_row_are_not_reported():
+    df = pd.DataFrame([
+        record(ФИО="Иванов Иван", Тема=""),
+        record(ФИО="Петров Пётр", Кафедра="", ДатаНачала="", Тема=""),
+    ])
+    records, _ = server.records_from_wide_df(df)
+    assert records[1]["Кафедра"] == "Экономики" and records[1]["ДатаНачала"] == "01.09.2025"
+    report = server.validate_records(records, TEMPLATES)
+    # пустая «Тема» первой строки наследуется второй строкой, поэтому пусто в обеих
+    assert [(r["row"], r["empty"]) for r in report["issues"]] == [(1, ["Тема"]), (2, ["Тема"])]
+    assert report["columns"] == {"Тема": {"empty": 2, "bad_date": 0, "templates": ["отзыв"]}}
@@ -0,0 +1,164 @@
+"""Распределённый прогон vkr.py: очередь частей с арендой, склейка частичных архивов, ZIP64."""
+import io
+import subprocess
+import sys
+import time
+import zipfile
+from pathlib import Path
+
+import pytest
+
+import server
+import vkr
+
+ROOT = Path(__file__).resolve().parent.parent
+META = {"created": 0.0, "students": 1, "templates": {}}
+
+
+def payload(n):
+    return ([{"ФИО": f"Студент {n}"}], ["tpl"], "", n)
+
+
+@pytest.fixture
+def queue(tmp_path):
+    q = vkr.ShardQueue(tmp_path / vkr.QUEUE_FILE)
+    yield q
+    q.close()
+
+
+def test_payloads_round_trip_as_json(queue):
+    queue.fill({**META, "templates": {"Шаблон": "v1"}}, [payload(1)])
+    assert queue.meta()["templates"] == {"Шаблон": "v1"}
+    shard_id, data = queue.claim("a", 60)
+    assert (shard_id, data) == (1, payload(1))
+    stored = queue.db.execute("SELECT typeof(payload), typeof(value) FROM shards, meta").fetchone()
+    assert stored == ("text", "text")
+
+
+def test_expired_lease_is_reclaimed_and_old_owner_cannot_complete(queue):
+    queue.fill(META, [payload(1)])
+    assert queue.claim("a", 0.05)[0] == 1
+    assert queue.claim("b", 60) is None  # аренда «a» ещё действует
+    time.sleep(0.1)
+    assert queue.claim("b", 60)[0] == 1
+    assert not queue.extend(1, "a", 60)
+    assert not queue.complete(1, "a", 1, [])
+    assert queue.complete(1, "b", 1, ["x.ERROR.txt"])
+    (row,) = queue.results()
+    assert row[1:4] == ("done", "b", 1)
+    assert row[4] == '["x.ERROR.txt"]'
+
+
+def test_shard_fails_after_max_attempts_and_requeues_on_restart(queue):
+    queue.fill(META, [payload(1)])
+    for attempt in range(vkr.MAX_ATTEMPTS):
+        assert queue.claim(f"w{attempt}", -1)[0] == 1  # аренда сразу просрочена: воркер «умер»
+    assert queue.claim("late", 60) is None
+    assert queue.counts() == {"failed": 1}
+
+    assert queue.requeue_failed() == 1
+    assert queue.counts() == {"queued": 1}
+    assert queue.claim("again", 60)[0] == 1
+
+
+def test_release_counts_attempts(queue):
+    queue.fill(META, [payload(1)])
+    for attempt in range(vkr.MAX_ATTEMPTS):
+        queue.claim("w", 60)
+        queue.release(1, "w", "boom")
+    assert queue.counts() == {"failed": 1}
+    assert queue.results()[0][5] == "boom"
+
+
+def test_render_chunk_raises_shard_lost_when_cancelled():
+    tpl = server.current_plan().templates[0]
+    with pytest.raises(vkr.ShardLost):
+        vkr.render_chunk([{"ФИО": "Иванов"}], [tpl["id"]], "", 1, None, lambda: True)
+
+
+def test_worker_drops_shard_when_extend_fails(tmp_path, monkeypatch):
+    run = tmp_path
+    q = vkr.ShardQueue(run / vkr.QUEUE_FILE)
+    q.fill(META, [payload(1)])
+
+    def extend(self, shard_id, worker, lease):
+        # часть перехватил и уже сдал другой воркер
+        self.db.execute("UPDATE shards SET worker = 'thief', state = 'done' WHERE id = ?", (shard_id,))
+        return False
+
+    def render_chunk(records, ids, prefix, start, out_dir, cancelled):
+        deadline = time.monotonic() + 5
+        while not cancelled():
+            assert time.monotonic() < deadline, "heartbeat не заметил потерю аренды"
+            time.sleep(0.01)
+        raise vkr.ShardLost()
+
+    monkeypatch.setattr(vkr.ShardQueue, "extend", extend)
+    monkeypatch.setattr(vkr, "render_chunk", render_chunk)
+    monkeypatch.setattr(vkr, "POLL_INTERVAL", 0.01)
+    assert vkr.work_loop(str(run), 0.06) == 0
+    assert not vkr.part_path(run, 1).exists()
+    assert q.results()[0][1:3] == ("done", "thief")
+    q.close()
+
+
+def entries(n, prefix="d"):
+    return [(f"{prefix}/{i:05d}.txt", f"документ {i}\n".encode() * (i % 7 + 1)) for i in range(n)]
+
+
+def zipfile_bytes(items):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, data in items:
+            zf.writestr(server.fixed_zipinfo(name), data)
+    return out.getvalue()
+
+
+def raw_writer(items):
+    writer = server.RawZipWriter()
+    for name, data in items:
+        writer.write(name, data)
+    return writer.close()
+
+
+def test_raw_zip_writer_matches_zipfile():
+    items = entries(50)
+    assert b"".join(raw_writer(items)) == zipfile_bytes(items)
+
+
+def test_merge_parts_matches_single_zipfile(tmp_path):
+    first, second = entries(30, "a"), entries(20, "b")
+    vkr.write_part(vkr.part_path(tmp_path, 1), first)
+    vkr.write_part(vkr.part_path(tmp_path, 2), second)
+    out = tmp_path / "all.zip"
+    vkr.merge_parts(tmp_path, [1, 2], out)
+    assert out.read_bytes() == zipfile_bytes(first + second)
+
+
+def test_zip64_end_record_for_many_entries():
+    items = [(f"{i:06d}", b"") for i in range(70_000)]
+    data = b"".join(raw_writer(items))
+    assert data == zipfile_bytes(items)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        names = zf.namelist()
+    assert len(names) == 70_000 and names[-1] == "069999"
+
+
+def run_vkr(*args):
+    subprocess.run([sys.executable, "-m", "vkr", *args], cwd=ROOT, check=True, capture_output=True)
+
+
+def test_coordinate_with_one_student_shards_matches_generate(tmp_path):
+    table = tmp_path / "students.csv"
+    table.write_text(
+        "ФИО,Группа,НачалоПрактики\n"
+        "Иванов Иван Иванович,ЭК-21,01.09.2025\n"
+        "Петров Пётр Петрович,ЭК-21,\n"
+        "Сидоров Сидор Сидорович,ЭК-22,02.09.2025\n",
+        encoding="utf-8",
+    )
+    run_vkr("generate", "--table", str(table), "--kit", "kit2", "--out", str(tmp_path / "gen.zip"), "--workers", "2")
+    run_vkr("coordinate", "--table", str(table), "--kit", "kit2", "--run-dir", str(tmp_path / "run"),
+            "--out", str(tmp_path / "coord.zip"), "--shard-size", "1", "--local-workers", "2")
+    assert (tmp_path / "coord.zip").read_bytes() == (tmp_path / "gen.zip").read_bytes()
+    assert len(zipfile.ZipFile(tmp_path / "coord.zip").namelist()) == 3 * 7
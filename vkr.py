@@ -0,0 +1,526 @@
+"""
+Пакетная генерация без HTTP — для массовых прогонов в конце семестра.
+
+    python -m vkr generate --table students.xlsx --kit kit1 --out ./out --workers 8 --format dir
+    python -m vkr generate --gsheet "https://docs.google.com/..." --kit kit1,kit2 --out out.zip
+
+Тот же план шаблонов (templates_config.py), то же чтение таблиц и тот же рендер, что у
+/generate в server.py; структура папок и порядок файлов в ZIP — как в архиве сервиса.
+Студенты делятся на части и рендерятся в нескольких процессах; в режиме dir каждый процесс
+пишет свои документы прямо на диск.
+
+Для прогона на нескольких машинах (общий диск, без брокера):
+
+    python -m vkr coordinate --table all.xlsx --kit kit1 --run-dir /mnt/shared/run1 --out all.zip
+    python -m vkr worker --run-dir /mnt/shared/run1 --processes 8      # на каждой машине
+
+Координатор делит студентов на части (shards) и кладёт их в очередь — SQLite-файл в run-dir.
+Воркеры берут части с арендой (lease), продлевают её, пока рендерят, и пишут частичные архивы
+в run-dir/parts. Часть умершего воркера по истечении аренды берёт другой. Координатор склеивает
+частичные архивы, копируя сжатые записи как есть (без распаковки и повторного сжатия).
+Перезапуск координатора с тем же run-dir продолжает прогон.
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import math
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, UploadFile
+
+import server
+
+ERROR_SUFFIX = ".ERROR.txt"
+
+
+class ShardLost(Exception):
+    """Аренду части перехватил другой воркер — дорабатывать и сдавать её уже нельзя."""
+
+CHUNKS_PER_WORKER = 2  # частей в работе на процесс: готовые ждут записи по порядку, память ограничена
+
+
+def open_table(path: Path) -> UploadFile:
+    """Файл с диска в виде UploadFile — как его получил бы /generate."""
+    return UploadFile(file=path.open("rb"), filename=path.name)
+
+
+def split_records(records: List[Dict[str, str]], size: int) -> List[Tuple[int, List[Dict[str, str]]]]:
+    """[(номер первого студента, часть записей), ...] по size записей."""
+    return [(i + 1, records[i:i + size]) for i in range(0, len(records), size)]
+
+
+def read_inputs(args: argparse.Namespace):
+    """Группы шаблонов и записи таблицы — как их получил бы /generate."""
+    plan = server.current_plan()
+    groups = server.template_groups(plan, args.kit, args.include)
+    table = open_table(Path(args.table)) if args.table else None
+    record_sets = server.load_record_sets(
+        table, args.gsheet, args.header_row, args.gsheet_format, server.split_csv(args.sheets)
+    )
+    if not any(records for _, records in record_sets):
+        raise HTTPException(400, "Не найдено ни одной строки с данными")
+    return groups, record_sets
+
+
+def build_tasks(record_sets, groups, size: int) -> List[Tuple[List[Dict[str, str]], List[str], str, int]]:
+    """Задания «лист × группа» → части по студентам; порядок частей = порядок файлов в архиве."""
+    tasks = []
+    for records, templates, prefix in server.generation_jobs(record_sets, groups):
+        ids = [t["id"] for t in templates]
+        for start, chunk in split_records(records, size):
+            tasks.append((chunk, ids, prefix, start))
+    return tasks
+
+
+def render_chunk(
+    records: List[Dict[str, str]],
+    template_ids: List[str],
+    prefix: str,
+    start: int,
+    out_dir: Optional[str],
+    cancelled: Optional[Callable[[], bool]] = None,
+) -> Tuple[List[Tuple[str, bytes]], int, int, List[str]]:
+    """
+    Выполняется в процессе-воркере. Возвращает (документы для ZIP, сколько файлов, всего байт, ошибки);
+    при out_dir документы сразу пишутся на диск и в ответ не попадают.
+    cancelled проверяется перед каждым студентом: True — бросаем ShardLost.
+    """
+    plan = server.current_plan()
+    templates = [plan.by_id[i.lower()] for i in template_ids]
+    if cancelled is None:
+        entries = server.render_group(records, templates, prefix, start=start)
+    else:
+        entries = []
+        for offset, record in enumerate(records):
+            if cancelled():
+                raise ShardLost()
+            entries += server.render_group([record], templates, prefix, start=start + offset)
+
+    errors = [name for name, _ in entries if name.endswith(ERROR_SUFFIX)]
+    count, size = len(entries), sum(len(data) for _, data in entries)
+    if out_dir is not None:
+        root = Path(out_dir)
+        for name, data in entries:
+            path = root / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+        entries = []
+    return entries, count, size, errors
+
+
+def generate(args: argparse.Namespace) -> int:
+    t0 = time.perf_counter()
+    groups, record_sets = read_inputs(args)
+    students = sum(len(records) for _, records in record_sets)
+    t_read = time.perf_counter() - t0
+
+    out = Path(args.out)
+    if args.format == "dir":
+        out.mkdir(parents=True, exist_ok=True)
+        out_dir: Optional[str] = str(out)
+    else:
+        if out.suffix.lower() != ".zip":
+            out = out.with_name(out.name + ".zip")
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out_dir = None
+
+    # примерно поровну на процесс, но не крупнее 50 студентов (память и равномерная загрузка)
+    largest = max(len(records) for _, records in record_sets)
+    tasks = build_tasks(record_sets, groups, max(1, min(50, math.ceil(largest / args.workers))))
+
+    documents, written = 0, 0
+    failures: List[str] = []
+    zf = zipfile.ZipFile(out.with_suffix(".part"), "w", compression=zipfile.ZIP_DEFLATED) if out_dir is None else None
+    pending = iter(tasks)
+    with ProcessPoolExecutor(max_workers=args.workers) as ex:
+        # окно из workers × CHUNKS_PER_WORKER частей: следующая отправляется, когда первая записана,
+        # так что в памяти не больше окна готовых документов, а порядок в ZIP — порядок частей
+        window = deque(
+            ex.submit(render_chunk, *task, out_dir) for task in itertools.islice(pending, args.workers * CHUNKS_PER_WORKER)
+        )
+        while window:
+            entries, count, size, errors = window.popleft().result()
+            task = next(pending, None)
+            if task is not None:
+                window.append(ex.submit(render_chunk, *task, out_dir))
+            for name, data in entries:
+                zf.writestr(server.fixed_zipinfo(name), data)
+            documents += count
+            written += size
+            failures += errors
+    if zf is not None:
+        zf.close()
+        out.with_suffix(".part").replace(out)
+
+    elapsed = time.perf_counter() - t0
+    failed = len(failures)
+    ok = documents - failed
+    print(f"Готово: {out}")
+    print(f"  студентов: {students}, групп: {len(groups)}, документов: {ok}, ошибок: {failed}")
+    print(f"  чтение таблицы: {t_read:.2f} с, всего: {elapsed:.2f} с, воркеров: {args.workers}")
+    print(f"  скорость: {ok / elapsed:.1f} док/с, {written / elapsed / 1024 / 1024:.1f} МБ/с")
+    for name in failures[:20]:
+        print(f"  ошибка: {name}", file=sys.stderr)
+    if len(failures) > 20:
+        print(f"  … и ещё {len(failures) - 20}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+# ============= Распределённый прогон: координатор и воркеры =============
+QUEUE_FILE = "queue.sqlite"
+MAX_ATTEMPTS = 3      # столько раз часть выдаётся воркерам, прежде чем считается упавшей
+POLL_INTERVAL = 2.0   # сек между опросами очереди
+
+
+def dump_json(value) -> str:
+    # очередь лежит на общем диске: только данные (JSON), никакого pickle — его чтение исполняет код
+    return json.dumps(value, ensure_ascii=False)
+
+
+class ShardQueue:
+    """
+    Очередь частей в SQLite-файле на общем диске. Часть выдаётся воркеру с арендой до
+    lease_until; воркер продлевает аренду, пока работает. Просроченная аренда = воркер умер,
+    часть снова доступна (attempts считает выдачи). Соединение — на поток.
+    """
+
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(str(path), timeout=60, isolation_level=None)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS shards (
+                id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',   -- queued | running | done | failed
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                documents INTEGER,
+                errors TEXT,
+                error TEXT
+            );
+            """
+        )
+
+    def close(self) -> None:
+        self.db.close()
+
+    def meta(self) -> Optional[dict]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'run'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def fill(self, meta: dict, payloads: List[tuple]) -> None:
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('run', ?)", (dump_json(meta),))
+            self.db.executemany("INSERT INTO shards (payload) VALUES (?)", [(dump_json(p),) for p in payloads])
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def claim(self, worker: str, lease: float) -> Optional[Tuple[int, tuple]]:
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute(
+                "UPDATE shards SET state = 'failed', error = 'воркер перестал отвечать' "
+                "WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, MAX_ATTEMPTS),
+            )
+            row = self.db.execute(
+                "SELECT id, payload FROM shards "
+                "WHERE state = 'queued' OR (state = 'running' AND lease_until < ?) ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row:
+                self.db.execute(
+                    "UPDATE shards SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                    "WHERE id = ?",
+                    (worker, now + lease, row[0]),
+                )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return (row[0], tuple(json.loads(row[1]))) if row else None
+
+    def extend(self, shard_id: int, worker: str, lease: float) -> bool:
+        cur = self.db.execute(
+            "UPDATE shards SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (time.time() + lease, shard_id, worker),
+        )
+        return cur.rowcount == 1
+
+    def complete(self, shard_id: int, worker: str, documents: int, errors: List[str]) -> bool:
+        # чужая (перехваченная после просрочки) часть не засчитывается — её допишет новый владелец
+        cur = self.db.execute(
+            "UPDATE shards SET state = 'done', documents = ?, errors = ?, lease_until = NULL "
+            "WHERE id = ? AND worker = ? AND state = 'running'",
+            (documents, dump_json(errors), shard_id, worker),
+        )
+        return cur.rowcount == 1
+
+    def release(self, shard_id: int, worker: str, error: str) -> None:
+        self.db.execute(
+            "UPDATE shards SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "error = ?, lease_until = NULL WHERE id = ? AND worker = ? AND state = 'running'",
+            (MAX_ATTEMPTS, error, shard_id, worker),
+        )
+
+    def requeue_failed(self) -> int:
+        cur = self.db.execute("UPDATE shards SET state = 'queued', attempts = 0, error = NULL WHERE state = 'failed'")
+        return cur.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall())
+
+    def results(self):
+        return self.db.execute("SELECT id, state, worker, documents, errors, error FROM shards ORDER BY id").fetchall()
+
+
+def part_path(run_dir: Path, shard_id: int) -> Path:
+    return run_dir / "parts" / f"{shard_id:06d}.zip"
+
+
+def write_part(path: Path, entries: List[Tuple[str, bytes]]) -> None:
+    """Частичный архив: те же записи, что /generate положил бы в общий ZIP (fixed_zipinfo)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries:
+            zf.writestr(server.fixed_zipinfo(name), data)
+    os.replace(tmp, path)
+
+
+def merge_parts(run_dir: Path, shard_ids: List[int], out: Path) -> int:
+    """Склейка частичных архивов в один ZIP без повторного сжатия; возвращает размер."""
+    tmp = out.with_suffix(".part")
+    with tmp.open("wb") as fp:
+        writer = server.RawZipWriter(fp)
+        for shard_id in shard_ids:
+            for name, member in server.zip_raw_members(part_path(run_dir, shard_id)):
+                writer.write_raw(name, member)
+        writer.close()
+    tmp.replace(out)
+    return out.stat().st_size
+
+
+def check_templates(meta: dict) -> None:
+    """На машине воркера шаблоны должны быть теми же, что у координатора."""
+    plan = server.current_plan()
+    for tpl_id, version in meta["templates"].items():
+        tpl = plan.by_id.get(tpl_id.lower())
+        if tpl is None or server.template_version(tpl) != version:
+            raise HTTPException(409, f"Шаблон {tpl_id} отличается от шаблона координатора")
+
+
+def work_loop(run_dir: str, lease: float) -> int:
+    """Один процесс-воркер: берёт части, пока они есть; возвращает число сделанных частей."""
+    run = Path(run_dir)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    queue = ShardQueue(run / QUEUE_FILE)
+    meta = queue.meta()
+    while meta is None:  # воркер запущен раньше координатора
+        time.sleep(POLL_INTERVAL)
+        meta = queue.meta()
+    check_templates(meta)
+
+    done = 0
+    while True:
+        shard = queue.claim(worker, lease)
+        if shard is None:
+            counts = queue.counts()
+            if not counts.get("queued") and not counts.get("running"):
+                break
+            time.sleep(POLL_INTERVAL)  # части ещё у других воркеров: вдруг кто-то из них умрёт
+            continue
+
+        shard_id, (records, ids, prefix, start) = shard
+        stop, lost = threading.Event(), threading.Event()
+
+        def heartbeat():
+            hb = ShardQueue(run / QUEUE_FILE)
+            try:
+                while not stop.wait(lease / 3):
+                    if not hb.extend(shard_id, worker, lease):
+                        # аренда истекла и часть уже выдана другому воркеру
+                        lost.set()
+                        return
+            finally:
+                hb.close()
+
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            entries, count, _, errors = render_chunk(records, ids, prefix, start, None, lost.is_set)
+            if lost.is_set():
+                raise ShardLost()
+            write_part(part_path(run, shard_id), entries)
+        except ShardLost:
+            # часть доделает новый владелец: не пишем её архив, не сдаём и не возвращаем в очередь
+            print(f"Воркер {worker}: аренда части {shard_id} потеряна, часть брошена", file=sys.stderr)
+            continue
+        except Exception as e:
+            queue.release(shard_id, worker, f"{type(e).__name__}: {e}")
+            continue
+        finally:
+            stop.set()
+            beat.join()
+        if queue.complete(shard_id, worker, count, errors):
+            done += 1
+    queue.close()
+    return done
+
+
+def work(args: argparse.Namespace) -> int:
+    run_dir = str(Path(args.run_dir).resolve())
+    if args.processes == 1:
+        shards = work_loop(run_dir, args.lease)
+    else:
+        with ProcessPoolExecutor(max_workers=args.processes) as ex:
+            shards = sum(ex.map(work_loop, [run_dir] * args.processes, [args.lease] * args.processes))
+    print(f"Воркер {socket.gethostname()}: частей сделано {shards}")
+    return 0
+
+
+def coordinate(args: argparse.Namespace) -> int:
+    t0 = time.perf_counter()
+    run_dir = Path(args.run_dir).resolve()
+    run_dir.mkdir(parents=True, exist_ok=True)
+    queue = ShardQueue(run_dir / QUEUE_FILE)
+
+    meta = queue.meta()
+    if meta is None:
+        groups, record_sets = read_inputs(args)
+        tasks = build_tasks(record_sets, groups, args.shard_size)
+        meta = {
+            "created": time.time(),
+            "students": sum(len(records) for _, records in record_sets),
+            "templates": {t["id"]: server.template_version(t) for _, tpls in groups for t in tpls},
+        }
+        queue.fill(meta, tasks)
+        print(f"Очередь: {len(tasks)} частей, студентов {meta['students']} → {run_dir}")
+    else:
+        again = queue.requeue_failed()
+        print(f"Продолжаем прогон {run_dir}" + (f" (повторно в очередь: {again})" if again else ""))
+
+    local = None
+    if args.local_workers:
+        local = subprocess.Popen(
+            [sys.executable, "-m", "vkr", "worker", "--run-dir", str(run_dir),
+             "--processes", str(args.local_workers), "--lease", str(args.lease)],
+            cwd=str(Path(__file__).resolve().parent),
+        )
+
+    last = None
+    while True:
+        counts = queue.counts()
+        state = (counts.get("done", 0), counts.get("running", 0), counts.get("queued", 0), counts.get("failed", 0))
+        if state != last:
+            print("  готово {}, в работе {}, в очереди {}, упало {}".format(*state), flush=True)
+            last = state
+        if not state[1] and not state[2]:
+            break
+        time.sleep(POLL_INTERVAL)
+    if local is not None:
+        local.wait()
+
+    rows = queue.results()
+    queue.close()
+    failed = [r for r in rows if r[1] != "done"]
+    for shard_id, _, worker, _, _, error in failed:
+        print(f"  часть {shard_id} не сделана ({worker}): {error}", file=sys.stderr)
+    if failed:
+        print(f"Архив не собран: упало частей {len(failed)}; перезапустите coordinate с тем же --run-dir",
+              file=sys.stderr)
+        return 1
+
+    out = Path(args.out)
+    if out.suffix.lower() != ".zip":
+        out = out.with_name(out.name + ".zip")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    t_merge = time.perf_counter()
+    size = merge_parts(run_dir, [r[0] for r in rows], out)
+
+    documents = sum(r[3] or 0 for r in rows)
+    failures = [name for r in rows for name in json.loads(r[4] or "[]")]
+    workers: Dict[str, int] = {}
+    for r in rows:
+        host = (r[2] or "?").rsplit(":", 1)[0]
+        workers[host] = workers.get(host, 0) + 1
+    elapsed = time.perf_counter() - t0
+    print(f"Готово: {out} ({size / 1024 / 1024:.1f} МБ, склейка {time.perf_counter() - t_merge:.2f} с)")
+    print(f"  студентов: {meta['students']}, частей: {len(rows)}, документов: {documents - len(failures)}, "
+          f"ошибок: {len(failures)}")
+    print(f"  всего: {elapsed:.2f} с, {(documents - len(failures)) / elapsed:.1f} док/с; части по машинам: "
+          + ", ".join(f"{h}={n}" for h, n in sorted(workers.items())))
+    for name in failures[:20]:
+        print(f"  ошибка: {name}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m vkr", description="Генерация документов ВКР без веб-сервиса")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_input_args(p: argparse.ArgumentParser) -> None:
+        src = p.add_mutually_exclusive_group(required=True)
+        src.add_argument("--table", help="Excel/CSV с данными студентов")
+        src.add_argument("--gsheet", help="ссылка на Google Sheet")
+        p.add_argument("--kit", help="комплект(ы) через запятую: kit1,kit2 (по умолчанию — все шаблоны)")
+        p.add_argument("--include", help="id шаблонов через запятую, группы — через «;» (как include у /generate)")
+        p.add_argument("--sheets", help="листы Excel (имена/номера) или gid Google Sheets (имена — с --gsheet-format xlsx) через запятую")
+        p.add_argument("--header-row", type=int, default=0, help="номер строки заголовков (по умолчанию 0 — найти автоматически)")
+        p.add_argument("--gsheet-format", default=None, help="csv или xlsx для Google Sheets")
+
+    gen = sub.add_parser("generate", help="сгенерировать документы по таблице")
+    add_input_args(gen)
+    gen.add_argument("--out", required=True, help="папка (--format dir) или файл архива (--format zip)")
+    gen.add_argument("--format", choices=("zip", "dir"), default="zip")
+    gen.add_argument("--workers", type=int, default=server.GENERATE_WORKERS, help="процессов рендера")
+    gen.set_defaults(run=generate)
+
+    coord = sub.add_parser("coordinate", help="разбить прогон на части, дождаться воркеров и склеить архив")
+    add_input_args(coord)
+    coord.add_argument("--run-dir", required=True, help="папка прогона на общем диске (очередь и части)")
+    coord.add_argument("--out", required=True, help="итоговый архив")
+    coord.add_argument("--shard-size", type=int, default=50, help="студентов в части (по умолчанию 50)")
+    coord.add_argument("--local-workers", type=int, default=0, help="сколько воркеров запустить на этой машине")
+    coord.add_argument("--lease", type=float, default=120, help="аренда части, сек (по умолчанию 120)")
+    coord.set_defaults(run=coordinate)
+
+    wrk = sub.add_parser("worker", help="брать части из очереди прогона и рендерить их")
+    wrk.add_argument("--run-dir", required=True, help="папка прогона на общем диске")
+    wrk.add_argument("--processes", type=int, default=server.GENERATE_WORKERS, help="процессов на машине")
+    wrk.add_argument("--lease", type=float, default=120, help="аренда части, сек (по умолчанию 120)")
+    wrk.set_defaults(run=work)
+
+    args = parser.parse_args(argv)
+    for name in ("workers", "processes", "shard_size"):
+        if hasattr(args, name):
+            setattr(args, name, max(1, getattr(args, name)))
+    try:
+        return args.run(args)
+    except HTTPException as e:
+        print(f"Ошибка: {e.detail}", file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())